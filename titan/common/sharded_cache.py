@@ -41,10 +41,10 @@ DEFAULT_EXPIRATION_SECONDS = 24 * 60 * 60  # 1 day
 # max number of bytes of the pickled shard_map dict (without content).
 MIN_SHARDING_SIZE = memcache.MAX_VALUE_SIZE - 1000  # 999 KB
 
-def Get(key):
+def Get(key, namespace=None):
   """Get a memcache entry, or None."""
   key = MEMCACHE_PREFIX + key
-  shard_map = memcache.get(key)
+  shard_map = memcache.get(key, namespace=namespace)
   if not shard_map:
     # The shard_map was evicted or never set.
     return
@@ -55,10 +55,10 @@ def Get(key):
     return pickle.loads(shard_map['content'])
 
   keys = ['%s%d' % (key, i) for i in range(num_shards)]
-  shards = memcache.get_multi(keys)
+  shards = memcache.get_multi(keys, namespace=namespace)
   if len(shards) != num_shards:
     # One or more content shards were evicted, delete map and content shards.
-    memcache.delete_multi([key] + keys)
+    memcache.delete_multi([key] + keys, namespace=namespace)
     return
 
   # All shards present, stitch contents back together and unpickle.
@@ -67,7 +67,7 @@ def Get(key):
   value = pickle.loads(value % shards)
   return value
 
-def Set(key, value, time=DEFAULT_EXPIRATION_SECONDS):
+def Set(key, value, time=DEFAULT_EXPIRATION_SECONDS, namespace=None):
   """Set a memcache entry."""
   key = MEMCACHE_PREFIX + key
   value = pickle.dumps(value)
@@ -91,19 +91,19 @@ def Set(key, value, time=DEFAULT_EXPIRATION_SECONDS):
     del content_map[key + '0']
 
   # Set the shard map and all content shards.
-  failed_keys = memcache.set_multi(content_map, time=time)
+  failed_keys = memcache.set_multi(content_map, time=time, namespace=namespace)
   if failed_keys:
     logging.error('Sharded cache set_multi failed. Keys: %r', failed_keys)
-    if not memcache.delete_multi(failed_keys):
+    if not memcache.delete_multi(failed_keys, namespace=namespace):
       logging.error('Sharded cache delete_multi failed, Keys: %r', failed_keys)
   return not bool(failed_keys)
 
-def Delete(key, seconds=0):
+def Delete(key, seconds=0, namespace=None):
   """Delete a memcache entry."""
   key = MEMCACHE_PREFIX + key
-  shard_map = memcache.get(key)
+  shard_map = memcache.get(key, namespace=namespace)
   if not shard_map:
     # The shard_map was evicted or never set.
     return memcache.DELETE_ITEM_MISSING
   keys = [key] + ['%s%d' % (key, i) for i in range(shard_map['num_shards'])]
-  return memcache.delete_multi(keys, seconds=seconds)
+  return memcache.delete_multi(keys, seconds=seconds, namespace=namespace)
@@ -957,14 +957,16 @@ def _ReadContentOrBlobs(file_obj):
   if file_ent.content is not None:
     content = file_ent.content
   else:
-    content = files_cache.GetBlob(file_ent.path)
+    # The entity may be from a namespace other than the current one.
+    namespace = file_ent.key().namespace()
+    content = files_cache.GetBlob(file_ent.path, namespace=namespace)
     if content is None:
       blob = file_ent.blob
       if not file_ent.blob:
         # Backwards-compatibility with deprecated "blobs" property:
         blob = blobstore.BlobInfo.get(file_ent.blobs[0])
       content = blob.open().read()
-      files_cache.StoreBlob(file_ent.path, content)
+      files_cache.StoreBlob(file_ent.path, content, namespace=namespace)
   if file_ent.encoding == 'utf-8':
     return content.decode('utf-8')
   return content
@@ -13,7 +13,11 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""A convenience wrapper for internal Titan memcache operations."""
+"""A convenience wrapper for internal Titan memcache operations.
+
+Memcache values are namespaced like the datastore. Functions which take a
+"namespace" argument use the current namespace if it is None.
+"""
 
 import collections
 import logging
@@ -29,11 +33,12 @@ DIR_MEMCACHE_PREFIX = 'titan-dir:'
 # The flag to store in memcache signifying that a file doesn't exist.
 _NO_FILE_FLAG = False
 
-def GetFiles(paths):
+def GetFiles(paths, namespace=None):
   """Given paths, get _File entities (or Nones) if each file state is cached.
 
   Args:
     paths: Absolute filename or iterable of absolute filenames.
+    namespace: The namespace of the files.
   Returns:
     On cache hit: A tuple of (<Entity or list of entities>, True).
     On cache miss: (None, False)
@@ -43,9 +48,9 @@ def GetFiles(paths):
     cache_keys = [FILE_MEMCACHE_PREFIX + path for path in paths]
 
     try:
-      file_ents = memcache.get_multi(cache_keys)
+      file_ents = memcache.get_multi(cache_keys, namespace=namespace)
     except AttributeError:
-      memcache.delete_multi(cache_keys)
+      memcache.delete_multi(cache_keys, namespace=namespace)
       logging.exception('Possibly corrupt memcache values (%r).', cache_keys)
       return None, False
 
@@ -58,9 +63,9 @@ def GetFiles(paths):
   else:
     cache_key = FILE_MEMCACHE_PREFIX + paths
     try:
-      file_ents = memcache.get(cache_key)
+      file_ents = memcache.get(cache_key, namespace=namespace)
     except AttributeError:
-      memcache.delete(cache_key)
+      memcache.delete(cache_key, namespace=namespace)
       logging.exception('Possibly corrupt memcache value (%r).', cache_key)
       return None, False
 
@@ -71,6 +76,41 @@ def GetFiles(paths):
   # non-existent. Return a var to distinguish this from a cache miss.
   return file_ents, True
 
+def GetFilesInNamespaces(namespaced_paths):
+  """Get cached _File entities (or Nones) from any number of namespaces.
+
+  The lookups of all namespaces are made concurrently.
+
+  Args:
+    namespaced_paths: An iterable of (namespace, path) two-tuples.
+  Returns:
+    A dictionary of (namespace, path) to _File entities, or to None if the
+    file is cached as non-existent. Uncached files are not included.
+  """
+  paths_by_namespace = collections.defaultdict(list)
+  for namespace, path in namespaced_paths:
+    paths_by_namespace[namespace].append(path)
+
+  client = memcache.Client()
+  rpcs = []
+  for namespace, paths in paths_by_namespace.iteritems():
+    cache_keys = [FILE_MEMCACHE_PREFIX + path for path in paths]
+    rpcs.append((namespace, cache_keys,
+                 client.get_multi_async(cache_keys, namespace=namespace)))
+
+  file_ents = {}
+  for namespace, cache_keys, rpc in rpcs:
+    try:
+      values = rpc.get_result()
+    except AttributeError:
+      memcache.delete_multi(cache_keys, namespace=namespace)
+      logging.exception('Possibly corrupt memcache values (%r).', cache_keys)
+      continue
+    for cache_key, value in values.iteritems():
+      path = cache_key[len(FILE_MEMCACHE_PREFIX):]
+      file_ents[(namespace, path)] = value or None
+  return file_ents
+
 def StoreFiles(file_ents):
   """Store the given _File entities in memcache."""
   is_multiple = hasattr(file_ents, '__iter__')
@@ -87,12 +127,13 @@ def StoreFiles(file_ents):
     cache_key = FILE_MEMCACHE_PREFIX + file_ents.path
     return memcache.set(cache_key, file_ents)
 
-def StoreAll(data):
+def StoreAll(data, namespace=None):
   """Store either file entities or flag files as non-existent.
 
   Args:
     data: a dictionary with path keys and either _File entity or None values.
         Paths with a None value will be marked as non-existent.
+    namespace: The namespace of the files.
   Returns:
     The result of memcache.set_multi().
   """
@@ -100,7 +141,7 @@ def StoreAll(data):
   for key, value in data.iteritems():
     cache_key = FILE_MEMCACHE_PREFIX + key
     values[cache_key] = value if value else _NO_FILE_FLAG
-  return memcache.set_multi(values)
+  return memcache.set_multi(values, namespace=namespace)
 
 def SetFileDoesNotExist(paths):
   """Set a flag signifying that the given _File entities do not exist."""
@@ -113,15 +154,15 @@ def SetFileDoesNotExist(paths):
     cache_key = FILE_MEMCACHE_PREFIX + paths
     return memcache.set(cache_key, _NO_FILE_FLAG)
 
-def GetBlob(path):
+def GetBlob(path, namespace=None):
   """Get a blob's content from the sharded cache."""
   cache_key = BLOB_MEMCACHE_PREFIX + path
-  return sharded_cache.Get(cache_key)
+  return sharded_cache.Get(cache_key, namespace=namespace)
 
-def StoreBlob(path, content):
+def StoreBlob(path, content, namespace=None):
   """Set a blob's content in the sharded cache."""
   cache_key = BLOB_MEMCACHE_PREFIX + path
-  return sharded_cache.Set(cache_key, content)
+  return sharded_cache.Set(cache_key, content, namespace=namespace)
 
 def ClearBlobsForFiles(file_ents):
   """Delete blobs from the sharded cache."""
@@ -23,14 +23,35 @@ Usage:
   files.Get('/path/to/file.txt')  # True
   time.sleep(61)
   files.Exists('/path/to/file.txt')  # False
+
+  # Expired files are deleted lazily when read, and also by a sweeper, which
+  # should be started from a cron job (for example, hourly):
+  expirations.SweepExpiredFiles()
+
+Indexes:
+  The "expires" meta property is indexed. ListFiles and ListDir check for
+  expired files with a keys-only query, which needs these composite indexes:
+
+  - kind: _File
+    properties:
+    - name: dir_path
+    - name: expires
+  - kind: _File
+    properties:
+    - name: paths
+    - name: expires
 """
 
+import logging
 import time
+from google.appengine.ext import deferred
 from titan import files
 from titan.common import hooks
 
 SERVICE_NAME = 'expirations'
 
+DEFAULT_SWEEP_BATCH_SIZE = 200
+
 def RegisterService():
   """Registers the hooks into the Titan services system."""
   hooks.RegisterHook(SERVICE_NAME, 'file-exists', hook_class=HookForExists)
@@ -46,8 +67,18 @@ class HookForExists(hooks.Hook):
   """Hook for files.Exists that checks for timed expirations."""
 
   def Pre(self, path, **unused_kwargs):
-    """Overrides the default files.Exists method by using files.Get instead."""
-    return hooks.TitanMethodResult(bool(files.Get(path)))
+    self._path = path
+
+  def Post(self, exists):
+    """Returns False if the file exists but has expired."""
+    if not exists:
+      return exists
+    # The core files.Exists call has cached the entity, so this is cheap.
+    file_obj = files.File(self._path)
+    if _IsExpired(file_obj):
+      files.Delete(file_obj, async=True)
+      return False
+    return exists
 
 class HookForWriteAndTouch(hooks.Hook):
   """Hook for files.Write that checks for timed expirations."""
@@ -98,26 +129,99 @@ class HookForGet(hooks.Hook):
 class HookForListFiles(hooks.Hook):
   """Hook for files.ListFiles that checks for timed expirations."""
 
+  def Pre(self, dir_path, recursive=False, **unused_kwargs):
+    self._expired_query = _MakeExpiredQuery(dir_path, recursive=recursive)
+
   def Post(self, file_objs):
-    """Iterates through the result set and removes any expired files."""
-    expired, unexpired = _CheckExpirations(file_objs)
+    """Removes any expired files from the result set."""
+    expired, unexpired = _CheckExpirations(file_objs, self._expired_query)
     files.Delete(expired, async=True)
     return unexpired
 
 class HookForListDir(hooks.Hook):
   """Hook for files.ListDir that checks for timed expirations."""
 
+  def Pre(self, dir_path, **unused_kwargs):
+    self._expired_query = _MakeExpiredQuery(dir_path)
+
   def Post(self, results):
-    """Iterates through the files in the dir and removes any expired files."""
+    """Removes any expired files from the files in the dir."""
     dirs, file_objs = results
-    expired, unexpired = _CheckExpirations(file_objs)
+    expired, unexpired = _CheckExpirations(file_objs, self._expired_query)
     files.Delete(expired, async=True)
     return dirs, unexpired
 
-def _CheckExpirations(file_objs):
-  """Returns a list of expired and unexpired file objs."""
+def SweepExpiredFiles(batch_size=DEFAULT_SWEEP_BATCH_SIZE):
+  """Delete a batch of expired files, then defer a task for the next batch.
+
+  Deleted files drop out of the query, so each batch starts a new query.
+
+  Args:
+    batch_size: The number of files to delete per task.
+  Returns:
+    The number of files deleted in this batch.
+  """
+  file_keys = files._File.all(keys_only=True)
+  file_keys.filter('expires <', time.time())
+  file_keys_batch = file_keys.fetch(batch_size)
+  if not file_keys_batch:
+    return 0
+
+  # Stored paths have already been modified by other services (such as
+  # versions or namespaces), so get and delete the files directly. The query
+  # is eventually consistent, so skip files which were already deleted or
+  # have been rewritten since they expired.
+  paths = [key.name() for key in file_keys_batch]
+  file_objs = files.Get(paths, disabled_services=True).values()
+  expired = [file_obj for file_obj in file_objs if _IsExpired(file_obj)]
+  if expired:
+    files.Delete(expired, disabled_services=True)
+  logging.info('Deleted %d expired files.', len(expired))
+  # If nothing was deleted, leave the rest to the next sweep rather than
+  # re-reading the same stale index rows.
+  if expired and len(file_keys_batch) == batch_size:
+    deferred.defer(SweepExpiredFiles, batch_size=batch_size)
+  return len(expired)
+
+def _MakeExpiredQuery(dir_path, recursive=False):
+  """Make a keys-only query for the expired files in a directory.
+
+  The depth and filters of a ListFiles call are not included: the query only
+  needs to find a superset of the expired files in the results, and other
+  filters would need a composite index for every combination of filters.
+
+  Returns:
+    A query.
+  """
+  dir_path = files.ValidatePaths(dir_path)
+  if dir_path != '/' and dir_path.endswith('/'):
+    dir_path = dir_path[:-1]
+  file_keys = files._File.all(keys_only=True)
+  file_keys.filter('paths =' if recursive else 'dir_path =', dir_path)
+  file_keys.filter('expires <', time.time())
+  return file_keys
+
+def _CheckExpirations(file_objs, expired_query=None):
+  """Returns a list of expired and unexpired file objs.
+
+  Args:
+    file_objs: An iterable of File objects.
+    expired_query: A keys-only query of expired files, from _MakeExpiredQuery.
+        If given, only the file objects which the query matched are loaded.
+  """
   expired = []
   unexpired = []
+  if expired_query is not None:
+    # The query is eventually consistent, so candidates are loaded and
+    # re-checked before being deleted: a file may have been rewritten since.
+    expired_paths = set([key.name() for key in expired_query])
+    for file_obj in file_objs:
+      if file_obj.path in expired_paths and _IsExpired(file_obj):
+        expired.append(file_obj)
+      else:
+        unexpired.append(file_obj)
+    return expired, unexpired
+
   for file_obj in file_objs:
     if _IsExpired(file_obj):
       expired.append(file_obj)
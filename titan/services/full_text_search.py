@@ -13,10 +13,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-"""Service to support full text search in Titan files."""
+"""Service to support full text search in Titan files.
+
+Index updates are buffered in a pull queue which only holds the namespace
+and stored path of each file. A worker, deferred at most once per
+INDEX_WORKER_DELAY_SECONDS, leases the queued paths, coalesces duplicates,
+and indexes the current state of each file in batches of up to
+INDEX_BATCH_SIZE documents. Each file is read and indexed in its own
+namespace. Each worker leases and indexes at most TASKQUEUE_LEASE_MAX_TASKS
+paths, then defers another worker if more updates are queued.
+
+Index backends which are not transactional (such as the trigram index) need
+their updates to be serialized, so workers must not run concurrently. This
+requires a pull queue and a push queue for the workers in queue.yaml:
+
+  - name: titan-full-text-search-updates
+    mode: pull
+  - name: full-text-search
+    max_concurrent_requests: 1
+
+Index backends:
+  By default, files are indexed with the App Engine search API. Another index
+  backend, such as the local trigram index, can be configured with:
+
+    hooks.SetServiceConfig(full_text_search.SERVICE_NAME, {
+        'backend': trigram_index.TrigramIndexBackend(),
+    })
+
+  An index backend must define Put(file_objs), Delete(paths), and
+  Search(query, **kwargs), which returns a list of paths.
+"""
 
 import base64
+import collections
+import json
+import logging
+import time
+from google.appengine.api import namespace_manager
 from google.appengine.api import search
+from google.appengine.api import taskqueue
 from google.appengine.ext import deferred
 from titan.common import hooks
 from titan.files import files
@@ -24,6 +59,18 @@ from titan.files import files
 SERVICE_NAME = 'full-text-search'
 INDEX_NAME = 'titan-' +  SERVICE_NAME
 
+TASKQUEUE_NAME = 'titan-full-text-search-updates'
+TASKQUEUE_LEASE_SECONDS = 300
+
+# The maximum number of documents per search API call.
+INDEX_BATCH_SIZE = 200
+
+# The maximum number of paths indexed by each worker.
+TASKQUEUE_LEASE_MAX_TASKS = INDEX_BATCH_SIZE
+
+# How long updates are buffered before a worker indexes them.
+INDEX_WORKER_DELAY_SECONDS = 10
+
 def RegisterService():
   hooks.RegisterHook(SERVICE_NAME, 'file-write', hook_class=HookForWrite)
   hooks.RegisterHook(SERVICE_NAME, 'file-touch', hook_class=HookForWrite)
@@ -34,13 +81,11 @@ class HookForWrite(hooks.Hook):
   """Hook for files.Write(), files.Touch(), and files.Copy()."""
 
   def Post(self, file_obj):
-    """Create a search document for the file entity."""
-    # TODO(user): Support namespace.
-    doc_id = _GetDocId(file_obj.path)
-    fields = _GetSearchFields(file_obj)
-    doc = search.Document(doc_id=doc_id, fields=fields)
-    index = _GetSearchIndex()
-    deferred.defer(index.add, doc, _queue=SERVICE_NAME)
+    """Queue an index update for the file."""
+    # Other services (such as versions) may return a file whose path is not
+    # where it is stored, so queue the stored path of the entity.
+    file_ent = files._GetFileEntities(file_obj)
+    _QueueIndexUpdates(file_ent.key().namespace(), [file_ent.path])
     return file_obj
 
 class HookForDelete(hooks.Hook):
@@ -49,13 +94,120 @@ class HookForDelete(hooks.Hook):
   def Pre(self, **kwargs):
     """Delete the search document."""
     paths = kwargs['paths']
-    # TODO(user): Support namespace.
     paths = paths if hasattr(paths, '__iter__') else [paths]
-    doc_ids = map(_GetDocId, paths)
-    index = _GetSearchIndex()
-    deferred.defer(index.remove, doc_ids, _queue=SERVICE_NAME)
+    namespace = kwargs.get('namespace') or namespace_manager.get_namespace()
+    _QueueIndexUpdates(namespace, files.ValidatePaths(paths))
     return kwargs
 
+def ProcessIndexUpdates():
+  """Index the current state of a batch of files with queued updates.
+
+  Files which exist are indexed and files which don't are removed from the
+  index, so a path which was updated many times is only indexed once. If the
+  batch was full, another worker is deferred for the rest of the updates.
+
+  Returns:
+    The number of paths which were updated in the index.
+  """
+  queue = taskqueue.Queue(TASKQUEUE_NAME)
+  tasks = queue.lease_tasks(lease_seconds=TASKQUEUE_LEASE_SECONDS,
+                            max_tasks=TASKQUEUE_LEASE_MAX_TASKS)
+  if not tasks:
+    return 0
+  backend = _GetIndexBackend()
+  namespaces_to_paths = collections.defaultdict(set)
+  for task in tasks:
+    namespace, path = _LoadTaskPayload(task.payload)
+    namespaces_to_paths[namespace].add(path)
+  num_paths = 0
+  for namespace, paths in namespaces_to_paths.iteritems():
+    paths = sorted(paths)
+    for i in range(0, len(paths), INDEX_BATCH_SIZE):
+      _UpdateIndex(backend, namespace, paths[i:i + INDEX_BATCH_SIZE])
+    num_paths += len(paths)
+  queue.delete_tasks(tasks)
+  if len(tasks) == TASKQUEUE_LEASE_MAX_TASKS:
+    deferred.defer(ProcessIndexUpdates, _queue=SERVICE_NAME)
+  logging.info('Updated %d paths in the full text search index.', num_paths)
+  return num_paths
+
+def _QueueIndexUpdates(namespace, paths):
+  """Queue index updates for paths, and make sure a worker will run."""
+  tasks = [taskqueue.Task(payload=_DumpTaskPayload(namespace, path),
+                          method='PULL')
+           for path in paths]
+  queue = taskqueue.Queue(TASKQUEUE_NAME)
+  for i in range(0, len(tasks), taskqueue.MAX_TASKS_PER_ADD):
+    queue.add(tasks[i:i + taskqueue.MAX_TASKS_PER_ADD])
+
+  # Defer one worker per interval. Named tasks can only be added once, so
+  # other requests in the same interval don't add more workers.
+  interval = int(time.time() / INDEX_WORKER_DELAY_SECONDS)
+  try:
+    deferred.defer(ProcessIndexUpdates,
+                   _name='%s-worker-%d' % (SERVICE_NAME, interval),
+                   _countdown=INDEX_WORKER_DELAY_SECONDS,
+                   _queue=SERVICE_NAME)
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    pass
+
+class SearchApiBackend(object):
+  """Index backend which uses the App Engine search API."""
+
+  def __init__(self, index_name=INDEX_NAME, namespace=None):
+    self.index_name = index_name
+    self.namespace = namespace
+
+  def Put(self, file_objs):
+    """Index a list of up to 200 File objects."""
+    docs = []
+    for file_obj in file_objs:
+      fields = _GetSearchFields(file_obj)
+      docs.append(search.Document(doc_id=_GetDocId(file_obj.path),
+                                  fields=fields))
+    _GetSearchIndex(self.index_name, self.namespace).put(docs)
+
+  def Delete(self, paths):
+    """Remove a list of up to 200 paths from the index."""
+    doc_ids = [_GetDocId(path) for path in paths]
+    _GetSearchIndex(self.index_name, self.namespace).delete(doc_ids)
+
+  def Search(self, query, index_name=None, namespace=None, **kwargs):
+    """Make a search request and return the file key names (paths)."""
+    results = _SearchRequest(query, index_name or self.index_name,
+                             namespace or self.namespace, **kwargs)
+    return [_KeyFromDocId(x.document.doc_id) for x in results]
+
+def _GetIndexBackend():
+  """Get the configured index backend, or the search API backend."""
+  try:
+    return hooks.GetServiceConfig(SERVICE_NAME)['backend']
+  except hooks.ConfigError:
+    return SearchApiBackend()
+
+def _UpdateIndex(backend, namespace, paths):
+  """Index existing files and remove missing ones, for up to 200 paths."""
+  original_namespace = namespace_manager.get_namespace()
+  namespace_manager.set_namespace(namespace)
+  try:
+    file_objs = files.Get(paths, disabled_services=True)
+    existing_file_objs = [file_objs[p] for p in paths if p in file_objs]
+    removed_paths = [p for p in paths if p not in file_objs]
+    if existing_file_objs:
+      backend.Put(existing_file_objs)
+    if removed_paths:
+      backend.Delete(removed_paths)
+  finally:
+    namespace_manager.set_namespace(original_namespace)
+
+def _DumpTaskPayload(namespace, path):
+  return json.dumps({'namespace': namespace, 'path': path})
+
+def _LoadTaskPayload(payload):
+  """Load a (namespace, path) two-tuple from a queued task payload."""
+  data = json.loads(payload)
+  return data['namespace'], data['path']
+
 def _GetSearchIndex(index_name=INDEX_NAME, namespace=None):
   """Create a search index."""
   return search.Index(name=index_name,
@@ -103,6 +255,5 @@ def _SearchRequest(query, index_name=INDEX_NAME, namespace=None, **kwargs):
 
 def SearchRequest(query, index_name=INDEX_NAME, namespace=None, **kwargs):
   """Make a search request and return the file key names (paths)."""
-  results = _SearchRequest(query, index_name, namespace, **kwargs)
-  documents = [_KeyFromDocId(x.document.doc_id) for x in results]
-  return documents
+  return _GetIndexBackend().Search(query, index_name=index_name,
+                                   namespace=namespace, **kwargs)
@@ -23,6 +23,12 @@ Example:
   # And, to retrieve the manifest of available variants:
   manifest.GetManifest('/foo.html')
 
+Each variant's data is stored in its own entity, in one of NUM_SHARDS entity
+groups per base path, so writes of many variants of one base path can run in
+parallel. GetManifest assembles the variants with one ancestor query per
+shard, which is strongly consistent, and caches the result in memcache;
+variant writes update the cached manifest in place.
+
 Documentation:
   http://code.google.com/p/titan-files/wiki/ManifestService
 """
@@ -31,6 +37,8 @@ try:
   import json
 except ImportError:
   import simplejson as json
+import zlib
+from google.appengine.api import memcache
 from google.appengine.ext import db
 from titan.common import hooks
 from titan.files import files
@@ -38,6 +46,20 @@ from titan.files import files
 SERVICE_NAME = 'manifest'
 DEFAULT_MANIFEST_FILE_EXTENSION = '.manifest'
 
+# The number of entity groups which hold the variants of each base path.
+NUM_SHARDS = 8
+
+MANIFEST_MEMCACHE_PREFIX = 'titan-manifest:'
+MANIFEST_CACHE_SECONDS = 60 * 60
+
+# While a variant is written, the cached manifest is replaced by a lock for
+# this long, so a manifest which was read before the write isn't cached.
+MANIFEST_LOCK_SECONDS = 30
+_MANIFEST_LOCK = 'locked'
+
+# The number of times to retry updating a cached manifest.
+_CAS_RETRIES = 3
+
 class VariantData(object):
   """Encapsulation of data related to a unique file variant."""
 
@@ -56,50 +78,53 @@ class VariantData(object):
     """Optional abstract method for customized validation."""
     pass
 
+class _ManifestVariant(db.Model):
+  """The data of one variant, keyed by the variant path.
+
+  The parent key is the shard of the base path, from _MakeShardKey.
+
+  Attributes:
+    base_path: The base path of the variant, ex: /foo.html
+    data: A JSON-serialized dictionary of variant-specific data.
+  """
+  base_path = db.StringProperty()
+  data = db.TextProperty()
+
 def RegisterService():
   hooks.RegisterHook(SERVICE_NAME, 'file-write', hook_class=HookForWrite)
 
 class HookForWrite(hooks.Hook):
   """Hook for files.Write()."""
 
-  @staticmethod
-  def __UpdateOrCreateManifest(variant_path, manifest_path, data):
-    """Update or create the manifest file.
-
-    Args:
-      variant_path: The path to the variant, ex: /de/foo.html
-      manifest_path: The path to the manfiest, ex: /foo.html.manifest
-      data: The dictionary of variant-specific data.
-    """
-    # Keep this function light--it's run in a transaction.
-    manifest_file = files.Get(manifest_path, disabled_services=[SERVICE_NAME])
-    new_data = {}
-    if manifest_file:
-      new_data.update(json.loads(manifest_file.content))
-    new_data[variant_path] = data
-
-    new_data = json.dumps(new_data)
-    files.Write(manifest_path, new_data, disabled_services=[SERVICE_NAME])
-
   def Pre(self, variant_data=None, **kwargs):
-    """Pre-hook method which updates manifest file.
+    """Pre-hook method which starts the manifest update.
 
     Args:
       variant_data: A VariantData instance.
     """
+    self._rpc = None
     if not variant_data:
       return
-    variant_path = kwargs['path']
-    manifest_path = variant_data.base_path + DEFAULT_MANIFEST_FILE_EXTENSION
     variant_data.Validate()
-    data = variant_data.Serialize()
-
-    # Update the manifest file. This is run in a transaction to avoid race
-    # conditions where a manifest update could lose data when many files are
-    # uploaded concurrently and all affect the same manifest.
-    db.run_in_transaction(
-        self.__UpdateOrCreateManifest,
-        variant_path=variant_path, manifest_path=manifest_path, data=data)
+    self._variant_path = files.ValidatePaths(kwargs['path'])
+    self._base_path = variant_data.base_path
+    self._data = variant_data.Serialize()
+
+    # Variants are separate entities, so the update doesn't need a
+    # transaction and runs while the file itself is written.
+    shard = zlib.crc32(self._variant_path.encode('utf-8')) % NUM_SHARDS
+    variant = _ManifestVariant(key_name=self._variant_path,
+                               parent=_MakeShardKey(self._base_path, shard),
+                               base_path=self._base_path,
+                               data=json.dumps(self._data))
+    self._rpc = db.put_async(variant)
+
+  def Post(self, file_obj):
+    """Post-hook method which waits for the manifest update."""
+    if self._rpc:
+      self._rpc.get_result()
+      _UpdateCachedManifest(self._base_path, self._variant_path, self._data)
+    return file_obj
 
 def GetManifest(base_path):
   """Get the manifest file for a particular resource path.
@@ -109,5 +134,48 @@ def GetManifest(base_path):
   Returns:
     A dictionary containing the manifest data; keys are the variant paths.
   """
+  cache_key = MANIFEST_MEMCACHE_PREFIX + base_path
+  manifest = memcache.get(cache_key)
+  if manifest is not None and manifest != _MANIFEST_LOCK:
+    return manifest or None
+
+  # Start the ancestor queries of all shards before reading any results.
+  variant_queries = [
+      _ManifestVariant.all().ancestor(_MakeShardKey(base_path, shard)).run()
+      for shard in range(NUM_SHARDS)]
+  manifest = {}
+  # Include manifests which were written as files before variants were
+  # stored separately.
   manifest_file = files.Get(base_path + DEFAULT_MANIFEST_FILE_EXTENSION)
-  return json.loads(manifest_file.content) if manifest_file else None
+  if manifest_file:
+    manifest.update(json.loads(manifest_file.content))
+  for variants in variant_queries:
+    for variant in variants:
+      manifest[variant.key().name()] = json.loads(variant.data)
+
+  # Cache empty manifests too, to avoid repeating the queries. If a variant
+  # is being written, the lock is cached and this doesn't replace it.
+  memcache.add(cache_key, manifest, time=MANIFEST_CACHE_SECONDS)
+  return manifest or None
+
+def _MakeShardKey(base_path, shard):
+  return db.Key.from_path('_ManifestShard', '%s:%d' % (base_path, shard))
+
+def _UpdateCachedManifest(base_path, variant_path, data):
+  """Add a variant to a cached manifest, or lock an uncached manifest.
+
+  A GetManifest which ran its queries before the variant was written could
+  otherwise cache a manifest which is missing the variant.
+  """
+  cache_key = MANIFEST_MEMCACHE_PREFIX + base_path
+  client = memcache.Client()
+  for _ in range(_CAS_RETRIES):
+    manifest = client.gets(cache_key)
+    if manifest is None or manifest == _MANIFEST_LOCK:
+      break
+    manifest[variant_path] = data
+    if client.cas(cache_key, manifest, time=MANIFEST_CACHE_SECONDS):
+      return
+  # The manifest isn't cached, or there was too much contention. Let a
+  # GetManifest rebuild it after the lock expires.
+  memcache.set(cache_key, _MANIFEST_LOCK, time=MANIFEST_LOCK_SECONDS)
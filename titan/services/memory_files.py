@@ -15,14 +15,30 @@
 
 """Service to cache specific Titan files in appserver memory.
 
+Lookups can also be batched across calls within a request. GetAsync queues
+paths and returns futures; all queued paths are fetched together, with one
+memcache and at most one datastore RPC, when the first result is needed or
+when the next uncached files.Get happens:
+
+  header = memory_files.GetAsync('/templates/header.html')
+  footers = memory_files.GetAsync(['/templates/a.html', '/templates/b.html'])
+  ...
+  header.get_result()  # Fetches all three files in one batch.
+
+Like the files.Get hook, GetAsync reads files directly, without running
+other services. Cached files are keyed by namespace and path, and a batch
+can include files from many namespaces.
+
 Documentation:
   http://code.google.com/p/titan-files/wiki/MemoryFilesService
 """
 
 import os
+from google.appengine.api import namespace_manager
 from titan.common import datastructures
 from titan.common import hooks
 from titan.files import files
+from titan.services import namespaces
 
 SERVICE_NAME = 'memory-files'
 
@@ -32,6 +48,7 @@ SERVICE_NAME = 'memory-files'
 DEFAULT_MRU_SIZE = 300
 
 _ENVIRON_FILES_STORE_NAME = 'titan-memory-files-store'
+_ENVIRON_BATCHER_NAME = 'titan-memory-files-batcher'
 
 # The "RegisterService" method is required for all Titan service plugins.
 def RegisterService():
@@ -76,8 +93,95 @@ class HookForCopy(hooks.Hook):
     paths = files.ValidatePaths(kwargs['destination_path'])
     _Clear(paths)
 
+class FileFuture(object):
+  """The eventual result of GetAsync() for one path."""
+
+  def __init__(self, batcher, namespaced_path):
+    self._batcher = batcher
+    self._namespaced_path = namespaced_path
+    self._has_result = False
+    self._result = None
+
+  def get_result(self):
+    """Returns the File object, or None if the file doesn't exist."""
+    if not self._has_result:
+      self._result = self._batcher.GetResult(self._namespaced_path)
+      self._has_result = True
+    return self._result
+
+class _RequestBatcher(object):
+  """Collects lookups made within a request and fetches them together."""
+
+  def __init__(self, local_files_store):
+    self._local_files_store = local_files_store
+    self._queued_paths = set()
+
+  def Queue(self, namespaced_paths):
+    """Queue (namespace, path) two-tuples to be fetched with the next batch."""
+    for namespaced_path in namespaced_paths:
+      if namespaced_path not in self._local_files_store:
+        self._queued_paths.add(namespaced_path)
+
+  def Flush(self, namespaced_paths=()):
+    """Fetch the given paths and all queued paths in one batch.
+
+    Args:
+      namespaced_paths: An iterable of (namespace, path) two-tuples which
+          aren't in the request-local store.
+    Returns:
+      A dictionary of all fetched (namespace, path) two-tuples to File objects
+      or None.
+    """
+    paths_set = set(namespaced_paths)
+    for namespaced_path in self._queued_paths:
+      # Skip queued paths which were fetched since they were queued.
+      if namespaced_path not in self._local_files_store:
+        paths_set.add(namespaced_path)
+    self._queued_paths = set()
+    if not paths_set:
+      return {}
+    new_file_objs = namespaces.GetFiles(paths_set)
+    results = dict([(namespaced_path, new_file_objs.get(namespaced_path))
+                    for namespaced_path in paths_set])
+    # Also store Nones, so that non-existent files are not re-fetched.
+    self._local_files_store.update(results)
+    return results
+
+  def GetResult(self, namespaced_path):
+    if namespaced_path in self._local_files_store:
+      return self._local_files_store[namespaced_path]
+    return self.Flush([namespaced_path])[namespaced_path]
+
+def GetAsync(paths, namespace=None):
+  """Queue files to be fetched in a batch with other lookups in the request.
+
+  Args:
+    paths: Absolute filename or iterable of absolute filenames.
+    namespace: The namespace of the files, or None for the current namespace.
+  Returns:
+    A FileFuture if given a single path, or a dictionary of paths to
+    FileFuture objects if given multiple paths.
+  """
+  is_multiple = hasattr(paths, '__iter__')
+  paths = files.ValidatePaths(paths)
+  paths_list = paths if is_multiple else [paths]
+  if namespace is None:
+    namespace = namespace_manager.get_namespace()
+  batcher = _GetRequestBatcher()
+  batcher.Queue([(namespace, path) for path in paths_list])
+  futures = dict([(path, FileFuture(batcher, (namespace, path)))
+                  for path in paths_list])
+  return futures if is_multiple else futures[paths]
+
+def _GetRequestBatcher():
+  """Returns the request-local _RequestBatcher."""
+  if _ENVIRON_BATCHER_NAME not in os.environ:
+    batcher = _RequestBatcher(_GetRequestLocalFilesStore())
+    os.environ[_ENVIRON_BATCHER_NAME] = batcher
+  return os.environ[_ENVIRON_BATCHER_NAME]
+
 def _GetRequestLocalFilesStore():
-  """Returns a request-local MRUDict mapping paths to File objects."""
+  """Returns a request-local MRUDict of (namespace, path) to File objects."""
   # os.environ is replaced by the runtime environment with a request-local
   # object, allowing non-string types to be stored globally in the environment
   # and automatically cleaned up at the end of each request.
@@ -90,16 +194,24 @@ def _Get(paths):
   """Get File objects from paths, and populate the global cache."""
   is_multiple = hasattr(paths, '__iter__')
   local_files_store = _GetRequestLocalFilesStore()
+  namespace = namespace_manager.get_namespace()
 
   paths_set = set(paths if is_multiple else [paths])
-  cached_file_keys = set(local_files_store.keys())
-  cached_paths = list(cached_file_keys & paths_set)
-  uncached_paths = list(paths_set - cached_file_keys)
+  cached_paths = []
+  uncached_paths = []
+  for path in paths_set:
+    if (namespace, path) in local_files_store:
+      cached_paths.append(path)
+    else:
+      uncached_paths.append(path)
 
   if cached_paths and not uncached_paths:
     # All of the requested files are currently in the cache; return this subset.
-    file_objs = dict(
-        (k, local_files_store[k]) for k in cached_paths if local_files_store[k])
+    file_objs = {}
+    for path in cached_paths:
+      value = local_files_store[(namespace, path)]
+      if value:
+        file_objs[path] = value
     return __NormalizeResult(file_objs, is_multiple)
 
   # Merge file objects which existed in the global cache into the result.
@@ -108,29 +220,28 @@ def _Get(paths):
   file_objs = {}
   for path in cached_paths:
     # This affects the MRUDict, so only grab the value once.
-    value = local_files_store[path]
+    value = local_files_store[(namespace, path)]
     if value:  # The cached calue could be None, meaning the file doesn't exist.
       file_objs[path] = value
 
-  new_file_objs = files.Get(uncached_paths, disabled_services=True)
-  local_files_store.update(new_file_objs)
-  file_objs.update(new_file_objs)
-
-  # Also store Nones, so that non-existent files are not re-fetched.
+  # Fetch the uncached paths together with any lookups queued by GetAsync.
+  new_file_objs = _GetRequestBatcher().Flush(
+      [(namespace, path) for path in uncached_paths])
   for path in uncached_paths:
-    if path not in new_file_objs:
-      local_files_store[path] = None
+    if new_file_objs[(namespace, path)]:
+      file_objs[path] = new_file_objs[(namespace, path)]
 
   return __NormalizeResult(file_objs, is_multiple)
 
 def _Clear(paths):
-  """Remove paths from the global cache."""
+  """Remove paths in the current namespace from the global cache."""
   is_multiple = hasattr(paths, '__iter__')
   local_files_store = _GetRequestLocalFilesStore()
+  namespace = namespace_manager.get_namespace()
   paths_list = paths if is_multiple else [paths]
   for path in paths_list:
-    if path in local_files_store:
-      del local_files_store[path]
+    if (namespace, path) in local_files_store:
+      del local_files_store[(namespace, path)]
 
 def __NormalizeResult(file_objs, is_multiple):
   """Handle all result cases including multiple paths and non-existent paths."""
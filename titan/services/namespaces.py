@@ -22,10 +22,18 @@ Usage:
   files.Write('/path/to/file.txt', 'tmp!', namespace='tmp')
   files.Get('/path/to/file.txt', namespace='tmp').content
     => 'tmp!'
+
+  # Get files from many namespaces in one batch, without changing the
+  # current namespace:
+  namespaces.GetFiles([('tmp', '/path/to/file.txt'), ('', '/foo.txt')])
 """
 
+import collections
 from google.appengine.api import namespace_manager
+from google.appengine.ext import db
 from titan.common import hooks
+from titan.files import files
+from titan.files import files_cache
 
 SERVICE_NAME = 'namespaces'
 HOOK_METHODS = (
@@ -65,3 +73,43 @@ class NamespaceHook(hooks.Hook):
   def _RevertNamespace(self):
     if self.namespace:
       namespace_manager.set_namespace(self.original_namespace)
+
+def GetFiles(namespaced_paths):
+  """Get files from any number of namespaces in one batch.
+
+  This reads files directly, without running other services, and does not
+  change the current namespace.
+
+  Args:
+    namespaced_paths: An iterable of (namespace, path) two-tuples. A None
+        namespace is the current namespace.
+  Returns:
+    A dictionary of (namespace, path) two-tuples to loaded File objects.
+    Non-existent files are not included.
+  """
+  current_namespace = namespace_manager.get_namespace()
+  namespaced_paths = [
+      (current_namespace if namespace is None else namespace,
+       files.ValidatePaths(path))
+      for namespace, path in namespaced_paths]
+
+  file_ents = files_cache.GetFilesInNamespaces(namespaced_paths)
+  uncached_paths = [namespaced_path for namespaced_path in namespaced_paths
+                    if namespaced_path not in file_ents]
+  if uncached_paths:
+    # One datastore RPC for all namespaces.
+    keys = [db.Key.from_path(files._File.kind(), path, namespace=namespace)
+            for namespace, path in uncached_paths]
+    data_by_namespace = collections.defaultdict(dict)
+    for namespaced_path, file_ent in zip(uncached_paths, db.get(keys)):
+      file_ents[namespaced_path] = file_ent
+      namespace, path = namespaced_path
+      data_by_namespace[namespace][path] = file_ent
+    for namespace, data in data_by_namespace.iteritems():
+      files_cache.StoreAll(data, namespace=namespace)
+
+  file_objs = {}
+  for namespaced_path, file_ent in file_ents.iteritems():
+    if file_ent:
+      file_objs[namespaced_path] = files.File(file_ent.path, _file_ent=file_ent)
+  return file_objs
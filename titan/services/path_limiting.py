@@ -24,11 +24,23 @@ Documentation:
   http://code.google.com/p/titan-files/wiki/PathLimitingService
 """
 
+import re
+import threading
 from titan.common import hooks
 from titan.files import files
 
 SERVICE_NAME = 'titan-path-limiting'
 
+# The maximum number of paths for which enabled services are memoized.
+MAX_MEMOIZED_PATHS = 10000
+
+# Matches regexes which only match a literal prefix, like "^/foo/" or "/foo.*".
+_LITERAL_PREFIX_REGEX = re.compile(r'^\^?((?:[^.^$*+?{}\[\]\\|()]|\\[^\w])*)'
+                                   r'(?:\.\*)?$')
+
+_matcher_lock = threading.Lock()
+_matcher = None
+
 def RegisterService():
   hooks.RegisterHook(SERVICE_NAME, 'file-exists', hook_class=SinglePathHook)
   hooks.RegisterHook(SERVICE_NAME, 'file-get', hook_class=MultiplePathsHook)
@@ -77,25 +89,86 @@ class DirPathHook(hooks.Hook):
     """Pre-hook method."""
     return _ComposeDisabledServices(kwargs['dir_path'], kwargs)
 
+class _PathMatcher(object):
+  """Compiled services whitelist, for finding the services enabled for a path.
+
+  Regexes which only match a literal prefix are compiled into a prefix trie,
+  so they are all matched in one pass over the path. Other regexes are
+  matched individually. The result for each path is memoized.
+  """
+
+  def __init__(self, services_whitelist):
+    self.services_whitelist = services_whitelist
+    self.service_names = frozenset(services_whitelist)
+    # Each trie node is a two-item list: [child nodes dict, service names].
+    self._trie = [{}, set()]
+    self._regexes = []
+    for service_name, path_regex in services_whitelist.iteritems():
+      literal_match = _LITERAL_PREFIX_REGEX.match(path_regex.pattern)
+      # Flags (like re.IGNORECASE or re.VERBOSE) change what a literal-looking
+      # pattern matches, so only patterns without flags are put in the trie.
+      if literal_match and not path_regex.flags:
+        prefix = re.sub(r'\\(.)', r'\1', literal_match.group(1))
+        node = self._trie
+        for char in prefix:
+          node = node[0].setdefault(char, [{}, set()])
+        node[1].add(service_name)
+      else:
+        self._regexes.append((service_name, path_regex))
+    self._enabled_services = {}
+
+  def GetEnabledServices(self, path):
+    """Returns a frozenset of the services whitelisted for the given path."""
+    enabled_services = self._enabled_services.get(path)
+    if enabled_services is not None:
+      return enabled_services
+
+    enabled_services = set(self._trie[1])
+    node = self._trie
+    for char in path:
+      node = node[0].get(char)
+      if node is None:
+        break
+      enabled_services |= node[1]
+    for service_name, path_regex in self._regexes:
+      if service_name not in enabled_services and path_regex.match(path):
+        enabled_services.add(service_name)
+    enabled_services = frozenset(enabled_services)
+
+    if len(self._enabled_services) >= MAX_MEMOIZED_PATHS:
+      self._enabled_services = {}
+    self._enabled_services[path] = enabled_services
+    return enabled_services
+
+def _GetPathMatcher():
+  """Get the _PathMatcher for the current config, compiling it if needed."""
+  global _matcher
+  path_limits_config = hooks.GetServiceConfig(SERVICE_NAME)
+  services_whitelist = path_limits_config['services_whitelist']
+  matcher = _matcher
+  if matcher is None or matcher.services_whitelist is not services_whitelist:
+    with _matcher_lock:
+      matcher = _matcher
+      if (matcher is None
+          or matcher.services_whitelist is not services_whitelist):
+        matcher = _matcher = _PathMatcher(services_whitelist)
+  return matcher
+
 def _ComposeDisabledServices(paths, original_kwargs):
   """Figure out which services to disable based on the given paths."""
   paths = paths if hasattr(paths, '__iter__') else [paths]
-  paths = files.ValidatePaths(paths)
+  # Support File objects. Paths are validated by the core methods.
+  paths = [path.path if isinstance(path, (files.File, files._File)) else path
+           for path in paths]
   disabled_services = set(original_kwargs.get('disabled_services', []))
 
-  path_limits_config = hooks.GetServiceConfig(SERVICE_NAME)
-  services_whitelist = path_limits_config['services_whitelist']
-
-  for service_name, path_regex in services_whitelist.iteritems():
-    any_paths_match = False
-    for path in paths:
-      if path_regex.match(path):
-        any_paths_match = True
-        break
-    # If any paths matched the whitelist, we leave the service enabled.
-    # Otherwise, if no paths matched, we disable it.
-    if not any_paths_match:
-      disabled_services.add(service_name)
+  # If any paths matched the whitelist, we leave the service enabled.
+  # Otherwise, if no paths matched, we disable it.
+  matcher = _GetPathMatcher()
+  enabled_services = set()
+  for path in paths:
+    enabled_services |= matcher.GetEnabledServices(path)
+  disabled_services |= matcher.service_names - enabled_services
 
   if disabled_services:
     return {'disabled_services': disabled_services}
@@ -22,14 +22,39 @@ Usage:
   permissions = permissions.Permissions(read_users=['bob@example.com'],
                                         write_users=['alice@example.com'])
   files.Write('/some/file.html', 'content', permissions=permissions)
+
+  # Set permissions which are inherited by all files in a directory tree,
+  # unless a file has its own permissions.
+  permissions.SetDirPermissions('/some/dir', permissions)
+
+Directory permissions are cached as compiled ACLs in each instance (for
+ACL_LOCAL_CACHE_SECONDS) and in memcache, so checking them doesn't usually
+need any datastore RPCs. Changes to directory permissions may take up to
+ACL_LOCAL_CACHE_SECONDS to be seen by other instances.
 """
 
+import os
+import time
+from google.appengine.api import memcache
+from google.appengine.api import namespace_manager
 from google.appengine.api import users
+from google.appengine.ext import db
 from titan.common import hooks
 from titan.files import files
 
 SERVICE_NAME = 'permissions'
 
+ACL_MEMCACHE_PREFIX = 'titan-permissions-acl:'
+ACL_MEMCACHE_SECONDS = 10 * 60
+ACL_LOCAL_CACHE_SECONDS = 60
+
+# The value stored in memcache signifying that a directory has no permissions.
+_NO_ACL_FLAG = 0
+
+# Process-local cache of (namespace, dir path) two-tuples to
+# (expiration, _Acl or None) two-tuples.
+_local_dir_acls = {}
+
 class PermissionsError(IOError):
   pass
 
@@ -47,6 +72,39 @@ class Permissions(object):
     self.read_users = set() if read_users is None else set(read_users)
     self.write_users = set() if write_users is None else set(write_users)
 
+class _DirPermissions(db.Model):
+  """Permissions of a directory, keyed by the directory path.
+
+  Attributes:
+    read_users: A list of users who can read files in the directory.
+    write_users: A list of users who can write files in the directory.
+  """
+  read_users = db.StringListProperty()
+  write_users = db.StringListProperty()
+
+class _Acl(object):
+  """A compiled ACL, for checking many files with set lookups."""
+
+  def __init__(self, read_users=None, write_users=None):
+    self.read_users = frozenset(read_users or [])
+    self.write_users = frozenset(write_users or [])
+    if self.read_users and self.write_users:
+      # Users who can write can also read.
+      self.read_users |= self.write_users
+
+  def __nonzero__(self):
+    return bool(self.read_users or self.write_users)
+
+  def NeedsUser(self, read=False, write=False):
+    """Whether checking the given access depends on the user."""
+    return bool(read and self.read_users or write and self.write_users)
+
+  def CanRead(self, user):
+    return not self.read_users or user in self.read_users
+
+  def CanWrite(self, user):
+    return not self.write_users or user in self.write_users
+
 class HookForGet(hooks.Hook):
   """Hook for files.Get()."""
 
@@ -55,7 +113,13 @@ class HookForGet(hooks.Hook):
 
   def Post(self, file_objs):
     """For every File returned, verify that the user has read permissions."""
-    _VerifyPermissions(file_objs, user=self.user, read=True)
+    if file_objs is None:
+      return file_objs
+    if isinstance(file_objs, dict):
+      _VerifyPermissions(file_objs.keys(), file_objs, user=self.user, read=True)
+    else:
+      _VerifyPermissions([file_objs.path], {file_objs.path: file_objs},
+                         user=self.user, read=True)
     return file_objs
 
 class HookForWrite(hooks.Hook):
@@ -63,8 +127,10 @@ class HookForWrite(hooks.Hook):
 
   def Pre(self, user=None, permissions=None, **kwargs):
     """Pre hook for files.Write()."""
+    path = files.ValidatePaths(kwargs['path'])
     file_obj = files.Get(kwargs['path'], disabled_services=[SERVICE_NAME])
-    _VerifyPermissions(file_obj, user, write=True)
+    _VerifyPermissions([path], {path: file_obj} if file_obj else {}, user,
+                       write=True)
 
     # Pass the file entity to the next layer to avoid duplicate RPCs.
     changed_kwargs = {}
@@ -87,7 +153,8 @@ class HookForDelete(hooks.Hook):
     """Pre hook for files.Delete()."""
     paths = files.ValidatePaths(kwargs['paths'])
     file_objs = files.Get(paths, disabled_services=[SERVICE_NAME])
-    _VerifyPermissions(file_objs, user, write=True)
+    _VerifyPermissions(*_GetPathsAndFilesDict(paths, file_objs), user=user,
+                       write=True)
 
     # Pass the file entities to the next layer to avoid duplicate RPCs.
     return {'paths': _FilesDictToList(paths, file_objs)}
@@ -99,11 +166,58 @@ class HookForTouch(hooks.Hook):
     """Pre hook for files.Touch()."""
     paths = files.ValidatePaths(kwargs['paths'])
     file_objs = files.Get(paths, disabled_services=[SERVICE_NAME])
-    _VerifyPermissions(file_objs, user, write=True)
+    _VerifyPermissions(*_GetPathsAndFilesDict(paths, file_objs), user=user,
+                       write=True)
 
     # Pass the file objects to the next layer to avoid duplicate RPCs.
     return {'paths': _FilesDictToList(paths, file_objs)}
 
+def SetDirPermissions(dir_path, permissions):
+  """Set the permissions inherited by all files in a directory tree.
+
+  Files with their own permissions are not affected, and permissions of a
+  subdirectory override those of its parent directories.
+
+  Args:
+    dir_path: Absolute directory path.
+    permissions: A Permissions object, or None to remove the permissions.
+  """
+  dir_path = _NormalizeDirPath(dir_path)
+  if (permissions is None
+      or not (permissions.read_users or permissions.write_users)):
+    db.delete(db.Key.from_path(_DirPermissions.kind(), dir_path))
+    value = _NO_ACL_FLAG
+  else:
+    read_users = list(permissions.read_users)
+    write_users = list(permissions.write_users)
+    _DirPermissions(key_name=dir_path, read_users=read_users,
+                    write_users=write_users).put()
+    value = (read_users, write_users)
+  # Overwrite (rather than delete) the cached value, so that a concurrent
+  # reader of the old permissions can't cache them again; readers only add.
+  memcache.set(ACL_MEMCACHE_PREFIX + dir_path, value, time=ACL_MEMCACHE_SECONDS)
+  _local_dir_acls.pop((namespace_manager.get_namespace(), dir_path), None)
+
+def GetDirPermissions(dir_path):
+  """Get the permissions set on a directory (not including inherited ones).
+
+  Args:
+    dir_path: Absolute directory path.
+  Returns:
+    A Permissions object, or None if the directory has no permissions.
+  """
+  dir_path = _NormalizeDirPath(dir_path)
+  acl = _GetDirAcls([dir_path])[dir_path]
+  if not acl:
+    return None
+  return Permissions(read_users=acl.read_users, write_users=acl.write_users)
+
+def _GetPathsAndFilesDict(paths, file_objs):
+  """Normalize the results of files.Get to a list of paths and a dict."""
+  if hasattr(paths, '__iter__'):
+    return paths, file_objs
+  return [paths], {paths: file_objs} if file_objs else {}
+
 def _FilesDictToList(paths, file_objs):
   """Given paths and a dict of paths to files, make a list of files or None."""
   is_multiple = hasattr(paths, '__iter__')
@@ -112,24 +226,54 @@ def _FilesDictToList(paths, file_objs):
     return [file_objs.get(path, paths[i]) for i, path in enumerate(paths)]
   return file_objs
 
-def _VerifyPermissions(file_objs, user, read=False, write=False):
-  """Check user access over file_objs, verifying ability read and/or write."""
-  if not hasattr(file_objs, '__iter__'):
-    file_objs = [file_objs]
+def _VerifyPermissions(paths, file_objs, user, read=False, write=False):
+  """Check user access over paths, verifying ability read and/or write.
+
+  Each file is checked against its own permissions or, if it has none (or
+  doesn't exist), the permissions of its closest directory which has them.
+
+  Args:
+    paths: A list of absolute filenames.
+    file_objs: A dictionary of paths to File objects, for paths which exist.
+    user: The email of the user, or None for the current user.
+    read: Whether to check read access.
+    write: Whether to check write access.
+  Raises:
+    PermissionsError: If the user doesn't have access to any of the files.
+  """
+  # Compile file ACLs, and find which directory ACLs are needed.
+  acls = {}
+  file_acls = {}
+  dir_paths = set()
+  for path in paths:
+    file_obj = file_objs.get(path)
+    acl = None
+    if file_obj is not None:
+      read_users = getattr(file_obj, 'permissions_read_users', None)
+      write_users = getattr(file_obj, 'permissions_write_users', None)
+      if read_users or write_users:
+        acl_key = (tuple(read_users or []), tuple(write_users or []))
+        if acl_key not in file_acls:
+          file_acls[acl_key] = _Acl(read_users, write_users)
+        acl = file_acls[acl_key]
+    if acl is None:
+      dir_paths.update(_GetParentDirs(path))
+    acls[path] = acl
+  dir_acls = _GetDirAcls(dir_paths) if dir_paths else {}
 
   have_evaluated_user = False
-  for file_obj in file_objs:
-    if file_obj is None:
-      # If a file entity doesn't exist, default permissions are open.
+  for path in paths:
+    acl = acls[path]
+    if acl is None:
+      for dir_path in _GetParentDirs(path):
+        if dir_acls[dir_path]:
+          acl = dir_acls[dir_path]
+          break
+    if acl is None or not acl.NeedsUser(read=read, write=write):
+      # If there are no permissions, default permissions are open.
       continue
 
-    read_users = getattr(file_obj, 'permissions_read_users', None)
-    write_users = getattr(file_obj, 'permissions_write_users', None)
-    if read_users and write_users:
-      read_users = set(read_users).union(set(write_users))
-
-    check_permissions = bool(read and read_users or write and write_users)
-    if not user and not have_evaluated_user and check_permissions:
+    if not user and not have_evaluated_user:
       # We are checking permissions, fetch the current user.
       if users.is_current_user_admin():
         # Allow app-level admins to do anything.
@@ -138,11 +282,81 @@ def _VerifyPermissions(file_objs, user, read=False, write=False):
       user = user and user.email()
       have_evaluated_user = True
 
-    if read and read_users and user not in read_users:
+    if read and not acl.CanRead(user):
       raise PermissionsError(
-          'Permission denied: "%s" to read Titan File "%s".'
-          % (user, file_obj.path))
-    if write and write_users and user not in write_users:
+          'Permission denied: "%s" to read Titan File "%s".' % (user, path))
+    if write and not acl.CanWrite(user):
       raise PermissionsError(
-          'Permission denied: "%s" to write Titan File: "%s".'
-          % (user, file_obj.path))
+          'Permission denied: "%s" to write Titan File: "%s".' % (user, path))
+
+def _GetDirAcls(dir_paths):
+  """Get the compiled ACLs of directories.
+
+  ACLs are read from the process-local cache, then memcache, then the
+  datastore, with at most one batch RPC to each.
+
+  Args:
+    dir_paths: An iterable of normalized directory paths.
+  Returns:
+    A dictionary of dir paths to _Acl objects, or None for directories without
+    permissions.
+  """
+  now = time.time()
+  # Directory permissions (and memcache) are namespaced, so the process-local
+  # cache must be too.
+  namespace = namespace_manager.get_namespace()
+  dir_acls = {}
+  missing_dir_paths = []
+  for dir_path in dir_paths:
+    cached = _local_dir_acls.get((namespace, dir_path))
+    if cached and cached[0] > now:
+      dir_acls[dir_path] = cached[1]
+    else:
+      missing_dir_paths.append(dir_path)
+  if not missing_dir_paths:
+    return dir_acls
+
+  cache_keys = [ACL_MEMCACHE_PREFIX + p for p in missing_dir_paths]
+  cached_values = memcache.get_multi(cache_keys)
+  values = {}
+  uncached_dir_paths = []
+  for dir_path, cache_key in zip(missing_dir_paths, cache_keys):
+    if cache_key in cached_values:
+      values[dir_path] = cached_values[cache_key]
+    else:
+      uncached_dir_paths.append(dir_path)
+
+  if uncached_dir_paths:
+    dir_permissions_ents = _DirPermissions.get_by_key_name(uncached_dir_paths)
+    new_cached_values = {}
+    for dir_path, ent in zip(uncached_dir_paths, dir_permissions_ents):
+      value = (ent.read_users, ent.write_users) if ent else _NO_ACL_FLAG
+      values[dir_path] = value
+      new_cached_values[ACL_MEMCACHE_PREFIX + dir_path] = value
+    # Only add values, so that values set by SetDirPermissions aren't
+    # overwritten by a concurrent read of the old permissions.
+    memcache.add_multi(new_cached_values, time=ACL_MEMCACHE_SECONDS)
+
+  expiration = now + ACL_LOCAL_CACHE_SECONDS
+  for dir_path in missing_dir_paths:
+    value = values[dir_path]
+    acl = None if value == _NO_ACL_FLAG else _Acl(*value)
+    _local_dir_acls[(namespace, dir_path)] = (expiration, acl)
+    dir_acls[dir_path] = acl
+  return dir_acls
+
+def _GetParentDirs(path):
+  """Get the parent directories of a path, from closest to the root."""
+  dir_paths = []
+  dir_path = os.path.dirname(path)
+  while True:
+    dir_paths.append(dir_path)
+    if dir_path == '/':
+      return dir_paths
+    dir_path = os.path.dirname(dir_path)
+
+def _NormalizeDirPath(dir_path):
+  dir_path = files.ValidatePaths(dir_path)
+  if dir_path != '/' and dir_path.endswith('/'):
+    dir_path = dir_path[:-1]
+  return dir_path
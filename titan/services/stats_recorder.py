@@ -15,15 +15,34 @@
 
 """Enable Titan Stats recording of all core file operations.
 
+Counters are aggregated within each request, so a request has one set of
+counters per operation no matter how many calls it makes. Latency can be
+sampled to reduce the cost of timing:
+
+  hooks.SetServiceConfig(stats_recorder.SERVICE_NAME, {
+      'latency_sample_rate': 0.1,  # Time 10% of calls.
+  })
+
+Invocation counts are always exact. Average latencies and percentiles are
+unbiased estimates of the sampled calls; histogram bucket counts only
+include sampled calls.
+
 Documentation:
   http://code.google.com/p/titan-files/wiki/StatsRecorderService
 """
 
+import os
+import random
+import time
 from titan.common import hooks
 from titan.stats import stats
 
 SERVICE_NAME = 'titan-stats-recorder'
 
+DEFAULT_LATENCY_SAMPLE_RATE = 1.0
+
+_ENVIRON_COUNTERS_NAME = 'titan-stats-recorder-counters'
+
 def RegisterService():
   """Method required for all Titan service plugins."""
   hooks.RegisterHook(SERVICE_NAME, 'file-exists', hook_class=StatsHook,
@@ -53,25 +72,65 @@ class StatsHook(hooks.Hook):
   def __init__(self, counter_name, *args, **kwargs):
     super(StatsHook, self).__init__(*args, **kwargs)
     self.counter_name = counter_name
-    self.invocation_counter = stats.Counter(self.counter_name)
-    self.latency_counter = stats.AverageTimingCounter('%s/latency'
-                                                      % self.counter_name)
+    self._start = None
 
   def Pre(self, **kwargs):
-    self.invocation_counter.Increment()
-    self.latency_counter.Start()
+    self._counters = _GetRequestLocalCounters(self.counter_name)
+    self._counters[0].Increment()
+    sample_rate = _GetLatencySampleRate()
+    if sample_rate >= 1 or random.random() < sample_rate:
+      self._start = time.time()
 
   def Post(self, result):
-    self._StopAndStoreCounters()
+    self._StopCounters()
     return result
 
   def OnError(self, unused_error):
-    self._StopAndStoreCounters()
+    self._StopCounters()
 
-  def _StopAndStoreCounters(self):
-    self.latency_counter.Stop()
-    counters = [self.invocation_counter, self.latency_counter]
+  def _StopCounters(self):
+    if self._start is None:
+      # This call's latency isn't sampled.
+      return
+    # Time once and record the same latency in both latency counters.
+    latency = int((time.time() - self._start) * 1000)
+    self._start = None
+    _, latency_counter, latency_histogram_counter = self._counters
+    latency_counter.Offset(latency)
+    latency_histogram_counter.Offset(latency)
+
+def _GetRequestLocalCounters(counter_name):
+  """Get the counters of an operation, shared by all calls in a request.
+
+  Args:
+    counter_name: The name of the operation's invocation counter.
+  Returns:
+    A three-tuple of the invocation, latency, and latency histogram counters.
+  """
+  # os.environ is replaced by the runtime environment with a request-local
+  # object, allowing non-string types to be stored globally in the environment
+  # and automatically cleaned up at the end of each request.
+  if _ENVIRON_COUNTERS_NAME not in os.environ:
+    os.environ[_ENVIRON_COUNTERS_NAME] = {}
+  counters_by_name = os.environ[_ENVIRON_COUNTERS_NAME]
+  counters = counters_by_name.get(counter_name)
+  if counters is None:
+    counters = (
+        stats.Counter(counter_name),
+        stats.AverageTimingCounter('%s/latency' % counter_name),
+        stats.HistogramCounter('%s/latency/histogram' % counter_name),
+    )
+    counters_by_name[counter_name] = counters
+    # Store the counters once; later calls update the same counter objects.
     stats.StoreRequestLocalCounters(counters)
+  return counters
+
+def _GetLatencySampleRate():
+  try:
+    config = hooks.GetServiceConfig(SERVICE_NAME)
+  except hooks.ConfigError:
+    return DEFAULT_LATENCY_SAMPLE_RATE
+  return config.get('latency_sample_rate', DEFAULT_LATENCY_SAMPLE_RATE)
 
 def MakeAllCounters():
   """Make a new list of all counters which can be aggregated and saved."""
@@ -98,5 +157,16 @@ def MakeAllCounters():
       stats.AverageTimingCounter('files/ListFiles/latency'),
       stats.AverageTimingCounter('files/ListDir/latency'),
       stats.AverageTimingCounter('files/DirExists/latency'),
+      # Latency histogram counters.
+      stats.HistogramCounter('files/Exists/latency/histogram'),
+      stats.HistogramCounter('files/Get/latency/histogram'),
+      stats.HistogramCounter('files/Write/latency/histogram'),
+      stats.HistogramCounter('files/Delete/latency/histogram'),
+      stats.HistogramCounter('files/Touch/latency/histogram'),
+      stats.HistogramCounter('files/Copy/latency/histogram'),
+      stats.HistogramCounter('files/CopyDir/latency/histogram'),
+      stats.HistogramCounter('files/ListFiles/latency/histogram'),
+      stats.HistogramCounter('files/ListDir/latency/histogram'),
+      stats.HistogramCounter('files/DirExists/latency/histogram'),
   ]
   return counters
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Trigram index backend for the full text search service.
+
+Unlike the search API, this index supports substring and regex queries over
+code, and works in the dev_appserver and in tests.
+
+Usage:
+  # In appengine_config.py:
+  hooks.SetServiceConfig(full_text_search.SERVICE_NAME, {
+      'backend': trigram_index.TrigramIndexBackend(),
+  })
+
+  full_text_search.SearchRequest('def GetCounterData')
+  full_text_search.SearchRequest(r'Get\w+Data\(', regex=True)
+
+Each (case-insensitive) trigram of a file's path and content has a posting
+list of the paths which contain it. Posting lists are sharded by path and
+split into chunks which fit in an entity, and each file remembers its own
+trigrams, so updating a file only changes the
+posting lists of trigrams which were added or removed.
+
+A query is answered by intersecting the posting lists of the trigrams which
+every match must contain, then verifying and ranking the candidate files by
+the number of matches. Queries must contain a literal of at least three
+characters.
+
+Updates are not transactional, so they must not run concurrently. The full
+text search service only serializes them if its worker queue allows a single
+concurrent request (see the queue.yaml configuration in full_text_search).
+"""
+
+import json
+import logging
+import re
+import zlib
+from google.appengine.api import namespace_manager
+from google.appengine.ext import db
+from titan.files import files
+
+INDEX_NAME = 'titan-trigrams'
+DEFAULT_NUM_SHARDS = 8
+DEFAULT_LIMIT = 20
+
+# The maximum number of candidate files to verify per query.
+MAX_CANDIDATES = 1000
+
+# Matches in a file's path rank higher than matches in its content.
+PATH_MATCH_WEIGHT = 10
+
+_TRIGRAM_LENGTH = 3
+_BATCH_SIZE = 500
+
+# The max size of the uncompressed paths in one posting list chunk, which
+# keeps entities under the 1MB limit even if the paths don't compress.
+_MAX_CHUNK_BYTES = 512 * 1024
+
+class _TrigramPostings(db.Model):
+  """One chunk of the paths which contain a trigram, in one shard of an index.
+
+  The key name of the first chunk is
+  "<index name>:<shard>:<hex of the UTF-8 trigram>", and the key names of
+  further chunks append ":<chunk number>".
+
+  Attributes:
+    paths: Compressed, newline-separated paths.
+    num_chunks: The number of chunks in the posting list; only set on the
+        first chunk.
+  """
+  paths = db.BlobProperty()
+  num_chunks = db.IntegerProperty(default=1, indexed=False)
+
+class _TrigramDocument(db.Model):
+  """The trigrams of one indexed file.
+
+  The key name is "<index name>:<path>".
+
+  Attributes:
+    trigrams: A compressed JSON list of trigrams.
+  """
+  trigrams = db.BlobProperty()
+
+class TrigramIndexBackend(object):
+  """Index backend which stores trigram posting lists in the datastore."""
+
+  def __init__(self, index_name=INDEX_NAME, num_shards=DEFAULT_NUM_SHARDS):
+    """Constructor.
+
+    Args:
+      index_name: The name of the index.
+      num_shards: The number of shards of each posting list. This cannot be
+          changed after files are indexed.
+    """
+    self.index_name = index_name
+    self.num_shards = num_shards
+
+  def Put(self, file_objs):
+    """Index or re-index a list of File objects."""
+    paths = [file_obj.path for file_obj in file_objs]
+    old_docs = _TrigramDocument.get_by_key_name(
+        [self._MakeDocumentKeyName(path) for path in paths])
+    added_paths = {}
+    removed_paths = {}
+    docs = []
+    for file_obj, old_doc in zip(file_objs, old_docs):
+      trigrams = _GetTrigrams(_GetIndexedText(file_obj))
+      old_trigrams = _LoadTrigrams(old_doc)
+      shard = self._GetShard(file_obj.path)
+      for trigram in trigrams - old_trigrams:
+        key_name = self._MakePostingsKeyName(shard, trigram)
+        added_paths.setdefault(key_name, set()).add(file_obj.path)
+      for trigram in old_trigrams - trigrams:
+        key_name = self._MakePostingsKeyName(shard, trigram)
+        removed_paths.setdefault(key_name, set()).add(file_obj.path)
+      docs.append(_TrigramDocument(
+          key_name=self._MakeDocumentKeyName(file_obj.path),
+          trigrams=_DumpTrigrams(trigrams)))
+    self._UpdatePostings(added_paths, removed_paths)
+    for i in range(0, len(docs), _BATCH_SIZE):
+      db.put(docs[i:i + _BATCH_SIZE])
+
+  def Delete(self, paths):
+    """Remove a list of paths from the index."""
+    key_names = [self._MakeDocumentKeyName(path) for path in paths]
+    old_docs = _TrigramDocument.get_by_key_name(key_names)
+    removed_paths = {}
+    for path, old_doc in zip(paths, old_docs):
+      shard = self._GetShard(path)
+      for trigram in _LoadTrigrams(old_doc):
+        key_name = self._MakePostingsKeyName(shard, trigram)
+        removed_paths.setdefault(key_name, set()).add(path)
+    self._UpdatePostings({}, removed_paths)
+    keys = [db.Key.from_path(_TrigramDocument.kind(), key_name)
+            for key_name, old_doc in zip(key_names, old_docs) if old_doc]
+    for i in range(0, len(keys), _BATCH_SIZE):
+      db.delete(keys[i:i + _BATCH_SIZE])
+
+  def Search(self, query, regex=False, case_sensitive=False,
+             limit=DEFAULT_LIMIT, namespace=None, **unused_kwargs):
+    """Search for files containing a substring or matching a regex.
+
+    Args:
+      query: A substring, or a regex if regex is True.
+      regex: Whether the query is a regular expression.
+      case_sensitive: Whether matches are case-sensitive.
+      limit: The maximum number of paths to return.
+      namespace: The namespace of the files to search. Defaults to the
+          current namespace.
+    Raises:
+      ValueError: If the query doesn't contain a literal of at least three
+          characters.
+    Returns:
+      A list of paths, ordered from the most to the fewest matches.
+    """
+    flags = 0 if case_sensitive else re.IGNORECASE
+    if regex:
+      literals = _GetRequiredLiterals(query)
+      pattern = re.compile(query, flags | re.MULTILINE)
+    else:
+      literals = [query]
+      pattern = re.compile(re.escape(query), flags)
+    trigrams = set()
+    for literal in literals:
+      trigrams |= _GetTrigrams(literal)
+    if not trigrams:
+      raise ValueError('Query must contain a literal of at least %d '
+                       'characters: %r' % (_TRIGRAM_LENGTH, query))
+
+    # Files are indexed in their own namespace, like their index entities.
+    original_namespace = namespace_manager.get_namespace()
+    if namespace is not None:
+      namespace_manager.set_namespace(namespace)
+    try:
+      candidate_paths = sorted(self._GetCandidatePaths(trigrams))
+      if len(candidate_paths) > MAX_CANDIDATES:
+        logging.warning('Only verifying %d of %d candidate files for query '
+                        '%r.', MAX_CANDIDATES, len(candidate_paths), query)
+        candidate_paths = candidate_paths[:MAX_CANDIDATES]
+
+      # Verify and rank the candidates, since containing all of the trigrams
+      # doesn't mean that a file matches.
+      results = []
+      for i in range(0, len(candidate_paths), _BATCH_SIZE):
+        file_objs = files.Get(candidate_paths[i:i + _BATCH_SIZE],
+                              disabled_services=True)
+        for path, file_obj in file_objs.iteritems():
+          score = len(pattern.findall(_GetContent(file_obj)))
+          if pattern.search(path):
+            score += PATH_MATCH_WEIGHT
+          if score:
+            results.append((-score, path))
+    finally:
+      namespace_manager.set_namespace(original_namespace)
+    results.sort()
+    return [path for _, path in results[:limit]]
+
+  def _GetCandidatePaths(self, trigrams):
+    """Get the paths which contain all of the given trigrams."""
+    key_names = []
+    for trigram in trigrams:
+      for shard in range(self.num_shards):
+        key_names.append(self._MakePostingsKeyName(shard, trigram))
+    posting_lists = _GetPostingLists(key_names)
+
+    trigram_paths = []
+    for i in range(0, len(posting_lists), self.num_shards):
+      paths = set()
+      for shard_paths, _ in posting_lists[i:i + self.num_shards]:
+        paths |= shard_paths
+      if not paths:
+        return set()
+      trigram_paths.append(paths)
+    # Intersect the smallest posting lists first.
+    trigram_paths.sort(key=len)
+    candidate_paths = trigram_paths[0]
+    for paths in trigram_paths[1:]:
+      candidate_paths &= paths
+    return candidate_paths
+
+  def _UpdatePostings(self, added_paths, removed_paths):
+    """Update posting lists.
+
+    Args:
+      added_paths: A dictionary of posting key names to sets of paths to add.
+      removed_paths: A dictionary of posting key names to sets of paths to
+          remove.
+    """
+    key_names = sorted(set(added_paths) | set(removed_paths))
+    posting_lists = _GetPostingLists(key_names)
+    changed_ents = []
+    deleted_keys = []
+    for key_name, (paths, num_chunks) in zip(key_names, posting_lists):
+      paths |= added_paths.get(key_name, set())
+      paths -= removed_paths.get(key_name, set())
+      chunks = _SplitPaths(paths)
+      for i, chunk_paths in enumerate(chunks):
+        postings_ent = _TrigramPostings(
+            key_name=_MakeChunkKeyName(key_name, i),
+            paths=_DumpPaths(chunk_paths))
+        if not i:
+          postings_ent.num_chunks = len(chunks)
+        changed_ents.append(postings_ent)
+      # Delete chunks which are no longer needed, or the whole posting list.
+      for i in range(len(chunks), num_chunks):
+        deleted_keys.append(db.Key.from_path(
+            _TrigramPostings.kind(), _MakeChunkKeyName(key_name, i)))
+    for i in range(0, len(changed_ents), _BATCH_SIZE):
+      db.put(changed_ents[i:i + _BATCH_SIZE])
+    for i in range(0, len(deleted_keys), _BATCH_SIZE):
+      db.delete(deleted_keys[i:i + _BATCH_SIZE])
+
+  def _GetShard(self, path):
+    return zlib.crc32(path.encode('utf-8')) % self.num_shards
+
+  def _MakePostingsKeyName(self, shard, trigram):
+    return '%s:%d:%s' % (self.index_name, shard,
+                         trigram.encode('utf-8').encode('hex'))
+
+  def _MakeDocumentKeyName(self, path):
+    return '%s:%s' % (self.index_name, path)
+
+def _GetByKeyName(model_class, key_names):
+  """Get entities by key name in batches."""
+  ents = []
+  for i in range(0, len(key_names), _BATCH_SIZE):
+    ents.extend(model_class.get_by_key_name(key_names[i:i + _BATCH_SIZE]))
+  return ents
+
+def _GetPostingLists(key_names):
+  """Get posting lists by the key names of their first chunks.
+
+  Args:
+    key_names: A list of posting list key names.
+  Returns:
+    A list of (set of paths, number of chunks) two-tuples, ordered like
+    key_names. Posting lists which don't exist have no chunks.
+  """
+  first_chunks = _GetByKeyName(_TrigramPostings, key_names)
+  chunk_key_names = []
+  for key_name, first_chunk in zip(key_names, first_chunks):
+    if first_chunk:
+      chunk_key_names.extend([_MakeChunkKeyName(key_name, i)
+                              for i in range(1, first_chunk.num_chunks)])
+  chunks = dict(zip(chunk_key_names,
+                    _GetByKeyName(_TrigramPostings, chunk_key_names)))
+
+  posting_lists = []
+  for key_name, first_chunk in zip(key_names, first_chunks):
+    paths = _LoadPaths(first_chunk)
+    num_chunks = first_chunk.num_chunks if first_chunk else 0
+    for i in range(1, num_chunks):
+      paths |= _LoadPaths(chunks.get(_MakeChunkKeyName(key_name, i)))
+    posting_lists.append((paths, num_chunks))
+  return posting_lists
+
+def _MakeChunkKeyName(key_name, chunk):
+  return '%s:%d' % (key_name, chunk) if chunk else key_name
+
+def _SplitPaths(paths):
+  """Split paths into sorted chunks which each fit in an entity."""
+  chunks = []
+  chunk = []
+  chunk_bytes = 0
+  for path in sorted(paths):
+    path_bytes = len(path.encode('utf-8')) + 1
+    if chunk and chunk_bytes + path_bytes > _MAX_CHUNK_BYTES:
+      chunks.append(chunk)
+      chunk = []
+      chunk_bytes = 0
+    chunk.append(path)
+    chunk_bytes += path_bytes
+  if chunk:
+    chunks.append(chunk)
+  return chunks
+
+def _GetContent(file_obj):
+  """Get the content of a file, unless it is stored in blobstore."""
+  if file_obj.blob:
+    return u''
+  content = file_obj.content
+  if isinstance(content, str):
+    content = content.decode('utf-8', 'replace')
+  return content
+
+def _GetIndexedText(file_obj):
+  return u'%s\n%s' % (file_obj.path, _GetContent(file_obj))
+
+def _GetTrigrams(text):
+  """Get the set of lowercase trigrams in a string."""
+  if isinstance(text, str):
+    text = text.decode('utf-8', 'replace')
+  text = text.lower()
+  return set([text[i:i + _TRIGRAM_LENGTH]
+              for i in range(len(text) - _TRIGRAM_LENGTH + 1)])
+
+def _GetRequiredLiterals(pattern):
+  """Get literal strings which every match of a regex must contain.
+
+  This is conservative: groups and character classes are skipped, and a
+  pattern with a top-level alternation has no required literals.
+
+  Args:
+    pattern: A regular expression string.
+  Returns:
+    A list of literal strings.
+  """
+  literals = []
+  current = []
+  depth = 0
+  i = 0
+
+  def EndLiteral():
+    if current:
+      literals.append(''.join(current))
+      del current[:]
+
+  while i < len(pattern):
+    char = pattern[i]
+    if char == '\\':
+      escaped = pattern[i + 1:i + 2]
+      i += 2
+      if escaped and not escaped.isalnum():
+        if depth == 0:
+          current.append(escaped)
+      else:
+        # Character classes like \w, or backreferences.
+        EndLiteral()
+      continue
+    if char == '[':
+      EndLiteral()
+      # Skip to the end of the character class.
+      i += 1
+      if pattern[i:i + 1] == '^':
+        i += 1
+      if pattern[i:i + 1] == ']':
+        i += 1
+      while i < len(pattern) and pattern[i] != ']':
+        i += 2 if pattern[i] == '\\' else 1
+      i += 1
+      continue
+    if char == '(':
+      EndLiteral()
+      depth += 1
+    elif char == ')':
+      depth -= 1
+    elif char == '|':
+      if depth == 0:
+        return []
+    elif char in '*?{':
+      # The preceding character is optional (or, for {}, may be repeated).
+      if depth == 0 and current:
+        current.pop()
+      EndLiteral()
+      if char == '{':
+        end = pattern.find('}', i)
+        i = len(pattern) if end == -1 else end
+    elif char in '+.^$':
+      EndLiteral()
+    elif depth == 0:
+      current.append(char)
+    i += 1
+  EndLiteral()
+  return literals
+
+def _LoadTrigrams(doc):
+  if not doc or not doc.trigrams:
+    return set()
+  return set(json.loads(zlib.decompress(doc.trigrams)))
+
+def _DumpTrigrams(trigrams):
+  return zlib.compress(json.dumps(sorted(trigrams)))
+
+def _LoadPaths(postings_ent):
+  if not postings_ent or not postings_ent.paths:
+    return set()
+  return set(zlib.decompress(postings_ent.paths).decode('utf-8').split('\n'))
+
+def _DumpPaths(paths):
+  return zlib.compress('\n'.join(sorted(paths)).encode('utf-8'))
@@ -21,9 +21,18 @@ Documentation:
 
 # TODO(user): Add caching of all top-level entities, primarily _Changesets.
 
+import datetime
+import hashlib
+import json
 import logging
 import re
+import time
+import zlib
+from google.appengine.api import memcache
+from google.appengine.ext import blobstore
 from google.appengine.ext import db
+from google.appengine.ext import deferred
+from google.appengine.ext.db import metadata
 import diff_match_patch
 from titan.common import strong_counters
 from titan.common import hooks
@@ -47,6 +56,56 @@ VERSIONS_PATH_FORMAT = '/_titan/ver/%d%s'
 
 _CHANGESET_COUNTER_NAME = 'num_changesets'
 
+# The root paths of each changeset are recorded in this many manifest shards,
+# each in its own entity group, so writes to a changeset don't all contend.
+MANIFEST_SHARDS = 8
+
+# Paths per manifest shard, which keeps each shard well under the 1MB entity
+# limit. Changesets with more paths fall back to an eventually consistent
+# query of their files.
+MAX_MANIFEST_SHARD_PATHS = 1000
+
+DIFF_PENDING = 'pending'
+DIFF_DONE = 'done'
+
+# Memoized diffs are stored as Titan files, for example:
+# "/_titan/diffs/<sha1 of the diff inputs>.json"
+DIFFS_PATH_FORMAT = '/_titan/diffs/%s.json'
+
+# Diffs of files whose combined size exceeds this are computed in a task.
+MAX_INLINE_DIFF_SIZE = 1 << 16  # 64 KiB
+
+# Number of seconds a character-level diff may run before falling back to a
+# line-level diff.
+DIFF_DEADLINE_SECONDS = 30
+
+# A diff still pending after this many seconds is assumed to have failed to
+# compute, and GenerateDiffAsync() defers a new task for it.
+DIFF_PENDING_EXPIRATION_SECONDS = 60 * 60
+
+# Pseudo namespace for memcache values of immutable tree snapshot nodes.
+TREE_NODE_MEMCACHE_PREFIX = 'titan-tree:'
+
+# How many times Commit() will rebuild a tree snapshot which was made stale by
+# a concurrent commit.
+MAX_COMMIT_ATTEMPTS = 5
+
+# Garbage collection of versioned files and orphaned blobs. The queue should
+# be configured with a low rate in queue.yaml to limit foreground impact.
+GC_QUEUE_NAME = 'titan-versions-gc'
+GC_REPORT_PATH_FORMAT = '/_titan/gc/versions-%s.json'
+# The max number of paths and blob keys listed per key in a report.
+GC_REPORT_MAX_ITEMS = 1000
+DEFAULT_GC_BATCH_SIZE = 100
+DEFAULT_GC_BATCH_DELAY_SECONDS = 10
+# Blobs younger than this may still be in the process of being written.
+GC_BLOB_GRACE_DAYS = 1
+
+GC_STAGE_CHANGESETS = 'changesets'
+GC_STAGE_VERSIONS = 'versions'
+GC_STAGE_BLOBS = 'blobs'
+_GC_STAGES = (GC_STAGE_CHANGESETS, GC_STAGE_VERSIONS, GC_STAGE_BLOBS)
+
 class ChangesetError(Exception):
   pass
 
@@ -56,6 +115,12 @@ class FileVersionError(Exception):
 class CommitError(db.TransactionFailedError):
   pass
 
+class TreeSnapshotError(Exception):
+  pass
+
+class _StaleTreeHeadError(Exception):
+  pass
+
 def RegisterService():
   """Method required for all Titan service plugins."""
   hooks.RegisterHook(SERVICE_NAME, 'file-exists', hook_class=HookForExists)
@@ -174,6 +239,7 @@ class HookForWrite(hooks.Hook):
 
     root_path = files.ValidatePaths(kwargs['path'])
     changeset.AssociatePaths(root_path)
+    changeset.AddManifestPaths([root_path])
 
     # Modify where the file is written by prepending the versioned path.
     versioned_path, _ = _MakeVersionedPaths(root_path, changeset)
@@ -186,8 +252,7 @@ class HookForWrite(hooks.Hook):
       changed_kwargs['meta']['status'] = FILE_DELETED
       # This will orphan blobs if a large file is uploaded many times in a
       # changeset without committing, but that's better than losing the data.
-      # TODO(user): add a flag to entities signifying if they have been
-      # copied or deleted, so that we can notice and delete orphaned blobs.
+      # Orphaned blobs are deleted by the GarbageCollector.
       changed_kwargs['_delete_old_blob'] = False
     else:
       # The first time the versioned file is created (or un-deleted), we have
@@ -212,6 +277,8 @@ class HookForTouch(hooks.Hook):
 
     root_paths = files.ValidatePaths(kwargs['paths'])
     changeset.AssociatePaths(root_paths)
+    changeset.AddManifestPaths(
+        root_paths if hasattr(root_paths, '__iter__') else [root_paths])
 
     # Modify where the file is written by prepending the versioned path.
     versioned_paths, _ = _MakeVersionedPaths(root_paths, changeset)
@@ -245,6 +312,8 @@ class HookForDelete(hooks.Hook):
 
     root_paths = files.ValidatePaths(kwargs['paths'])
     changeset.AssociatePaths(root_paths)
+    changeset.AddManifestPaths(
+        root_paths if hasattr(root_paths, '__iter__') else [root_paths])
 
     # Modify where the file is written by prepending the versioned path.
     versioned_paths, _ = _MakeVersionedPaths(root_paths, changeset)
@@ -269,6 +338,14 @@ class HookForListFiles(hooks.Hook):
       # -----
       raise NotImplementedError('Cannot ListFiles with versions service.')
 
+    if (kwargs.get('filters') is None
+        and self.changeset.status == CHANGESET_SUBMITTED
+        and self.changeset.tree_root_hash):
+      # List the files as of a submitted changeset from its tree snapshot.
+      return hooks.TitanMethodResult(_ListSnapshotFiles(
+          self.changeset, kwargs['dir_path'], recursive=kwargs.get('recursive'),
+          depth=kwargs.get('depth')))
+
     # Modify which directory is listed by prepending the versioned path.
     dir_path, _ = _MakeVersionedPaths(kwargs['dir_path'], self.changeset)
     return {'dir_path': dir_path}
@@ -309,6 +386,8 @@ class Changeset(object):
     base_path: The path prefix for all files in this changeset,
         for example: '/_titan/ver/123'
     linked_changeset_base_path: Same as base_path, but for the linked changeset.
+    tree_root_hash: For submitted changesets, the root node hash of the
+        snapshot of all files as of this changeset.
   """
 
   def __init__(self, num, changeset_ent=None):
@@ -316,6 +395,7 @@ class Changeset(object):
     self._num = int(num)
     self._associated_paths = []
     self._finalized_paths = False
+    self._manifest_paths = set()
 
   def __eq__(self, other):
     """Compare equality of two Changeset objects."""
@@ -369,43 +449,82 @@ class Changeset(object):
   def created_by(self):
     return self.changeset_ent.created_by
 
+  @property
+  def tree_root_hash(self):
+    return self.changeset_ent.tree_root_hash
+
   def GetFiles(self):
     """Get all files associated with this changeset.
 
-    Guarantees strong consistency, but requires that associated file paths
-    have been finalized on this specific Changeset instance.
+    Guarantees strong consistency by reading the changeset's manifest of
+    associated paths, or the finalized paths of this specific instance.
 
     Raises:
-      ChangesetError: If associated file paths have not been finalized.
+      ChangesetError: If associated file paths have not been finalized and the
+          changeset has no manifest.
     Returns:
       A dictionary mapping root file paths to VersionedFile objects.
     """
-    if not self._finalized_paths:
-      raise ChangesetError(
-          'Cannot guarantee strong consistency when associated file paths '
-          'have not been finalized. Perhaps you want ListFiles?')
-    return files.Get(self._associated_paths, changeset=self)
+    if self._finalized_paths:
+      paths = self._associated_paths
+    else:
+      paths = self._GetManifestPaths()
+      if paths is None:
+        raise ChangesetError(
+            'Cannot guarantee strong consistency when associated file paths '
+            'have not been finalized. Perhaps you want ListFiles?')
+    if not paths:
+      return {}
+    return files.Get(paths, changeset=self._GetStagingChangeset())
 
   def ListFiles(self):
-    """Perform a query and return VersionedFiles of the changeset file paths.
+    """Return VersionedFiles of the changeset file paths.
 
-    This method is always eventually consistent and may not contain recently
-    changed files.
+    This method is strongly consistent for changesets which have a manifest.
+    Older changesets fall back to a query, which is eventually consistent and
+    may not contain recently changed files.
 
     Returns:
       A dictionary mapping root file paths to VersionedFile objects.
     """
-    changeset = self
-    if self.changeset_ent.status == CHANGESET_SUBMITTED:
-      # The files stored for submitted changesets are actually stored under the
-      # the staging changeset's number, since they are never moved.
-      changeset = self.changeset_ent.linked_changeset
+    paths = self._GetManifestPaths()
+    if paths is not None:
+      if not paths:
+        return {}
+      return files.Get(paths, changeset=self._GetStagingChangeset())
+
     versioned_file_objs = files.ListFiles('/', recursive=True,
-                                          changeset=changeset)
+                                          changeset=self._GetStagingChangeset())
     # Transform into a dictionary that maps non-versioned paths to the
     # VersionedFile objects.
     return dict([(file_obj.path, file_obj) for file_obj in versioned_file_objs])
 
+  def _GetStagingChangeset(self):
+    """Get the changeset under which this changeset's files are stored."""
+    if self.changeset_ent.status == CHANGESET_SUBMITTED:
+      # The files stored for submitted changesets are actually stored under the
+      # the staging changeset's number, since they are never moved.
+      return self.linked_changeset
+    return self
+
+  def _GetManifestPaths(self):
+    """Get the manifest's list of root file paths, or None if no manifest.
+
+    None is also returned if the manifest has overflowed, since it is then
+    incomplete.
+    """
+    staging_changeset = self._GetStagingChangeset()
+    shards = _ChangesetManifest.get_by_key_name(
+        [_ChangesetManifest.MakeKeyName(staging_changeset.num, shard)
+         for shard in range(MANIFEST_SHARDS)])
+    shards = [shard for shard in shards if shard]
+    if not shards or any(shard.overflowed for shard in shards):
+      return None
+    paths = []
+    for shard in shards:
+      paths.extend(shard.paths)
+    return sorted(paths)
+
   def AssociatePaths(self, paths):
     """Associate a path temporally to this changeset object before commit.
 
@@ -422,6 +541,21 @@ class Changeset(object):
       self._associated_paths.append(paths)
     self._finalized_paths = False
 
+  def AddManifestPaths(self, paths):
+    """Record root paths in the changeset's manifest, before they are written.
+
+    Paths are recorded first so that the manifest never misses a written
+    file; a path whose write then fails is skipped when the files are read.
+
+    Args:
+      paths: An iterable of absolute root file paths.
+    """
+    # Skip the RPC for paths which this instance has already recorded.
+    new_paths = set(paths) - self._manifest_paths
+    if new_paths:
+      _ChangesetManifest.AddPaths(self.num, new_paths)
+      self._manifest_paths.update(new_paths)
+
   def FinalizeAssociatedPaths(self):
     """Indicate that this specific Changeset object was used for all operations.
 
@@ -443,6 +577,8 @@ class _Changeset(db.Model):
     status: A string status of the changeset.
     linked_changeset: A reference between staging and finalized changesets.
     created_by: A users.User object of the user who created the changeset.
+    tree_root_hash: For submitted changesets, the root _TreeNode hash of the
+        snapshot of all files as of this changeset.
   """
   num = db.IntegerProperty(required=True)
   created = db.DateTimeProperty(auto_now_add=True)
@@ -453,6 +589,7 @@ class _Changeset(db.Model):
                                       CHANGESET_DELETED_BY_SUBMIT])
   linked_changeset = db.SelfReferenceProperty()
   created_by = db.UserProperty(auto_current_user_add=True)
+  tree_root_hash = db.StringProperty(indexed=False)
 
   def __repr__(self):
     return '<_Changeset %d status:%s>' % (self.num, self.status)
@@ -464,6 +601,64 @@ class _Changeset(db.Model):
     # arbitrary, non-existent "0" changeset.
     return db.Key.from_path('_Changeset', '0')
 
+class _ChangesetManifest(db.Model):
+  """Model listing some of the root file paths of a staging changeset.
+
+  A changeset's paths are split by hash across MANIFEST_SHARDS entities.
+  Each entity is its own entity group, so the manifest can be read by key
+  with strong consistency, and writes of different paths rarely contend.
+
+  Attributes:
+    key().name(): The changeset number and shard, like "123:4".
+    paths: A list of root file paths.
+    overflowed: Whether paths were left out to keep the entity small.
+  """
+  paths = db.StringListProperty(indexed=False)
+  overflowed = db.BooleanProperty(default=False, indexed=False)
+
+  def __repr__(self):
+    return '<_ChangesetManifest %s paths:%d>' % (self.key().name(),
+                                                 len(self.paths))
+
+  @staticmethod
+  def MakeKeyName(changeset_num, shard):
+    return '%d:%d' % (changeset_num, shard)
+
+  @staticmethod
+  def AddPaths(changeset_num, paths):
+    """Transactionally add root file paths to a changeset's manifest."""
+    shards_to_paths = {}
+    for path in paths:
+      shard = zlib.crc32(path.encode('utf-8')) % MANIFEST_SHARDS
+      shards_to_paths.setdefault(shard, set()).add(path)
+    key_names = [_ChangesetManifest.MakeKeyName(changeset_num, shard)
+                 for shard in shards_to_paths]
+
+    def Transaction():
+      manifests = _ChangesetManifest.get_by_key_name(key_names)
+      changed_manifests = []
+      for key_name, shard_paths, manifest in zip(
+          key_names, shards_to_paths.values(), manifests):
+        if not manifest:
+          manifest = _ChangesetManifest(key_name=key_name)
+        if manifest.overflowed:
+          continue
+        new_paths = shard_paths - set(manifest.paths)
+        if not new_paths:
+          continue
+        if len(manifest.paths) + len(new_paths) > MAX_MANIFEST_SHARD_PATHS:
+          manifest.overflowed = True
+        else:
+          manifest.paths.extend(sorted(new_paths))
+        changed_manifests.append(manifest)
+      if changed_manifests:
+        db.put(changed_manifests)
+
+    # One transaction across the shards, which are fewer than the 25 entity
+    # groups allowed in a cross-group transaction.
+    xg_transaction_options = db.create_transaction_options(xg=True)
+    db.run_in_transaction_options(xg_transaction_options, Transaction)
+
 class FileVersion(object):
   """Metadata about a committed file version.
 
@@ -573,6 +768,86 @@ class _FileVersion(db.Model):
   def MakeKeyName(changeset, path):
     return ':'.join([str(changeset.num), path])
 
+class DiffHandle(object):
+  """A pollable reference to a memoized, possibly still pending, diff.
+
+  Usage:
+    handle = vcs.GenerateDiffAsync(file_version_before, file_version_after)
+    ...
+    handle = vcs.GetDiff(handle.key)
+    if handle.done:
+      diffs = handle.GetResult()
+
+  Attributes:
+    key: The string key identifying the diff inputs.
+    done: Whether or not the diff has been computed.
+    is_line_fallback: Whether the diff fell back to a line-level diff because
+        the character-level diff exceeded its deadline.
+    is_expired: Whether the diff is still pending after its task should have
+        finished. GenerateDiffAsync() will defer a new task to compute it.
+  """
+
+  def __init__(self, key, diffs=None, is_line_fallback=False):
+    self._key = key
+    self._diffs = diffs
+    self._is_line_fallback = is_line_fallback
+    self._file_obj = None
+
+  def __repr__(self):
+    return '<DiffHandle %s done: %s>' % (self._key, self.done)
+
+  @property
+  def _diff_file(self):
+    if self._file_obj is None:
+      self._file_obj = files.Get(DIFFS_PATH_FORMAT % self._key,
+                                 disabled_services=True)
+    return self._file_obj
+
+  @property
+  def key(self):
+    return self._key
+
+  @property
+  def status(self):
+    if self._diffs is not None:
+      return DIFF_DONE
+    return self._diff_file.diff_status if self._diff_file else None
+
+  @property
+  def done(self):
+    return self.status == DIFF_DONE
+
+  @property
+  def is_expired(self):
+    if self.status != DIFF_PENDING:
+      return False
+    deferred_time = getattr(self._diff_file, 'diff_deferred_time', 0)
+    return time.time() >= deferred_time + DIFF_PENDING_EXPIRATION_SECONDS
+
+  @property
+  def is_line_fallback(self):
+    if self._diffs is None and self.done:
+      return self._diff_file.diff_is_line_fallback
+    return self._is_line_fallback
+
+  def GetResult(self):
+    """Returns the list of diff two-tuples, or None if not yet computed."""
+    if self._diffs is None and self.done:
+      # Since JSON only represents lists, convert each inner-list back
+      # to a two-tuple.
+      self._diffs = [tuple(d) for d in json.loads(self._diff_file.content)]
+    return self._diffs
+
+  def Serialize(self, full=False):
+    result = {
+        'key': self.key,
+        'status': self.status,
+        'is_line_fallback': self.is_line_fallback,
+    }
+    if full:
+      result['diffs'] = self.GetResult()
+    return result
+
 class _FilePointer(db.Model):
   """Pointer from a root file path to its current file version.
 
@@ -603,6 +878,228 @@ class _FilePointer(db.Model):
     # named '/', since no file path can be a single slash.
     return db.Key.from_path('_FilePointer', '/')
 
+class _TreeHead(db.Model):
+  """Pointer to the tree snapshot of the most recently committed changeset.
+
+  The entity is in the same entity group as all _Changesets, so it is updated
+  atomically with each commit.
+
+  Attributes:
+    changeset_num: The final changeset number of the latest commit.
+    root_hash: The root _TreeNode hash of that changeset's snapshot.
+  """
+  changeset_num = db.IntegerProperty()
+  root_hash = db.StringProperty(indexed=False)
+
+  def __repr__(self):
+    return '<_TreeHead changeset_num:%s root_hash:%s>' % (self.changeset_num,
+                                                          self.root_hash)
+
+  @staticmethod
+  def Get():
+    return _TreeHead.get_by_key_name('head', parent=_Changeset.GetRootKey())
+
+  @staticmethod
+  def Make(changeset_num, root_hash):
+    return _TreeHead(key_name='head', parent=_Changeset.GetRootKey(),
+                     changeset_num=changeset_num, root_hash=root_hash)
+
+class _TreeNode(db.Model):
+  """An immutable, content-addressed directory in a tree snapshot.
+
+  Attributes:
+    key().name(): SHA-1 hex digest of the serialized entries.
+    entries: JSON of the directory's entries, in this format:
+        {
+            'files': {'<file name>': <staging changeset num>, ...},
+            'dirs': {'<subdir name>': '<subdir node hash>', ...},
+        }
+  """
+  entries = db.TextProperty()
+
+class _Tree(object):
+  """Reader and builder of Merkle-style tree snapshots.
+
+  Each directory node is keyed by the hash of its entries, so unchanged
+  subtrees are shared between snapshots, and comparing two snapshots only
+  descends into subtrees whose hashes differ.
+  """
+
+  def __init__(self):
+    self._entries = {}
+    self._new_nodes = {}
+
+  def GetEntries(self, node_hashes):
+    """Batch load the entries of the given nodes.
+
+    Args:
+      node_hashes: An iterable of node hashes.
+    Raises:
+      TreeSnapshotError: If a node does not exist.
+    Returns:
+      A dictionary mapping node hashes to entries dictionaries.
+    """
+    node_hashes = set(node_hashes)
+    missing = [h for h in node_hashes if h not in self._entries]
+    if missing:
+      cached = memcache.get_multi(missing, key_prefix=TREE_NODE_MEMCACHE_PREFIX)
+      self._entries.update(cached)
+      missing = [h for h in missing if h not in cached]
+    if missing:
+      loaded = {}
+      node_ents = _TreeNode.get_by_key_name(missing)
+      for node_hash, node_ent in zip(missing, node_ents):
+        if not node_ent:
+          raise TreeSnapshotError('Tree node %s does not exist.' % node_hash)
+        loaded[node_hash] = json.loads(node_ent.entries)
+      # Nodes are immutable, so they can be cached indefinitely.
+      memcache.set_multi(loaded, key_prefix=TREE_NODE_MEMCACHE_PREFIX)
+      self._entries.update(loaded)
+    return dict([(h, self._entries[h]) for h in node_hashes])
+
+  def ApplyChanges(self, root_hash, changes):
+    """Make a new snapshot from a base snapshot and a set of file changes.
+
+    Args:
+      root_hash: The root node hash of the base snapshot, or None if empty.
+      changes: A dictionary mapping root file paths to the number of the
+          staging changeset holding the file's content, or None if deleted.
+    Returns:
+      The root node hash of the new snapshot. New nodes are not stored until
+      Flush() is called.
+    """
+    # {'/a/b.html': 3} --> {'files': {}, 'dirs': {'a': {'files': {'b.html': 3},
+    #                                                   'dirs': {}}}}
+    nested_changes = _MakeEmptyTreeEntries()
+    for path, changeset_num in changes.iteritems():
+      names = path.split('/')[1:]
+      level = nested_changes
+      for dir_name in names[:-1]:
+        level = level['dirs'].setdefault(dir_name, _MakeEmptyTreeEntries())
+      level['files'][names[-1]] = changeset_num
+    return self._ApplyNestedChanges(root_hash, nested_changes, is_root=True)
+
+  def _ApplyNestedChanges(self, node_hash, changes, is_root=False):
+    entries = _MakeEmptyTreeEntries()
+    if node_hash:
+      old_entries = self.GetEntries([node_hash])[node_hash]
+      entries['files'].update(old_entries['files'])
+      entries['dirs'].update(old_entries['dirs'])
+
+    for name, changeset_num in changes['files'].iteritems():
+      if changeset_num is None:
+        entries['files'].pop(name, None)
+      else:
+        entries['files'][name] = changeset_num
+
+    # Batch load the existing subdirectories which will be changed.
+    self.GetEntries([entries['dirs'][name] for name in changes['dirs']
+                     if name in entries['dirs']])
+    for name, subdir_changes in changes['dirs'].iteritems():
+      subdir_hash = self._ApplyNestedChanges(entries['dirs'].get(name),
+                                             subdir_changes)
+      if subdir_hash is None:
+        entries['dirs'].pop(name, None)
+      else:
+        entries['dirs'][name] = subdir_hash
+
+    if not is_root and not entries['files'] and not entries['dirs']:
+      # Titan doesn't represent empty directories.
+      return None
+    serialized_entries = json.dumps(entries, sort_keys=True,
+                                    separators=(',', ':'))
+    new_node_hash = hashlib.sha1(serialized_entries).hexdigest()
+    self._entries[new_node_hash] = entries
+    self._new_nodes[new_node_hash] = serialized_entries
+    return new_node_hash
+
+  def Flush(self):
+    """Store all nodes made by ApplyChanges()."""
+    if not self._new_nodes:
+      return
+    node_ents = []
+    for node_hash, serialized_entries in self._new_nodes.iteritems():
+      node_ents.append(_TreeNode(key_name=node_hash,
+                                 entries=serialized_entries))
+    db.put(node_ents)
+    memcache.set_multi(
+        dict([(h, self._entries[h]) for h in self._new_nodes]),
+        key_prefix=TREE_NODE_MEMCACHE_PREFIX)
+    self._new_nodes = {}
+
+  def ListFiles(self, root_hash, dir_path, recursive=False, depth=None):
+    """List the files of a directory in a snapshot.
+
+    Args:
+      root_hash: The root node hash of the snapshot.
+      dir_path: Absolute directory path, without a trailing slash.
+      recursive: Whether to list files recursively.
+      depth: If recursive, a positive integer to limit the recursion depth.
+    Returns:
+      A dictionary mapping root file paths to staging changeset numbers.
+    """
+    node_hash = root_hash
+    if dir_path != '/':
+      for dir_name in dir_path.split('/')[1:]:
+        node_hash = self.GetEntries([node_hash])[node_hash]['dirs'].get(
+            dir_name)
+        if node_hash is None:
+          return {}
+
+    # Walk the subtree breadth-first, batch loading each level.
+    result = {}
+    level = {'' if dir_path == '/' else dir_path: node_hash}
+    level_depth = 0
+    while level:
+      level_entries = self.GetEntries(level.values())
+      next_level = {}
+      for level_dir_path, level_node_hash in level.iteritems():
+        entries = level_entries[level_node_hash]
+        for name, changeset_num in entries['files'].iteritems():
+          result['%s/%s' % (level_dir_path, name)] = changeset_num
+        for name, subdir_hash in entries['dirs'].iteritems():
+          next_level['%s/%s' % (level_dir_path, name)] = subdir_hash
+      if not recursive or depth is not None and level_depth >= depth:
+        break
+      level = next_level
+      level_depth += 1
+    return result
+
+  def Diff(self, root_hash_before, root_hash_after):
+    """Compare two snapshots.
+
+    Args:
+      root_hash_before: The root node hash of the older snapshot.
+      root_hash_after: The root node hash of the younger snapshot.
+    Returns:
+      A dictionary mapping each changed root file path to a two-tuple of
+      (<staging changeset num before>, <staging changeset num after>), where
+      None means the file does not exist in that snapshot.
+    """
+    result = {}
+    self._DiffNodes('', root_hash_before, root_hash_after, result)
+    return result
+
+  def _DiffNodes(self, dir_path, node_hash_before, node_hash_after, result):
+    if node_hash_before == node_hash_after:
+      # Identical (or both non-existent) subtrees.
+      return
+    node_entries = self.GetEntries(
+        [h for h in (node_hash_before, node_hash_after) if h])
+    empty_entries = _MakeEmptyTreeEntries()
+    before = node_entries.get(node_hash_before, empty_entries)
+    after = node_entries.get(node_hash_after, empty_entries)
+
+    for name in set(before['files']) | set(after['files']):
+      changeset_num_before = before['files'].get(name)
+      changeset_num_after = after['files'].get(name)
+      if changeset_num_before != changeset_num_after:
+        result['%s/%s' % (dir_path, name)] = (changeset_num_before,
+                                              changeset_num_after)
+    for name in set(before['dirs']) | set(after['dirs']):
+      self._DiffNodes('%s/%s' % (dir_path, name), before['dirs'].get(name),
+                      after['dirs'].get(name), result)
+
 class VersionControlService(object):
   """A service object providing version control methods."""
 
@@ -665,11 +1162,47 @@ class VersionControlService(object):
                       file_version_ent=file_version_ent))
     return file_versions
 
+  def DiffChangesets(self, changeset_before, changeset_after):
+    """Get the file changes between the snapshots of two changesets.
+
+    This runs in time proportional to the changed subtrees, not the whole tree.
+
+    Args:
+      changeset_before: An older, submitted Changeset object.
+      changeset_after: A younger, submitted Changeset object.
+    Raises:
+      TreeSnapshotError: If either changeset has no tree snapshot.
+    Returns:
+      A dictionary mapping changed root file paths to one of FILE_CREATED,
+      FILE_EDITED, or FILE_DELETED.
+    """
+    for changeset in (changeset_before, changeset_after):
+      is_submitted = changeset.status == CHANGESET_SUBMITTED
+      if not is_submitted or not changeset.tree_root_hash:
+        raise TreeSnapshotError('Changeset %d has no tree snapshot.'
+                                % changeset.num)
+    changed_files = _Tree().Diff(changeset_before.tree_root_hash,
+                                 changeset_after.tree_root_hash)
+    result = {}
+    for path, (changeset_num_before, changeset_num_after) in (
+        changed_files.iteritems()):
+      if changeset_num_before is None:
+        result[path] = FILE_CREATED
+      elif changeset_num_after is None:
+        result[path] = FILE_DELETED
+      else:
+        result[path] = FILE_EDITED
+    return result
+
   @staticmethod
   def GenerateDiff(file_version_before, file_version_after,
-                   semantic_cleanup=False, diff_lines=False, edit_cost=None):
+                   semantic_cleanup=False, diff_lines=False, edit_cost=None,
+                   deadline=DIFF_DEADLINE_SECONDS):
     """Generate a diff using the diff_match_patch API.
 
+    Diffs are memoized by their inputs, so regenerating a diff of the same
+    file versions and options will not recompute it.
+
     Args:
       file_version_before: An older FileVersion object.
       file_version_after: A younger FileVersion object.
@@ -678,34 +1211,57 @@ class VersionControlService(object):
       edit_cost: Efficiency cleanup edit cost. The larger the edit cost,
           the more aggressive the cleanup. Sets diff_match_patch.Edit_Cost.
           This should usually not be combined with semantic_cleanup=True.
+      deadline: Number of seconds before a character-level diff falls back
+          to a line-level diff.
     Returns:
       A list of two-tuples, following the diff_match_patch return structure.
       http://code.google.com/p/google-diff-match-patch/wiki/API
     """
-    file_obj_before = files.Get(
-        file_version_before.path,
-        changeset=file_version_before.changeset.linked_changeset)
-    assert file_obj_before
-
-    file_obj_after = files.Get(
-        file_version_after.path,
-        changeset=file_version_after.changeset.linked_changeset)
-    assert file_obj_after
-
-    differ = diff_match_patch.diff_match_patch()
-    before = file_obj_before.content
-    after = file_obj_after.content
-    if diff_lines:
-      diffs = differ.diff_lineMode(before, after, deadline=None)
-    else:
-      # TODO(user): support diff deadline.
-      diffs = differ.diff_main(before, after)
-    if edit_cost is not None:
-      differ.Diff_EditCost = edit_cost
-      differ.diff_cleanupEfficiency(diffs)
-    if semantic_cleanup:
-      differ.diff_cleanupSemantic(diffs)
-    return diffs
+    diff_kwargs = _MakeDiffKwargs(
+        file_version_before, file_version_after,
+        semantic_cleanup=semantic_cleanup, diff_lines=diff_lines,
+        edit_cost=edit_cost, deadline=deadline)
+    handle = DiffHandle(_MakeDiffKey(diff_kwargs))
+    if handle.done:
+      return handle.GetResult()
+    return _ComputeDiff(handle.key, **diff_kwargs).GetResult()
+
+  @staticmethod
+  def GenerateDiffAsync(file_version_before, file_version_after,
+                        semantic_cleanup=False, diff_lines=False,
+                        edit_cost=None, deadline=DIFF_DEADLINE_SECONDS):
+    """Generate a diff, deferring a task to compute it if the files are large.
+
+    Takes the same arguments as GenerateDiff().
+
+    Returns:
+      A DiffHandle object. If the diff is not done, poll for it with GetDiff().
+    """
+    diff_kwargs = _MakeDiffKwargs(
+        file_version_before, file_version_after,
+        semantic_cleanup=semantic_cleanup, diff_lines=diff_lines,
+        edit_cost=edit_cost, deadline=deadline)
+    handle = DiffHandle(_MakeDiffKey(diff_kwargs))
+    if handle.status is not None and not handle.is_expired:
+      # Either memoized, or a task has already been deferred to compute it.
+      return handle
+
+    file_obj_before, file_obj_after = _GetDiffFiles(**diff_kwargs)
+    if file_obj_before.size + file_obj_after.size <= MAX_INLINE_DIFF_SIZE:
+      return _ComputeDiff(handle.key, file_obj_before=file_obj_before,
+                          file_obj_after=file_obj_after, **diff_kwargs)
+
+    files.Write(DIFFS_PATH_FORMAT % handle.key, content='',
+                meta={'diff_status': DIFF_PENDING,
+                      'diff_deferred_time': time.time()},
+                disabled_services=True)
+    deferred.defer(_ComputeDiff, handle.key, _queue=SERVICE_NAME, **diff_kwargs)
+    return DiffHandle(handle.key)
+
+  @staticmethod
+  def GetDiff(key):
+    """Get a DiffHandle for a diff key returned by GenerateDiffAsync()."""
+    return DiffHandle(key)
 
   @staticmethod
   def MakeNiceDualLineDiffs(diffs):
@@ -830,8 +1386,9 @@ class VersionControlService(object):
     Args:
       staged_changeset: A Changeset object with a status of CHANGESET_NEW.
       force: Commit a changeset even if using an eventually-consistent query.
-          This could cause files recently added to the changeset to be missed
-          on commit.
+          This is only needed for changesets created without a manifest, and
+          could cause files recently added to the changeset to be missed on
+          commit.
     Raises:
       CommitError: If a changeset contains no files or it is already committed.
     Returns:
@@ -858,22 +1415,70 @@ class VersionControlService(object):
     final_changeset = self._NewChangeset(
         status=CHANGESET_PRE_SUBMIT, created_by=staged_changeset.created_by)
 
-    xg_transaction_options = db.create_transaction_options(xg=True)
-    db.run_in_transaction_options(
-        xg_transaction_options, self._Commit, staged_changeset,
-        final_changeset, staged_file_objs)
-
-    return final_changeset
+    # Map each path to the changeset holding its content, or None if deleted.
+    tree_changes = {}
+    for path, file_obj in staged_file_objs.iteritems():
+      is_deleted = file_obj.status == FILE_DELETED
+      tree_changes[path] = None if is_deleted else staged_changeset.num
 
-  @staticmethod
-  def _Commit(staged_changeset, final_changeset, staged_file_objs):
-    """Commit a staged changeset."""
     manifest = ['%s: %s' % (f.status, f.path)
                 for f in staged_file_objs.values()]
     logging.info('Submitting changeset %d as changeset %d with %d files:\n%s',
                  staged_changeset.num, final_changeset.num,
                  len(staged_file_objs), '\n'.join(manifest))
 
+    root_file_pointer = _FilePointer.GetRootKey()
+    file_pointer_keys = [db.Key.from_path('_FilePointer', path,
+                                          parent=root_file_pointer)
+                         for path in staged_file_objs]
+
+    xg_transaction_options = db.create_transaction_options(xg=True)
+    for _ in range(MAX_COMMIT_ATTEMPTS):
+      # Everything except the final writes is prepared outside of the
+      # transaction. This is consistent because every commit moves the tree
+      # head, so the transaction aborts if the head has moved since it was
+      # read here, before the _FilePointers were read.
+      #
+      # Tree nodes are immutable and content-addressed, so the new snapshot can
+      # also be built and stored before the transaction. Overlap this with
+      # fetching the current _FilePointers.
+      tree_head = _TreeHead.Get()
+      file_pointers_rpc = db.get_async(file_pointer_keys)
+      tree_root_hash = _MakeTreeSnapshot(tree_head, tree_changes)
+      entities_to_put, file_pointers_to_delete = self._PrepareCommit(
+          staged_changeset, final_changeset, staged_file_objs,
+          file_pointers_rpc.get_result(), tree_root_hash)
+      try:
+        db.run_in_transaction_options(
+            xg_transaction_options, self._Commit, tree_head, entities_to_put,
+            file_pointers_to_delete)
+        break
+      except _StaleTreeHeadError:
+        logging.info('Tree snapshot for changeset %d is stale, retrying.',
+                     final_changeset.num)
+    else:
+      raise CommitError('Too many concurrent commits to submit changeset %d.'
+                        % staged_changeset.num)
+
+    logging.info('Submitted changeset %d as changeset %d.',
+                 staged_changeset.num, final_changeset.num)
+    return final_changeset
+
+  @staticmethod
+  def _PrepareCommit(staged_changeset, final_changeset, staged_file_objs,
+                     file_pointer_ents, tree_root_hash):
+    """Make all of the entity changes for a commit, without any RPCs.
+
+    Args:
+      staged_changeset: The staging Changeset object.
+      final_changeset: The final Changeset object.
+      staged_file_objs: A dictionary of root paths to VersionedFile objects.
+      file_pointer_ents: The current _FilePointers (or None) for each path in
+          staged_file_objs, in the same order.
+      tree_root_hash: The root node hash of the new tree snapshot.
+    Returns:
+      A two-tuple of (<entities to put>, <_FilePointers to delete>).
+    """
     # Update status of the staging and final changesets.
     staged_changeset_ent = staged_changeset.changeset_ent
     staged_changeset_ent.status = CHANGESET_DELETED_BY_SUBMIT
@@ -881,23 +1486,14 @@ class VersionControlService(object):
     final_changeset_ent = final_changeset.changeset_ent
     final_changeset_ent.status = CHANGESET_SUBMITTED
     final_changeset_ent.linked_changeset = staged_changeset.changeset_ent
-    db.put([staged_changeset.changeset_ent, final_changeset.changeset_ent])
+    final_changeset_ent.tree_root_hash = tree_root_hash
+    new_tree_head = _TreeHead.Make(final_changeset.num, tree_root_hash)
+    entities_to_put = [staged_changeset_ent, final_changeset_ent, new_tree_head]
 
-    # Get a mapping of paths to current _FilePointers (or None).
-    file_pointers = {}
     root_file_pointer = _FilePointer.GetRootKey()
-    ordered_paths = staged_file_objs.keys()
-    file_pointer_ents = _FilePointer.get_by_key_name(ordered_paths,
-                                                     parent=root_file_pointer)
-    for i, file_pointer_ent in enumerate(file_pointer_ents):
-      file_pointers[ordered_paths[i]] = file_pointer_ent
-
-    new_file_versions = []
-    updated_file_pointers = []
     deleted_file_pointers = []
-    for path, file_obj in staged_file_objs.iteritems():
-      file_pointer = file_pointers[file_obj.path]
-
+    for file_obj, file_pointer in zip(staged_file_objs.values(),
+                                      file_pointer_ents):
       # Update "edited" status to be "created" on commit if file doesn't exist.
       status = file_obj.status
       if file_obj.status == FILE_EDITED and not file_pointer:
@@ -910,8 +1506,8 @@ class VersionControlService(object):
           changeset_num=final_changeset.num,
           changeset_created_by=final_changeset.created_by,
           status=status,
-          parent=final_changeset.changeset_ent)
-      new_file_versions.append(new_file_version)
+          parent=final_changeset_ent)
+      entities_to_put.append(new_file_version)
 
       # Create or change the _FilePointer for this file.
       if not file_pointer and status != FILE_DELETED:
@@ -929,18 +1525,389 @@ class VersionControlService(object):
         if file_pointer:
           deleted_file_pointers.append(file_pointer)
       else:
-        updated_file_pointers.append(file_pointer)
+        entities_to_put.append(file_pointer)
+    return entities_to_put, deleted_file_pointers
 
-    # For all file changes and updated pointers, do the RPCs.
-    if new_file_versions:
-      db.put(new_file_versions)
-    if updated_file_pointers:
-      db.put(updated_file_pointers)
-    if deleted_file_pointers:
-      db.delete(deleted_file_pointers)
+  @staticmethod
+  def _Commit(tree_head, entities_to_put, file_pointers_to_delete):
+    """Transactionally write a prepared commit; keep this minimal."""
+    current_tree_head = _TreeHead.Get()
+    if (getattr(current_tree_head, 'changeset_num', None)
+        != getattr(tree_head, 'changeset_num', None)):
+      raise _StaleTreeHeadError()
+
+    # Issue all of the writes in parallel.
+    rpcs = [db.put_async(entities_to_put)]
+    if file_pointers_to_delete:
+      rpcs.append(db.delete_async(file_pointers_to_delete))
+    for rpc in rpcs:
+      rpc.get_result()
+
+class GarbageCollector(object):
+  """Batch deletion of orphaned versioned files and unreferenced blobs.
+
+  Runs as a chain of deferred tasks, one batch per task, in three stages:
+    1. Changesets: deletes the files of deleted staging changesets, and
+       optionally of abandoned (uncommitted and expired) ones, which are
+       then marked as deleted.
+    2. Versions: deletes the content of committed file versions which fall
+       outside of the retention policy. The current version of each file and
+       all _FileVersion metadata are always kept.
+    3. Blobs: deletes blobs which are no longer referenced by any file, such
+       as those orphaned by writes with _delete_old_blob=False.
+
+  NOTE: deleting old version content means that GenerateDiff() and snapshot
+  listings will not be able to load the content of those versions.
+
+  Usage (for example, from a cron handler):
+    gc = versions.GarbageCollector(keep_versions=10, keep_days=30,
+                                   dry_run=True)
+    run_id = gc.Start()
+    # Later, inspect the report:
+    versions.GarbageCollector.GetReport(run_id)
+  """
 
-    logging.info('Submitted changeset %d as changeset %d.',
-                 staged_changeset.num, final_changeset.num)
+  def __init__(self, keep_versions=None, keep_days=None,
+               staging_expiration_days=None,
+               batch_size=DEFAULT_GC_BATCH_SIZE,
+               batch_delay_seconds=DEFAULT_GC_BATCH_DELAY_SECONDS,
+               dry_run=False):
+    """Constructor.
+
+    Args:
+      keep_versions: The number of most recent versions to keep per file.
+      keep_days: Keep all versions created within this many days. If both
+          keep_versions and keep_days are given, a version is only deleted if
+          neither policy keeps it. If neither is given, no versions are deleted.
+      staging_expiration_days: The age at which uncommitted staging changesets
+          are considered abandoned and deleted. If not given, uncommitted
+          changesets are never deleted.
+      batch_size: The number of entities to process per task.
+      batch_delay_seconds: The countdown between batch tasks, for throttling.
+      dry_run: Whether to only report what would be deleted.
+    """
+    if keep_versions is not None and keep_versions < 1:
+      raise ValueError('keep_versions must be a positive integer.')
+    self.keep_versions = keep_versions
+    self.keep_days = keep_days
+    self.staging_expiration_days = staging_expiration_days
+    self.batch_size = batch_size
+    self.batch_delay_seconds = batch_delay_seconds
+    self.dry_run = dry_run
+    self.run_id = None
+
+  def Start(self):
+    """Defer the first batch task; returns the run ID of the report."""
+    self.run_id = datetime.datetime.utcnow().strftime('%Y%m%d-%H%M%S-%f')
+    self._UpdateReport({})
+    deferred.defer(_RunGarbageCollectorBatch, self, _GC_STAGES[0],
+                   _queue=GC_QUEUE_NAME)
+    return self.run_id
+
+  @staticmethod
+  def GetReport(run_id):
+    """Get the report dictionary of a run, or None."""
+    report_file = files.Get(GC_REPORT_PATH_FORMAT % run_id,
+                            disabled_services=True)
+    return json.loads(report_file.content) if report_file else None
+
+  def RunBatch(self, stage, cursor=None):
+    """Process one batch of a stage and defer the next batch.
+
+    Args:
+      stage: One of the GC_STAGE_* constants.
+      cursor: The query cursor to continue from, or for the versions stage,
+          the last path processed.
+    Returns:
+      A dictionary of the counts and paths processed in this batch.
+    """
+    stage_methods = {
+        GC_STAGE_CHANGESETS: self._CollectChangesets,
+        GC_STAGE_VERSIONS: self._CollectVersions,
+        GC_STAGE_BLOBS: self._CollectBlobs,
+    }
+    batch_report, next_cursor = stage_methods[stage](cursor)
+    logging.info('Versions GC run %s %s batch (dry run: %s): %r', self.run_id,
+                 stage, self.dry_run, batch_report)
+
+    next_stage = stage
+    if next_cursor is None:
+      # This stage is exhausted, move on to the next one.
+      stage_index = _GC_STAGES.index(stage) + 1
+      next_stage = None
+      if stage_index < len(_GC_STAGES):
+        next_stage = _GC_STAGES[stage_index]
+    batch_report['done'] = next_stage is None
+    self._UpdateReport(batch_report)
+
+    if next_stage:
+      deferred.defer(_RunGarbageCollectorBatch, self, next_stage,
+                     cursor=next_cursor, _countdown=self.batch_delay_seconds,
+                     _queue=GC_QUEUE_NAME)
+    return batch_report
+
+  def _CollectChangesets(self, cursor):
+    """Delete files of abandoned or deleted staging changesets."""
+    report = {'changesets': 0, 'changeset_files': 0, 'paths': []}
+    expiration = None
+    if self.staging_expiration_days is not None:
+      expiration = datetime.datetime.now() - datetime.timedelta(
+          days=self.staging_expiration_days)
+    changeset_ents = _Changeset.all().ancestor(_Changeset.GetRootKey())
+    if cursor:
+      changeset_ents.with_cursor(cursor)
+    batch = changeset_ents.fetch(self.batch_size)
+
+    for changeset_ent in batch:
+      is_abandoned = (expiration is not None
+                      and changeset_ent.status == CHANGESET_NEW
+                      and changeset_ent.created < expiration)
+      if not is_abandoned and changeset_ent.status != CHANGESET_DELETED:
+        continue
+      changeset = Changeset(changeset_ent.num, changeset_ent=changeset_ent)
+      file_objs = files.ListFiles(changeset.base_path, recursive=True,
+                                  disabled_services=True)
+      report['changesets'] += 1
+      report['changeset_files'] += len(file_objs)
+      report['paths'].extend([f.path for f in file_objs])
+      if self.dry_run:
+        continue
+      self._DeleteFiles([f.path for f in file_objs])
+      if changeset_ent.status != CHANGESET_DELETED:
+        changeset_ent.status = CHANGESET_DELETED
+        changeset_ent.put()
+
+    next_cursor = changeset_ents.cursor() if batch else None
+    return report, next_cursor
+
+  def _CollectVersions(self, last_path):
+    """Delete the content of file versions outside of the retention policy.
+
+    Versions are listed in path order, and each batch continues after the
+    last path processed, so that all of a path's versions are checked once.
+    """
+    report = {'version_files': 0, 'paths': []}
+    if self.keep_versions is None and self.keep_days is None:
+      return report, None
+    file_version_keys = _FileVersion.all(keys_only=True).order('path')
+    if last_path is not None:
+      file_version_keys.filter('path >', last_path)
+    batch = file_version_keys.fetch(self.batch_size)
+
+    # Key names are '<changeset num>:<path>'.
+    paths = sorted(set([key.name().split(':', 1)[1] for key in batch]))
+    vcs = VersionControlService()
+    expired_paths = []
+    for path in paths:
+      file_versions = vcs.GetFileVersions(path)
+      for file_version in self._GetExpiredFileVersions(file_versions):
+        expired_paths.append(file_version.versioned_path)
+
+    report['version_files'] = len(expired_paths)
+    report['paths'] = expired_paths
+    if not self.dry_run:
+      self._DeleteFiles(expired_paths)
+    next_last_path = paths[-1] if batch else None
+    return report, next_last_path
+
+  def _GetExpiredFileVersions(self, file_versions):
+    """Given FileVersions ordered from latest to earliest, get expired ones."""
+    expired = []
+    retention_date = None
+    if self.keep_days is not None:
+      retention_date = datetime.datetime.now() - datetime.timedelta(
+          days=self.keep_days)
+    # Always keep the latest version, which is the current file content.
+    for i, file_version in enumerate(file_versions[1:], 1):
+      if self.keep_versions is not None and i < self.keep_versions:
+        continue
+      if retention_date is not None and file_version.created >= retention_date:
+        continue
+      expired.append(file_version)
+    return expired
+
+  def _CollectBlobs(self, cursor):
+    """Delete blobs which are not referenced by any file in any namespace."""
+    report = {'blobs': 0, 'blob_keys': []}
+    grace_date = datetime.datetime.now() - datetime.timedelta(
+        days=GC_BLOB_GRACE_DAYS)
+    blob_infos = blobstore.BlobInfo.all().filter('creation <', grace_date)
+    if cursor:
+      blob_infos.with_cursor(cursor)
+    batch = blob_infos.fetch(self.batch_size)
+
+    # Blob keys are global, but files are namespaced, so a blob is only
+    # orphaned if no file in any namespace references it.
+    namespaces = metadata.get_namespaces() if batch else []
+    orphaned_blob_keys = []
+    for blob_info in batch:
+      blob_key = blob_info.key()
+      if not self._IsBlobReferenced(blob_key, namespaces):
+        orphaned_blob_keys.append(blob_key)
+
+    report['blobs'] = len(orphaned_blob_keys)
+    report['blob_keys'] = [str(key) for key in orphaned_blob_keys]
+    if orphaned_blob_keys and not self.dry_run:
+      blobstore.delete(orphaned_blob_keys)
+    next_cursor = blob_infos.cursor() if batch else None
+    return report, next_cursor
+
+  @staticmethod
+  def _IsBlobReferenced(blob_key, namespaces):
+    for namespace in namespaces:
+      # Check both the "blob" property and the deprecated "blobs" property.
+      for property_name in ('blob', 'blobs'):
+        file_keys = db.Query(files._File, keys_only=True, namespace=namespace)
+        file_keys.filter('%s =' % property_name, blob_key)
+        if file_keys.fetch(1):
+          return True
+    return False
+
+  @staticmethod
+  def _DeleteFiles(paths):
+    """Delete whichever of the given files still exist, leaving their blobs."""
+    if not paths:
+      return
+    existing_file_objs = files.Get(paths, disabled_services=True)
+    if existing_file_objs:
+      # Blobs may be shared with other file versions by files.Copy(), so they
+      # are left for the blobs stage to collect once unreferenced.
+      files.Delete(existing_file_objs.values(), _delete_old_blobs=False,
+                   disabled_services=True)
+
+  def _UpdateReport(self, batch_report):
+    """Merge a batch's counts and paths into the run's report file."""
+    report = self.GetReport(self.run_id) or {
+        'run_id': self.run_id,
+        'dry_run': self.dry_run,
+        'keep_versions': self.keep_versions,
+        'keep_days': self.keep_days,
+        'done': False,
+    }
+    for key, value in batch_report.iteritems():
+      if isinstance(value, list):
+        report[key] = (report.get(key, []) + value)[:GC_REPORT_MAX_ITEMS]
+      elif isinstance(value, bool):
+        report[key] = value
+      else:
+        report[key] = report.get(key, 0) + value
+    files.Write(GC_REPORT_PATH_FORMAT % self.run_id, content=json.dumps(report),
+                disabled_services=True)
+
+def _RunGarbageCollectorBatch(garbage_collector, stage, cursor=None):
+  """Deferred task wrapper for GarbageCollector.RunBatch()."""
+  return garbage_collector.RunBatch(stage, cursor=cursor)
+
+def _MakeEmptyTreeEntries():
+  return {'files': {}, 'dirs': {}}
+
+def _MakeTreeSnapshot(tree_head, tree_changes):
+  """Build and store a tree snapshot; returns the new root node hash."""
+  tree = _Tree()
+  if tree_head:
+    base_root_hash = tree_head.root_hash
+  else:
+    # No snapshots exist yet, so bootstrap from all current file pointers.
+    file_pointers = _FilePointer.all().ancestor(_FilePointer.GetRootKey())
+    current_files = dict([(fp.key().name(), fp.changeset_num)
+                          for fp in file_pointers])
+    base_root_hash = tree.ApplyChanges(None, current_files)
+  root_hash = tree.ApplyChanges(base_root_hash, tree_changes)
+  tree.Flush()
+  return root_hash
+
+def _ListSnapshotFiles(changeset, dir_path, recursive=False, depth=None):
+  """List VersionedFiles of a directory from a changeset's tree snapshot."""
+  if depth is not None and depth <= 0:
+    raise ValueError('depth argument must be a positive integer.')
+  dir_path = files.ValidatePaths(dir_path)
+  # Strip trailing slash.
+  if dir_path != '/' and dir_path.endswith('/'):
+    dir_path = dir_path[:-1]
+  snapshot_files = _Tree().ListFiles(changeset.tree_root_hash, dir_path,
+                                     recursive=recursive, depth=depth)
+  file_objs = []
+  for path, changeset_num in sorted(snapshot_files.iteritems()):
+    versioned_path = VERSIONS_PATH_FORMAT % (changeset_num, path)
+    file_objs.append(VersionedFile(files.File(versioned_path)))
+  return file_objs
+
+def _MakeDiffKwargs(file_version_before, file_version_after, **options):
+  """Make the serializable arguments which uniquely identify a diff."""
+  # File contents are stored under the staging changeset's number.
+  diff_kwargs = {
+      'path_before': file_version_before.path,
+      'changeset_num_before':
+          file_version_before.changeset.linked_changeset_num,
+      'path_after': file_version_after.path,
+      'changeset_num_after': file_version_after.changeset.linked_changeset_num,
+  }
+  diff_kwargs.update(options)
+  return diff_kwargs
+
+def _MakeDiffKey(diff_kwargs):
+  """Make a fixed-length key from the diff arguments."""
+  return hashlib.sha1(json.dumps(diff_kwargs, sort_keys=True)).hexdigest()
+
+def _GetDiffFiles(path_before, changeset_num_before, path_after,
+                  changeset_num_after, **unused_options):
+  """Get the two VersionedFile objects to be diffed."""
+  file_obj_before = files.Get(
+      path_before, changeset=Changeset(changeset_num_before))
+  assert file_obj_before
+  file_obj_after = files.Get(
+      path_after, changeset=Changeset(changeset_num_after))
+  assert file_obj_after
+  return file_obj_before, file_obj_after
+
+def _ComputeDiff(key, semantic_cleanup, diff_lines, edit_cost, deadline,
+                 file_obj_before=None, file_obj_after=None, **diff_kwargs):
+  """Compute and memoize a diff; also used as a deferred task.
+
+  Args:
+    key: The diff key from _MakeDiffKey().
+    semantic_cleanup: See GenerateDiff().
+    diff_lines: See GenerateDiff().
+    edit_cost: See GenerateDiff().
+    deadline: See GenerateDiff().
+    file_obj_before: Optional pre-loaded file, to avoid duplicate RPCs.
+    file_obj_after: Optional pre-loaded file, to avoid duplicate RPCs.
+    **diff_kwargs: The file paths and changeset numbers of the files to diff.
+  Returns:
+    A completed DiffHandle object.
+  """
+  if not file_obj_before or not file_obj_after:
+    file_obj_before, file_obj_after = _GetDiffFiles(**diff_kwargs)
+
+  differ = diff_match_patch.diff_match_patch()
+  before = file_obj_before.content
+  after = file_obj_after.content
+  is_line_fallback = False
+  if diff_lines:
+    diffs = differ.diff_lineMode(before, after, deadline=None)
+  else:
+    end_time = time.time() + deadline
+    diffs = differ.diff_main(before, after, deadline=end_time)
+    if time.time() >= end_time:
+      # The character-level diff ran out of time and is likely far from
+      # minimal, so produce a (much cheaper) line-level diff instead.
+      logging.warning('Diff %s exceeded %ss deadline, falling back to a '
+                      'line-level diff.', key, deadline)
+      diffs = differ.diff_lineMode(before, after, deadline=None)
+      is_line_fallback = True
+  if edit_cost is not None:
+    differ.Diff_EditCost = edit_cost
+    differ.diff_cleanupEfficiency(diffs)
+  if semantic_cleanup:
+    differ.diff_cleanupSemantic(diffs)
+
+  meta = {
+      'diff_status': DIFF_DONE,
+      'diff_is_line_fallback': is_line_fallback,
+  }
+  files.Write(DIFFS_PATH_FORMAT % key, content=json.dumps(diffs), meta=meta,
+              disabled_services=True)
+  return DiffHandle(key, diffs=diffs, is_line_fallback=is_line_fallback)
 
 def _MakeVersionedPaths(paths, changeset):
   """Return a two-tuple of (versioned paths, is_multiple)."""
@@ -0,0 +1,299 @@
+#!/usr/bin/env python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Streaming alerts, evaluated on counter data as windows are aggregated.
+
+Usage:
+  all_alerts = [
+      # Fire when the average latency of any window is over 500ms.
+      alerts.ThresholdAlert('slow-gets', 'files/Get/latency', max_value=500),
+      # Fire when there are more than 1000 writes within 6 windows (1 minute).
+      alerts.RateAlert('write-spike', 'files/Write', num_windows=6,
+                       max_total=1000),
+      # Fire when a window is more than 4 standard deviations from the
+      # exponentially-weighted moving average.
+      alerts.AnomalyAlert('get-anomaly', 'files/Get', num_deviations=4),
+  ]
+  aggregator = stats.Aggregator(all_counters, alerts=all_alerts)
+
+A window can be aggregated in several parts, by concurrent aggregators, so
+alerts are only evaluated on complete windows: once a window is old enough
+that all of its parts have been stored, its parts are merged and evaluated.
+Each window is claimed by one aggregator, so it is evaluated once.
+
+Each alert keeps a small rolling state (a moving average, or a ring buffer of
+recent windows), which is stored in memcache between aggregator runs, so no
+historical data is read. If the state is evicted, it is rebuilt from new
+windows. Alert events are logged and written to Titan Files, like:
+  /_titan/stats/alerts/2015/5/15/slow-gets/1431648000.json
+"""
+
+import collections
+import datetime
+import json
+import logging
+import math
+import os
+from google.appengine.api import memcache
+from titan import files
+
+BASE_DIR = '/_titan/stats/alerts'
+STATE_MEMCACHE_PREFIX = 'titan-stats-alert:'
+STATE_CACHE_SECONDS = 7 * 24 * 60 * 60
+
+# The last window which has been claimed for evaluation.
+EVALUATED_THROUGH_MEMCACHE_KEY = 'titan-stats-alerts-evaluated-through'
+
+class AbstractAlert(object):
+  """Base class for all alerts."""
+
+  def __init__(self, name, counter_name):
+    """Constructor.
+
+    Args:
+      name: A unique name for the alert.
+      counter_name: The name (or key) of the counter to evaluate.
+    """
+    if '/' in name:
+      raise ValueError('"/" is not allowed in alert name: %s' % name)
+    self.name = name
+    self.counter_name = counter_name
+
+  def __repr__(self):
+    return '<%s %s %s>' % (self.__class__.__name__, self.name,
+                           self.counter_name)
+
+  def Evaluate(self, state, window, value, window_size):
+    """Abstract method, must update state and check a window's value.
+
+    Args:
+      state: A mutable dictionary of the alert's state, which is empty the
+          first time (or if the state was lost).
+      window: The window.
+      value: A number, the value of the counter for the window.
+      window_size: The number of seconds per window.
+    Returns:
+      A message if the alert fires for the window, otherwise None.
+    """
+    raise NotImplementedError('Subclasses should implement abstract method.')
+
+class ThresholdAlert(AbstractAlert):
+  """Fires when the value of a window is outside of a range."""
+
+  def __init__(self, name, counter_name, min_value=None, max_value=None):
+    super(ThresholdAlert, self).__init__(name, counter_name)
+    if min_value is None and max_value is None:
+      raise ValueError('min_value or max_value is required.')
+    self.min_value = min_value
+    self.max_value = max_value
+
+  def Evaluate(self, state, window, value, window_size):
+    if self.min_value is not None and value < self.min_value:
+      return '%s is %s, below the min of %s.' % (
+          self.counter_name, value, self.min_value)
+    if self.max_value is not None and value > self.max_value:
+      return '%s is %s, above the max of %s.' % (
+          self.counter_name, value, self.max_value)
+
+class RateAlert(AbstractAlert):
+  """Fires when the total of the last num_windows windows is over max_total.
+
+  Recent values are kept in a fixed-size ring buffer. Windows with no data
+  count as zero.
+  """
+
+  def __init__(self, name, counter_name, num_windows, max_total):
+    super(RateAlert, self).__init__(name, counter_name)
+    self.num_windows = num_windows
+    self.max_total = max_total
+
+  def Evaluate(self, state, window, value, window_size):
+    recent = collections.deque(state.get('recent', []),
+                               maxlen=self.num_windows)
+    recent.append((window, value))
+    state['recent'] = list(recent)
+    min_window = window - self.num_windows * window_size
+    total = sum([v for w, v in recent if w > min_window])
+    if total > self.max_total:
+      return '%s totaled %s over %d windows, above the max of %s.' % (
+          self.counter_name, total, self.num_windows, self.max_total)
+
+class AnomalyAlert(AbstractAlert):
+  """Fires when a value deviates from the exponentially-weighted moving average.
+
+  The moving average and variance are updated with every window, so the alert
+  adapts to gradual changes but fires on sudden ones.
+  """
+
+  def __init__(self, name, counter_name, alpha=0.1, num_deviations=3.0,
+               min_windows=30):
+    """Constructor.
+
+    Args:
+      name: A unique name for the alert.
+      counter_name: The name (or key) of the counter to evaluate.
+      alpha: The weight of each new window in the moving average.
+      num_deviations: Fire when a value is more than this many standard
+          deviations away from the moving average.
+      min_windows: The number of windows to learn from before firing.
+    """
+    super(AnomalyAlert, self).__init__(name, counter_name)
+    self.alpha = alpha
+    self.num_deviations = num_deviations
+    self.min_windows = min_windows
+
+  def Evaluate(self, state, window, value, window_size):
+    count = state.get('count', 0)
+    mean = state.get('mean', float(value))
+    variance = state.get('variance', 0.0)
+
+    message = None
+    deviation = math.sqrt(variance)
+    if (count >= self.min_windows and deviation
+        and abs(value - mean) > self.num_deviations * deviation):
+      message = ('%s is %s, %.1f standard deviations from the average of %.2f.'
+                 % (self.counter_name, value, abs(value - mean) / deviation,
+                    mean))
+
+    # Incremental exponentially-weighted mean and variance.
+    diff = value - mean
+    increment = self.alpha * diff
+    state['mean'] = mean + increment
+    state['variance'] = (1 - self.alpha) * (variance + diff * increment)
+    state['count'] = count + 1
+    return message
+
+class AlertEvaluator(object):
+  """Evaluates alerts on aggregate data, as windows are aggregated."""
+
+  def __init__(self, alerts, window_size):
+    self.alerts = alerts
+    self.window_size = window_size
+    self._counter_names_to_alerts = collections.defaultdict(list)
+    for alert in alerts:
+      self._counter_names_to_alerts[alert.counter_name].append(alert)
+    self.counter_names = set(self._counter_names_to_alerts)
+
+  def ClaimWindows(self, complete_through):
+    """Claim the complete windows which have not yet been evaluated.
+
+    Each window is only claimed once, even by concurrent aggregators.
+
+    Args:
+      complete_through: The last window which is complete.
+    Returns:
+      The window after which the claimed windows start, or None if no windows
+      were claimed. The claimed windows end with complete_through.
+    """
+    if not self.alerts:
+      return None
+    client = memcache.Client()
+    evaluated_through = client.gets(EVALUATED_THROUGH_MEMCACHE_KEY)
+    if evaluated_through is None:
+      # Start with the last complete window.
+      if client.add(EVALUATED_THROUGH_MEMCACHE_KEY, complete_through,
+                    time=STATE_CACHE_SECONDS):
+        return complete_through - self.window_size
+      return None
+    if evaluated_through >= complete_through:
+      return None
+    if client.cas(EVALUATED_THROUGH_MEMCACHE_KEY, complete_through,
+                  time=STATE_CACHE_SECONDS):
+      return evaluated_through
+    return None
+
+  def Evaluate(self, aggregate_results):
+    """Evaluate alerts on aggregate data, and record any alert events.
+
+    Args:
+      aggregate_results: A list of dictionaries containing "window" and
+          "counters", of complete windows from ClaimWindows().
+    Returns:
+      A list of alert event dictionaries.
+    """
+    if not self.alerts or not aggregate_results:
+      return []
+    state_keys = dict([(a.name, STATE_MEMCACHE_PREFIX + a.name)
+                       for a in self.alerts])
+    client = memcache.Client()
+    states = client.get_multi(state_keys.values(), for_cas=True)
+
+    events = []
+    updated_states = {}
+    for aggregate_data in sorted(aggregate_results, key=lambda d: d['window']):
+      window = aggregate_data['window']
+      for counter_name, counter_value in aggregate_data['counters'].iteritems():
+        for alert in self._counter_names_to_alerts.get(counter_name, []):
+          state_key = state_keys[alert.name]
+          state = updated_states.get(state_key, states.get(state_key))
+          if state is None:
+            state = {}
+          if 'window' in state and window <= state['window']:
+            # Skip windows which were already evaluated.
+            continue
+          value = _GetScalarValue(counter_value)
+          message = alert.Evaluate(state, window, value, self.window_size)
+          state['window'] = window
+          updated_states[state_key] = state
+          if message:
+            events.append({
+                'alert': alert.name,
+                'counter_name': counter_name,
+                'window': window,
+                'value': value,
+                'message': message,
+            })
+
+    # Windows are claimed by one aggregator at a time, but don't overwrite a
+    # state which was changed while these windows were evaluated.
+    new_states = dict([(k, v) for k, v in updated_states.iteritems()
+                       if k not in states])
+    cas_states = dict([(k, v) for k, v in updated_states.iteritems()
+                       if k in states])
+    failed_keys = []
+    if new_states:
+      failed_keys += client.add_multi(new_states, time=STATE_CACHE_SECONDS)
+    if cas_states:
+      failed_keys += client.cas_multi(cas_states, time=STATE_CACHE_SECONDS)
+    if failed_keys:
+      logging.warning('Alert states changed concurrently, not updated: %s',
+                      failed_keys)
+    for event in events:
+      _RecordEvent(event)
+    return events
+
+def _RecordEvent(event):
+  logging.warning('Stats alert "%s" at window %d: %s', event['alert'],
+                  event['window'], event['message'])
+  date = datetime.datetime.utcfromtimestamp(event['window'])
+  path = os.path.join(
+      BASE_DIR, str(date.year), str(date.month), str(date.day),
+      event['alert'], '%d.json' % event['window'])
+  meta = {
+      'stats_alert_name': event['alert'],
+      'stats_counter_name': event['counter_name'],
+      'stats_date': datetime.datetime(date.year, date.month, date.day),
+  }
+  try:
+    files.Write(path, content=json.dumps(event), meta=meta)
+  except Exception:
+    # Recording an event should never break aggregation; it was logged above.
+    logging.exception('Unable to record stats alert event.')
+
+def _GetScalarValue(counter_value):
+  """Get a single number from counter data, like the average of an average."""
+  if isinstance(counter_value, (list, tuple)):
+    return counter_value[0]
+  return counter_value
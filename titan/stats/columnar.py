@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# Copyright 2012 Google Inc. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Compact, columnar binary encoding of counter data.
+
+Usage:
+  content = columnar.Encode([(1337000000, 5), (1337000010, 2)])
+  windows, columns = columnar.DecodeColumns(content)
+  counter_data = columnar.Decode(content)
+
+Format (all numbers little-endian):
+  - The magic string "TSC\\x01".
+  - A header of: flags (1 byte), number of points (4 bytes), number of value
+    columns (1 byte), the first window (8 bytes), and then the type of each
+    value column (1 byte each, "q" or "d" as in the struct module).
+  - A body, zlib-compressed if FLAG_COMPRESSED is set, of the window deltas
+    (4-byte signed integers, the first of which is always 0), followed by each
+    value column (8-byte signed integers or doubles).
+
+Counter values must be numbers, or fixed-length sequences of numbers, which
+are decoded as tuples. Other data, like HistogramCounter buckets, can't be
+encoded and should be stored as JSON.
+"""
+
+import array
+import struct
+import sys
+import zlib
+
+MAGIC = 'TSC\x01'
+FLAG_COMPRESSED = 1 << 0
+FLAG_SEQUENCE_VALUES = 1 << 1
+
+_HEADER_FORMAT = '<BIBq'
+_HEADER_SIZE = struct.calcsize(_HEADER_FORMAT)
+_DELTA_TYPECODE = 'i'
+_FLOAT_TYPECODE = 'd'
+_INT_COLUMN_TYPE = 'q'
+_FLOAT_COLUMN_TYPE = 'd'
+_MIN_INT = -(1 << 63)
+_MAX_INT = (1 << 63) - 1
+_MAX_DELTA = (1 << 31) - 1
+
+def _GetInt64Typecode():
+  for typecode in ('l', 'i'):
+    if array.array(typecode).itemsize == 8:
+      return typecode
+  return None
+
+# None if the platform has no 8-byte integer array type, in which case nothing
+# can be encoded.
+_INT_TYPECODE = _GetInt64Typecode()
+
+def IsEncoded(content):
+  """Whether the given content is in the columnar format."""
+  return content.startswith(MAGIC)
+
+def Encode(counter_data, compress=True):
+  """Encode counter data.
+
+  Args:
+    counter_data: A list of (window, value) two-tuples, sorted by window.
+    compress: Whether to compress the windows and columns.
+  Returns:
+    The encoded string, or None if the data cannot be encoded.
+  """
+  if not _INT_TYPECODE or not counter_data:
+    return None
+  is_sequence = isinstance(counter_data[0][1], (list, tuple))
+  num_columns = len(counter_data[0][1]) if is_sequence else 1
+  if not 0 < num_columns < 256:
+    return None
+
+  windows = array.array(_DELTA_TYPECODE)
+  columns = [[] for _ in range(num_columns)]
+  last_window = counter_data[0][0]
+  for window, value in counter_data:
+    delta = window - last_window
+    if not 0 <= delta <= _MAX_DELTA:
+      return None
+    windows.append(delta)
+    last_window = window
+    if is_sequence:
+      if not isinstance(value, (list, tuple)) or len(value) != num_columns:
+        return None
+    else:
+      value = (value,)
+    for i, column_value in enumerate(value):
+      columns[i].append(column_value)
+
+  column_types = []
+  column_arrays = []
+  for column in columns:
+    typecode = _GetTypecode(column)
+    if not typecode:
+      return None
+    is_float = typecode == _FLOAT_TYPECODE
+    column_types.append(_FLOAT_COLUMN_TYPE if is_float else _INT_COLUMN_TYPE)
+    column_arrays.append(array.array(typecode, column))
+
+  flags = 0
+  if compress:
+    flags |= FLAG_COMPRESSED
+  if is_sequence:
+    flags |= FLAG_SEQUENCE_VALUES
+  header = struct.pack(_HEADER_FORMAT, flags, len(counter_data), num_columns,
+                       counter_data[0][0])
+  body = ''.join([_ToLittleEndianString(a) for a in [windows] + column_arrays])
+  if compress:
+    body = zlib.compress(body)
+  return MAGIC + header + ''.join(column_types) + body
+
+def DecodeColumns(content):
+  """Decode content into arrays.
+
+  Args:
+    content: A string from Encode().
+  Raises:
+    ValueError: If the content is not in the columnar format.
+  Returns:
+    A two-tuple of an array of windows and a list of value column arrays.
+  """
+  windows, columns, _ = _DecodeColumns(content)
+  return windows, columns
+
+def Decode(content):
+  """Decode content into counter data.
+
+  Args:
+    content: A string from Encode().
+  Raises:
+    ValueError: If the content is not in the columnar format.
+  Returns:
+    A list of (window, value) two-tuples. Sequence values are tuples.
+  """
+  windows, columns, is_sequence = _DecodeColumns(content)
+  if is_sequence:
+    values = zip(*columns)
+  else:
+    values = columns[0]
+  return zip(windows, values)
+
+def _DecodeColumns(content):
+  if not IsEncoded(content):
+    raise ValueError('Content is not in the columnar format.')
+  offset = len(MAGIC)
+  flags, num_points, num_columns, first_window = struct.unpack_from(
+      _HEADER_FORMAT, content, offset)
+  offset += _HEADER_SIZE
+  column_types = content[offset:offset + num_columns]
+  offset += num_columns
+  body = content[offset:]
+  if flags & FLAG_COMPRESSED:
+    body = zlib.decompress(body)
+
+  typecodes = [_DELTA_TYPECODE]
+  for column_type in column_types:
+    if column_type == _INT_COLUMN_TYPE and _INT_TYPECODE:
+      typecodes.append(_INT_TYPECODE)
+    elif column_type == _FLOAT_COLUMN_TYPE:
+      typecodes.append(_FLOAT_TYPECODE)
+    else:
+      raise ValueError('Unsupported column type: %r' % column_type)
+
+  arrays = []
+  offset = 0
+  for typecode in typecodes:
+    column = array.array(typecode)
+    size = column.itemsize * num_points
+    column.fromstring(body[offset:offset + size])
+    if sys.byteorder == 'big':
+      column.byteswap()
+    arrays.append(column)
+    offset += size
+
+  # Undo the delta encoding of windows.
+  windows = array.array(_INT_TYPECODE)
+  window = first_window
+  for delta in arrays[0]:
+    window += delta
+    windows.append(window)
+  return windows, arrays[1:], bool(flags & FLAG_SEQUENCE_VALUES)
+
+def _GetTypecode(column):
+  """Get the array typecode for a column of numbers, or None."""
+  typecode = _INT_TYPECODE
+  for value in column:
+    if isinstance(value, bool) or not isinstance(value, (int, long, float)):
+      return None
+    if isinstance(value, float):
+      typecode = _FLOAT_TYPECODE
+    elif not _MIN_INT <= value <= _MAX_INT:
+      return None
+  return typecode
+
+def _ToLittleEndianString(column):
+  if sys.byteorder == 'big':
+    column = array.array(column.typecode, column)
+    column.byteswap()
+  return column.tostring()
@@ -20,16 +20,29 @@ try:
 except ImportError:
   pass
 
+import calendar
 import datetime
+import hashlib
 import json
 import os
+import threading
 import time
 from django import template
 import webapp2
+from titan.common import sharded_cache
 from titan.stats import stats
 
 TEMPLATES_PATH = os.path.join(os.path.dirname(__file__), 'templates')
 
+RESPONSE_CACHE_PREFIX = 'titan-stats-response:'
+# Responses of ranges which include recent days are only cached briefly.
+RECENT_RESPONSE_CACHE_SECONDS = stats.DEFAULT_WINDOW_SIZE
+FINAL_RESPONSE_CACHE_SECONDS = 24 * 60 * 60
+
+# Compiled templates, by filename, shared by all requests on the instance.
+_templates = {}
+_templates_lock = threading.Lock()
+
 class CounterDataHandler(webapp2.RequestHandler):
   """Handler for getting counter data."""
 
@@ -40,6 +53,10 @@ class CounterDataHandler(webapp2.RequestHandler):
       counter_name: A counter name. Multiple names allowed.
       start_date: An ISO-8601 date string.
       end_date: An ISO-8601 date string.
+      since: A window. If given, only data points after it are returned, so
+          that clients can poll for new data.
+      max_points: The max number of data points per counter. Defaults to
+          stats.DEFAULT_MAX_POINTS.
     Returns:
       JSON response of the aggregate counter data from
       CountersService.GetCounterData().
@@ -49,9 +66,11 @@ class CounterDataHandler(webapp2.RequestHandler):
     aggregate_data = counters_service.GetCounterData(
         counter_names=params['counter_names'],
         start_date=params['start_date'],
-        end_date=params['end_date'])
+        end_date=params['end_date'],
+        since=params['since'],
+        max_points=params['max_points'])
     self.response.headers['Content-Type'] = 'application/json'
-    self.response.out.write(aggregate_data)
+    self.response.out.write(json.dumps(aggregate_data))
 
 class GraphHandler(webapp2.RequestHandler):
   """Handler for graphing counter data."""
@@ -63,29 +82,99 @@ class GraphHandler(webapp2.RequestHandler):
       counter_name: A counter name. Multiple names allowed.
       start_date: An ISO-8601 date string.
       end_date: An ISO-8601 date string.
+      max_points: The max number of data points per counter. Defaults to
+          stats.DEFAULT_MAX_POINTS.
     Returns:
       Rendered HTML template with graph of counter data.
     """
     params = _ParseRequestParams(self.request)
+    # Data of past-only date ranges never changes once it is compacted, so
+    # let clients cache it. Final responses are cached separately from those
+    # rendered before the data was final.
+    last_modified = _GetFinalizedTime(params['end_date'])
+    cache_key = _MakeResponseCacheKey('graph', params,
+                                      is_final=bool(last_modified))
+    if last_modified:
+      self.response.etag = cache_key
+      self.response.last_modified = last_modified
+      if_modified_since = self.request.if_modified_since
+      if if_modified_since:
+        if_modified_since = if_modified_since.replace(tzinfo=None)
+      if (cache_key in self.request.if_none_match
+          or (if_modified_since and if_modified_since >= last_modified)):
+        self.response.status = 304
+        return
 
-    counters_service = stats.CountersService()
-    aggregate_data = counters_service.GetCounterData(
-        counter_names=params['counter_names'],
-        start_date=params['start_date'],
-        end_date=params['end_date'])
-    # Render template:
-    path = os.path.join(TEMPLATES_PATH, 'graph.html')
-    tpl = template.Template(open(path).read())
-    data = {
-        'aggregate_data': aggregate_data,
-    }
-    context = template.Context(data)
-    self.response.out.write(tpl.render(context))
+    # Rendered graphs of long ranges can be larger than 1MB.
+    content = sharded_cache.Get(cache_key)
+    if content is None:
+      counters_service = stats.CountersService()
+      aggregate_data = counters_service.GetCounterData(
+          counter_names=params['counter_names'],
+          start_date=params['start_date'],
+          end_date=params['end_date'],
+          max_points=params['max_points'])
+      # Render template:
+      tpl = _GetTemplate('graph.html')
+      data = {
+          'aggregate_data': aggregate_data,
+      }
+      context = template.Context(data)
+      content = tpl.render(context)
+      sharded_cache.Set(cache_key, content,
+                        time=(FINAL_RESPONSE_CACHE_SECONDS if last_modified
+                              else RECENT_RESPONSE_CACHE_SECONDS))
+    self.response.out.write(content)
+
+def _GetTemplate(filename):
+  """Get a compiled template, which is only read and parsed once."""
+  tpl = _templates.get(filename)
+  if tpl is None:
+    with _templates_lock:
+      tpl = _templates.get(filename)
+      if tpl is None:
+        path = os.path.join(TEMPLATES_PATH, filename)
+        with open(path) as template_file:
+          tpl = template.Template(template_file.read())
+        _templates[filename] = tpl
+  return tpl
+
+def _MakeResponseCacheKey(handler_name, params, is_final=False):
+  # Include the app version, since a new template may render differently.
+  key = json.dumps([
+      os.environ.get('CURRENT_VERSION_ID'),
+      handler_name,
+      sorted(params['counter_names']),
+      params['start_date'] and params['start_date'].isoformat(),
+      params['end_date'] and params['end_date'].isoformat(),
+      params['since'],
+      params['max_points'],
+      is_final,
+  ])
+  return RESPONSE_CACHE_PREFIX + hashlib.sha1(key).hexdigest()
+
+def _GetFinalizedTime(end_date):
+  """Get when the data of a date range became final, or None if it isn't.
+
+  The data is final once every window of the end date has been compacted.
+  """
+  if not end_date:
+    return None
+  end_datetime = datetime.datetime(
+      end_date.year, end_date.month, end_date.day) + datetime.timedelta(days=1)
+  last_window = (calendar.timegm(end_datetime.timetuple())
+                 - stats.DEFAULT_WINDOW_SIZE)
+  compacted_through = stats.GetCompactedThrough()
+  if compacted_through is None or compacted_through < last_window:
+    return None
+  return end_datetime
 
 def _ParseRequestParams(request):
   counter_names = request.get_all('counter_name')
   start_date = request.get('start_date')
   end_date = request.get('end_date')
+  since = request.get('since')
+  max_points = request.get('max_points')
   if start_date:
     parsed_time = time.strptime(start_date, '%Y-%m-%d')
     start_date = datetime.date(
@@ -94,10 +183,14 @@ def _ParseRequestParams(request):
     parsed_time = time.strptime(end_date, '%Y-%m-%d')
     end_date = datetime.date(
         parsed_time.tm_year, parsed_time.tm_mon, parsed_time.tm_mday)
+  since = int(since) if since else None
+  max_points = int(max_points) if max_points else stats.DEFAULT_MAX_POINTS
   result = {
       'counter_names': counter_names,
       'start_date': start_date,
       'end_date': end_date,
+      'since': since,
+      'max_points': max_points,
   }
   return result
 
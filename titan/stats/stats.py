@@ -26,17 +26,53 @@ Usage:
   # ... code block ...
   latency_counter.Stop()
 
+  # Or record the distribution of latencies, to query percentiles later:
+  latency_histogram = stats.HistogramTimingCounter('widget/render/histogram')
+  latency_histogram.Start()
+  # ... code block ...
+  latency_histogram.Stop()
+
+  # Or break a counter down by dimensions, like per-project writes:
+  write_counter = stats.Counter('project/write',
+                                dimensions={'project': project_name})
+  write_counter.Increment()
+
   # Store the counters in the local request environment.
   stats.StoreRequestLocalCounters([latency_counter, page_view_counter])
 
   # Save the counter (this should happen at the absolute end of a request).
+  # Counters are merged into an instance-level buffer, which adds one task per
+  # window once the window has passed.
   stats.SaveRequestLocalCounters()
 
+  # Buffered windows are flushed by later requests, by a background thread
+  # (on instances with manual or basic scaling), and at instance shutdown.
+  # Instances with automatic scaling can't run either of the last two, so
+  # they can flush the buffer at the end of each request instead:
+  stats.SaveRequestLocalCounters(flush=True)
+
   # In a cron job run every minute:
   all_counters = [stats.Counter('page/view')]
   aggregator = stats.Aggregator(all_counters)
   aggregator.ProcessWindowsWithBackoff(total_runtime_minutes=1)
 
+  # Or, to keep up with more traffic, fan out to concurrent task workers:
+  stats.StartAggregatorWorkers(all_counters, num_workers=4)
+
+  # Counters which aren't given to the aggregator, such as counters with
+  # dimensions, are registered dynamically from the task data.
+
+  # Alerts can be evaluated on each window once it is complete:
+  all_alerts = [alerts.ThresholdAlert('slow', 'page/latency', max_value=500)]
+  aggregator = stats.Aggregator(all_counters, alerts=all_alerts)
+
+  # Query the top projects by number of writes today:
+  counters_service = stats.CountersService()
+  counters_service.GetTopDimensionValues('project/write', 'project', limit=10)
+
+  # In a cron job run every hour:
+  stats.CompactAggregateData()
+
 Internal design and terminology:
   - "Window" or "aggregation window" used below is a unix timestamp rounded to
     some number of seconds. Each window can be thought of as a bucket of time
@@ -45,24 +81,55 @@ Internal design and terminology:
     be 8640 data points stored permanently per day, per counter (since there
     are 86400 seconds in a day).
 
-  - The counters work in two steps:
+  - A counter with dimensions is stored as a separate counter, named by its
+    key (like "project/write|project=foo"). The day value of each dimensional
+    counter is also summarized in a single file per counter name and day, so
+    the top N values of a dimension don't need to read every counter file.
+
+  - Besides the raw windows, each day's data is also stored as 1-minute,
+    1-hour, and 1-day rollups, each point of which merges the counter data of
+    every window inside it. CountersService.GetCounterData picks the
+    resolution which fits the requested date range within a point budget, so
+    long date ranges read a bounded amount of data.
+
+  - The counters work in three steps:
     1. Application code creates, increments, and saves counters during a
-       request. When saving counters, a task is added to a pull task queue.
+       request. Saved counters are merged with those of other requests on the
+       same instance, and a task is added to a pull task queue for each
+       window that has passed.
     2. A cron job runs the Aggregator to collect, aggregate, and store counter
        data. Even though cron jobs can only be started at minute-level
        intervals, the cron job runs continuously for the entire minute,
        collecting data from aggregation windows which have already passed
        and pausing dynamically if all old windows have been collected.
+       Each window's data is stored append-only, in one small entity.
+    3. A less frequent cron job compacts stored windows into per-day data
+       files, so the cost of aggregating a window is constant no matter how
+       much data has already been stored for the day.
 """
 
+import calendar
+import collections
 import copy
 import datetime
+import hashlib
 import json
 import logging
+import math
 import os
+import random
+import threading
 import time
+from google.appengine.api import background_thread
+from google.appengine.api import memcache
+from google.appengine.api import runtime
 from google.appengine.api import taskqueue
+from google.appengine.ext import db
+from google.appengine.ext import deferred
 from titan import files
+from titan.common import sharded_cache
+from titan.stats import alerts as alerts_lib
+from titan.stats import columnar
 
 # The bucket size for an aggregation window, in number of seconds.
 DEFAULT_WINDOW_SIZE = 10
@@ -76,23 +143,116 @@ TASKQUEUE_LEASE_MAX_TASKS = 1000
 # the window hasn't yet passed.
 TASKQUEUE_LEASE_BUFFER_SECONDS = 3 * DEFAULT_WINDOW_SIZE
 
+# Tasks of each window are tagged with one of this many shards, so that
+# concurrent aggregator workers can lease disjoint sets of a window's tasks.
+TASKQUEUE_TAG_SHARDS = 4
+
+# The number of task tags an aggregator leases and processes concurrently.
+DEFAULT_PARALLEL_WINDOWS = 4
+
+# Alerts are evaluated on windows once they are this old, by which time all of
+# the parts of a window have been aggregated.
+ALERT_DELAY_SECONDS = 2 * 60
+
+# Delimiters of counter keys, like "project/write|project=foo,user=bar".
+COUNTER_KEY_DELIMITER = '|'
+DIMENSIONS_DELIMITER = ','
+DIMENSION_VALUE_DELIMITER = '='
+_DIMENSION_RESERVED_CHARS = frozenset(
+    [COUNTER_KEY_DELIMITER, DIMENSIONS_DELIMITER, DIMENSION_VALUE_DELIMITER,
+     ':', '/'])
+DIMENSIONS_FILENAME = 'dimensions.json'
+
+# How often the background thread flushes the windows which have passed.
+BUFFER_FLUSH_INTERVAL_SECONDS = DEFAULT_WINDOW_SIZE
+
+# Buffering more windows than this logs a warning, since it usually means that
+# tasks can't be added. Buffered data is never dropped.
+BUFFER_WARNING_WINDOWS = 30
+
 BASE_DIR = '/_titan/stats/counters'
-DATA_FILENAME = 'data-%ss.json' % DEFAULT_WINDOW_SIZE
+DATA_FILENAME_FORMAT = 'data-%ss.json'
+DATA_FILENAME = DATA_FILENAME_FORMAT % DEFAULT_WINDOW_SIZE
+
+# Data files are written in the columnar format when their data can be
+# encoded, and are otherwise JSON. Both formats are always readable.
+COMPRESS_DATA_FILES = True
+
+# Resolutions, in number of seconds, at which counter data is stored.
+RESOLUTIONS = (DEFAULT_WINDOW_SIZE, 60, 60 * 60, 24 * 60 * 60)
+
+# A suggested max number of points per counter, for callers of
+# GetCounterData which want it to pick a resolution.
+DEFAULT_MAX_POINTS = 2000
+
+# Histogram bucket bounds grow by this factor, so percentiles are accurate to
+# within about half of the growth (5%).
+HISTOGRAM_BUCKET_GROWTH = 1.1
+DEFAULT_PERCENTILES = (50, 95, 99)
+
+# Stored windows are compacted into data files once they are at least this old.
+COMPACTION_MIN_AGE_SECONDS = 60 * 60
+COMPACTION_BATCH_SIZE = 1000
+
+# The meta of this file records the window through which all stored windows
+# have been compacted.
+COMPACTION_STATE_PATH = BASE_DIR + '/compaction.json'
+
+# Each counter's series is cached per day. A day is finalized, and its series
+# cached for longer, once all of its windows have been compacted.
+SERIES_CACHE_PREFIX = 'titan-stats-series:'
+FINAL_SERIES_CACHE_SECONDS = 7 * 24 * 60 * 60
+
+# The assembled results of GetCounterData are also cached per date range, in
+# sharded_cache since long ranges can exceed 1MB. Ranges which include days
+# that are not final are only cached briefly, since they change every window.
+RANGE_CACHE_PREFIX = 'titan-stats-range:'
+RANGE_CACHE_SECONDS = 60 * 60
+RANGE_CACHE_RECENT_SECONDS = DEFAULT_WINDOW_SIZE
 
 class AbstractBaseCounter(object):
-  """Base class for all counters."""
+  """Base class for all counters.
 
-  def __init__(self, name):
+  Attributes:
+    name: The counter name.
+    dimensions: A dictionary of dimension names to values.
+    key: A string which uniquely identifies the counter name and dimensions.
+  """
+
+  def __init__(self, name, dimensions=None):
     self.name = name
-    if ':' in self.name:
-      raise ValueError('":" is not allowed in counter name: %s'
-                       % name)
+    if ':' in self.name or COUNTER_KEY_DELIMITER in self.name:
+      raise ValueError('":" and "%s" are not allowed in counter name: %s'
+                       % (COUNTER_KEY_DELIMITER, name))
     if name.startswith('/') or name.endswith('/'):
       raise ValueError('"/" is not allowed to begin or end counter name: %s'
                        % name)
+    self.dimensions = {}
+    for dimension, value in (dimensions or {}).iteritems():
+      if not isinstance(value, basestring):
+        value = str(value)
+      self.dimensions[dimension] = value
+    for dimension, value in self.dimensions.iteritems():
+      for part in (dimension, value):
+        if not part or set(part) & _DIMENSION_RESERVED_CHARS:
+          raise ValueError(
+              'Invalid dimension %r=%r of counter %s. Dimensions cannot be '
+              'empty or contain any of: %s'
+              % (dimension, value, name, ''.join(_DIMENSION_RESERVED_CHARS)))
+    self.key = _MakeCounterKey(self.name, self.dimensions)
+    if self.dimensions:
+      # The key is part of the paths of the counter's data files, so it must
+      # follow the path rules (such as no "..") to be compacted.
+      try:
+        files.ValidatePaths(_MakeLogPath(datetime.datetime.utcnow(), self.key))
+      except ValueError:
+        raise ValueError(
+            'Invalid dimensions %r of counter %s. Dimensions cannot contain '
+            'characters which are not allowed in paths, such as "..".'
+            % (self.dimensions, name))
 
   def __repr__(self):
-    return '<%s %s>' % (self.__class__.__name__, self.name)
+    return '<%s %s>' % (self.__class__.__name__, self.key)
 
   def Aggregate(self, value):
     """Abstract method, must aggregate data together before Finalize."""
@@ -110,7 +270,7 @@ class Counter(AbstractBaseCounter):
     self._value = 0
 
   def __repr__(self):
-    return '<Counter %s %s>' % (self.name, self._value)
+    return '<Counter %s %s>' % (self.key, self._value)
 
   def Increment(self):
     """Increment the counter by one."""
@@ -147,6 +307,9 @@ class AverageCounter(Counter):
     # Cumulative moving average:
     # (n*weight(n) + m*weight(m)) / (weight(n) + weight(m))
     value, weight = value
+    if not weight:
+      # Nothing was recorded, such as a timing counter which wasn't sampled.
+      return
     # Numerator:
     self._value *= self._weight
     self._value += value * weight
@@ -186,6 +349,94 @@ class AverageTimingCounter(AverageCounter):
     value, weight = super(AverageTimingCounter, self).Finalize()
     return (int(value), weight)
 
+class HistogramCounter(AbstractBaseCounter):
+  """A mergeable histogram counter, for percentiles of recorded values.
+
+  Values are counted in logarithmic buckets, so the finalized data stays small
+  no matter how many values are recorded, and histograms from many requests or
+  windows merge exactly by adding together their bucket counts.
+
+  Finalized data is a three-tuple of (count, total, buckets), where buckets is
+  a sorted list of [bucket index, count] pairs of non-empty buckets.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(HistogramCounter, self).__init__(*args, **kwargs)
+    self._count = 0
+    self._total = 0
+    self._buckets = {}
+
+  def __repr__(self):
+    return '<HistogramCounter %s %s>' % (self.key, self._count)
+
+  def Offset(self, value):
+    """Record a value in the histogram."""
+    index = _GetHistogramBucket(value)
+    self._buckets[index] = self._buckets.get(index, 0) + 1
+    self._count += 1
+    self._total += value
+
+  def Aggregate(self, value):
+    count, total, buckets = value
+    for index, bucket_count in buckets:
+      self._buckets[index] = self._buckets.get(index, 0) + bucket_count
+    self._count += count
+    self._total += total
+
+  def Finalize(self):
+    buckets = [[index, self._buckets[index]] for index in sorted(self._buckets)]
+    return (self._count, self._total, buckets)
+
+  def Mean(self):
+    """Get the mean of all recorded values, or None if there are none."""
+    if not self._count:
+      return None
+    return self._total / float(self._count)
+
+  def Percentile(self, percentile):
+    """Get the approximate value at the given percentile.
+
+    Args:
+      percentile: A number between 0 and 100.
+    Raises:
+      ValueError: If the percentile is out of range.
+    Returns:
+      The approximate value, or None if no values have been recorded.
+    """
+    if not 0 <= percentile <= 100:
+      raise ValueError('Percentile must be between 0 and 100. Got: %r'
+                       % percentile)
+    if not self._count:
+      return None
+    rank = max(1, int(math.ceil(self._count * percentile / 100.0)))
+    seen = 0
+    for index in sorted(self._buckets):
+      seen += self._buckets[index]
+      if seen >= rank:
+        return _GetHistogramBucketValue(index)
+
+class HistogramTimingCounter(HistogramCounter):
+  """A HistogramCounter with convenience methods for timing code blocks.
+
+  Records data in millisecond integers.
+  """
+
+  def __init__(self, *args, **kwargs):
+    super(HistogramTimingCounter, self).__init__(*args, **kwargs)
+    self._start = None
+
+  def Start(self):
+    assert self._start is None, 'Counter started again without stopping.'
+    self._start = time.time()
+
+  def Stop(self):
+    self.Offset(int((time.time() - self._start) * 1000))
+    self._start = None
+
+  def Finalize(self):
+    assert self._start is None, 'Counter finalized without stopping.'
+    return super(HistogramTimingCounter, self).Finalize()
+
 def StoreRequestLocalCounters(counters):
   """Store given counters in a request/thread-local environment var."""
   counters = counters if hasattr(counters, '__iter__') else [counters]
@@ -200,9 +451,141 @@ def GetRequestLocalCounters():
   """Get all environment counters."""
   return os.environ.get('counters', [])
 
-def SaveRequestLocalCounters():
-  """Save all environment counters for future aggregation."""
-  return SaveCounters(GetRequestLocalCounters())
+def SaveRequestLocalCounters(flush=False):
+  """Buffer all environment counters for future aggregation."""
+  return BufferCounters(GetRequestLocalCounters(), flush=flush)
+
+def BufferCounters(counters, timestamp=None, flush=False):
+  """Merge counter data into the instance-level buffer for its window.
+
+  Rather than adding a task for every request, the data of all requests on this
+  instance is merged per window, and one task is added per window after the
+  window has passed. Windows which have passed are flushed by this call, by a
+  background thread, and when the instance shuts down.
+
+  Args:
+    counters: An iterable of counters.
+    timestamp: A unix timestamp. Defaults to the current time if not given.
+    flush: Whether to also flush the current window.
+  Raises:
+    ValueError: if passed an empty list of counters.
+  """
+  counters = counters if hasattr(counters, '__iter__') else [counters]
+  if not counters:
+    raise ValueError('Counters are required. Got: %r' % counters)
+  _StartBufferFlushing()
+  now = time.time()
+  window = _GetWindow(now if timestamp is None else timestamp)
+  _counter_buffer.Add(window, counters)
+  FlushBufferedCounters(before_window=None if flush else _GetWindow(now))
+
+def FlushBufferedCounters(before_window=None):
+  """Add tasks for the buffered counter data on this instance.
+
+  Args:
+    before_window: Only flush windows before this one. Defaults to flushing
+        all buffered windows.
+  Returns:
+    The number of windows flushed.
+  """
+  windows_to_counters = _counter_buffer.Pop(before_window=before_window)
+  if not windows_to_counters:
+    return 0
+  tasks = []
+  for window in sorted(windows_to_counters):
+    tasks.append(_MakeTask(window, windows_to_counters[window]))
+  try:
+    # A single RPC for every window.
+    taskqueue.Queue(TASKQUEUE_NAME).add(tasks)
+  except taskqueue.Error:
+    # Task queue errors should not kill a request, so keep the data to be
+    # flushed by a later request.
+    logging.exception('Unable to add stats tasks to queue.')
+    _RestoreBufferedCounters(windows_to_counters)
+    return 0
+  except:
+    # Keep the data if the request runs out of time (or otherwise fails)
+    # while flushing, but don't swallow the error.
+    _RestoreBufferedCounters(windows_to_counters)
+    raise
+  return len(windows_to_counters)
+
+def _RestoreBufferedCounters(windows_to_counters):
+  for window, counters in windows_to_counters.iteritems():
+    _counter_buffer.Add(window, counters)
+
+def _StartBufferFlushing():
+  """Flush the buffer periodically and at shutdown, once per instance."""
+  global _buffer_flushing_started  # pylint: disable-msg=W0603
+  with _buffer_flushing_lock:
+    if _buffer_flushing_started:
+      return
+    _buffer_flushing_started = True
+  _previous_shutdown_hooks.append(
+      runtime.set_shutdown_hook(_FlushBufferedCountersAtShutdown))
+  try:
+    background_thread.start_new_background_thread(
+        _FlushBufferedCountersPeriodically, [])
+  except background_thread.Error:
+    # Instances with automatic scaling don't support background threads.
+    logging.info('Stats buffer is only flushed by requests on this instance.')
+
+def _FlushBufferedCountersPeriodically():
+  while True:
+    time.sleep(BUFFER_FLUSH_INTERVAL_SECONDS)
+    try:
+      FlushBufferedCounters(before_window=_GetWindow())
+    except Exception:
+      logging.exception('Unable to flush buffered stats.')
+
+def _FlushBufferedCountersAtShutdown():
+  try:
+    FlushBufferedCounters()
+  finally:
+    previous_shutdown_hook = _previous_shutdown_hooks[0]
+    if previous_shutdown_hook:
+      previous_shutdown_hook()
+
+class _CounterBuffer(object):
+  """A thread-safe buffer of counters merged by window and name."""
+
+  def __init__(self):
+    self._lock = threading.Lock()
+    # Maps windows to dictionaries of counter keys to counters.
+    self._windows = {}
+
+  def Add(self, window, counters):
+    """Merge the finalized data of counters into the window's counters."""
+    with self._lock:
+      buffered_counters = self._windows.setdefault(window, {})
+      for counter in counters:
+        if counter.key not in buffered_counters:
+          buffered_counters[counter.key] = counter.__class__(
+              counter.name, dimensions=counter.dimensions)
+        buffered_counters[counter.key].Aggregate(counter.Finalize())
+      if len(self._windows) > BUFFER_WARNING_WINDOWS:
+        logging.warning('Buffering stats for %d windows.', len(self._windows))
+
+  def Pop(self, before_window=None):
+    """Remove and return buffered windows.
+
+    Args:
+      before_window: Only pop windows before this one. Defaults to all windows.
+    Returns:
+      A dictionary mapping windows to lists of counters.
+    """
+    with self._lock:
+      windows_to_counters = {}
+      for window in self._windows.keys():
+        if before_window is None or window < before_window:
+          windows_to_counters[window] = self._windows.pop(window).values()
+      return windows_to_counters
+
+# Instance-level buffer, shared by all requests (and threads) on the instance.
+_counter_buffer = _CounterBuffer()
+_buffer_flushing_lock = threading.Lock()
+_buffer_flushing_started = False
+_previous_shutdown_hooks = []
 
 def SaveCounters(counters, timestamp=None):
   """Save counter data to a aggregation window.
@@ -220,41 +603,83 @@ def SaveCounters(counters, timestamp=None):
   if not counters:
     raise ValueError('Counters are required. Got: %r' % counters)
   window = _GetWindow(time.time() if timestamp is None else timestamp)
+  task = _MakeTask(window, counters)
+  try:
+    task.add(queue_name=TASKQUEUE_NAME)
+    return task.payload
+  except taskqueue.Error:
+    # Task queue errors from SaveCounters should not kill a request.
+    logging.exception('Unable to add stats task to queue.')
+
+def _MakeTask(window, counters):
+  """Make a pull task of the counters' finalized data for a window."""
   counter_data = {
       'window': window,
       'counters': {},
+      # Allows the aggregator to register unknown counters dynamically.
+      'counter_types': {},
   }
   for counter in counters:
-    counter_data['counters'][counter.name] = counter.Finalize()
+    counter_data['counters'][counter.key] = counter.Finalize()
+    counter_data['counter_types'][counter.key] = counter.__class__.__name__
   counter_data = json.dumps(counter_data)
   # Important: unlock this window's tasks for lease at the same time,
   # after the window itself has passed.
   eta = datetime.datetime.utcfromtimestamp(
       window + TASKQUEUE_LEASE_BUFFER_SECONDS)
-  try:
-    task = taskqueue.Task(
-        method='PULL',
-        payload=counter_data,
-        tag=str(window),
-        eta=eta)
-    task.add(queue_name=TASKQUEUE_NAME)
-    return counter_data
-  except taskqueue.Error:
-    # Task queue errors from SaveCounters should not kill a request.
-    logging.exception('Unable to add stats task to queue.')
+  # Tag like "<window>-<shard>".
+  tag = '%d-%d' % (window, random.randrange(TASKQUEUE_TAG_SHARDS))
+  return taskqueue.Task(
+      method='PULL',
+      payload=counter_data,
+      tag=tag,
+      eta=eta)
 
 class Aggregator(object):
   """A service class, used in a cron job to consume and save counters."""
 
-  def __init__(self, counters):
-    self._original_counters = copy.deepcopy(counters)
+  def __init__(self, counters=None, alerts=None):
+    """Constructor.
+
+    Args:
+      counters: An iterable of known counters. Other counters are registered
+          dynamically from the counter types given in task data.
+      alerts: An iterable of titan.stats.alerts alerts, which are evaluated
+          on each window once all of its parts have been aggregated.
+    """
+    self._alert_evaluator = alerts_lib.AlertEvaluator(
+        list(alerts or []), window_size=DEFAULT_WINDOW_SIZE)
+    self._original_counters = copy.deepcopy(counters or [])
+    # Maps counter keys to the class names of all counters seen.
+    self._counter_types = {}
+    for counter in self._original_counters:
+      self._counter_types[counter.key] = counter.__class__.__name__
     self._ResetCounters()
 
   def _ResetCounters(self):
     self.counters = copy.deepcopy(self._original_counters)
     self._names_to_counters = {}
     for counter in self.counters:
-      self._names_to_counters[counter.name] = counter
+      self._names_to_counters[counter.key] = counter
+
+  def _RegisterCounter(self, counter_key, counter_data):
+    """Make a counter which isn't yet known from the task's counter types.
+
+    Returns:
+      The new counter, or None if its counter type is unknown.
+    """
+    class_name = counter_data.get('counter_types', {}).get(counter_key)
+    counter_class = _GetCounterClass(class_name)
+    if not counter_class:
+      logging.warning('Skipping data of unknown counter "%s" (type: %r).',
+                      counter_key, class_name)
+      return None
+    name, dimensions = _ParseCounterKey(counter_key)
+    counter = counter_class(name, dimensions=dimensions)
+    self.counters.append(counter)
+    self._names_to_counters[counter_key] = counter
+    self._counter_types[counter_key] = class_name
+    return counter
 
   def ProcessNextWindow(self):
     """Lease tasks and permanently save a window's-worth of counter data tasks.
@@ -264,58 +689,128 @@ class Aggregator(object):
       integer and counters is a dictionary mapping counter names to aggregate
       data. Returns an empty dictionary if no tasks were available to consume.
     """
-    self._ResetCounters()
-    queue = taskqueue.Queue(TASKQUEUE_NAME)
+    results = self.ProcessNextWindows(max_windows=1)
+    return results[0] if results else {}
 
-    # Grab the first task to get its window.
-    tasks = queue.lease_tasks(lease_seconds=TASKQUEUE_LEASE_SECONDS,
-                              max_tasks=1)
-    if not tasks:
-      return {}
-    # Lease tasks by window tag.
-    tasks_in_window = queue.lease_tasks_by_tag(
-        lease_seconds=TASKQUEUE_LEASE_SECONDS,
-        max_tasks=TASKQUEUE_LEASE_MAX_TASKS,
-        tag=tasks[0].tag)
-    tasks.extend(tasks_in_window)
-
-    current_window = json.loads(tasks[0].payload)['window']
-    data_to_aggregate = []
-    for task in tasks:
-      counter_data = json.loads(task.payload)
-      data_to_aggregate.append(counter_data)
+  def ProcessNextWindows(self, max_windows=DEFAULT_PARALLEL_WINDOWS):
+    """Lease, aggregate, and save multiple windows of tasks concurrently.
 
-    # Aggregate the counter data into each counter object.
-    available_counter_names = set()
-    for counter_data in data_to_aggregate:
-      for counter_name, counter_value in counter_data['counters'].iteritems():
-        self._names_to_counters[counter_name].Aggregate(counter_value)
-        available_counter_names.add(counter_name)
+    Each tag's tasks are leased until the tag is drained, and all of the task
+    queue and datastore RPCs for the windows are made in parallel.
 
-    # Store each counter's finalized data into aggregate_data.
-    aggregate_data = {
-        'counters': {},
-        'window': current_window,
-    }
-    if not available_counter_names:
-      return {}
-    for counter in self.counters:
-      if counter.name not in available_counter_names:
-        # Don't store anything for counters with no data in this window.
-        continue
-      aggregate_data['counters'][counter.name] = counter.Finalize()
+    Args:
+      max_windows: The max number of task tags to process.
+    Returns:
+      A list of results like those of ProcessNextWindow(), one per window.
+    """
+    queue = taskqueue.Queue(TASKQUEUE_NAME)
+
+    # Each lease with no tag leases tasks of the tag with the earliest ETA.
+    rpcs = []
+    for _ in range(max_windows):
+      rpcs.append(queue.lease_tasks_by_tag_async(
+          lease_seconds=TASKQUEUE_LEASE_SECONDS,
+          max_tasks=TASKQUEUE_LEASE_MAX_TASKS))
+    tags_to_tasks = collections.defaultdict(list)
+    full_tags = set()
+    for rpc in rpcs:
+      tasks = rpc.get_result()
+      if tasks:
+        tags_to_tasks[tasks[0].tag].extend(tasks)
+      if len(tasks) == TASKQUEUE_LEASE_MAX_TASKS:
+        full_tags.add(tasks[0].tag)
+
+    # Drain any tags which may have more tasks, in parallel.
+    while full_tags:
+      rpcs = {}
+      for tag in full_tags:
+        rpcs[tag] = queue.lease_tasks_by_tag_async(
+            lease_seconds=TASKQUEUE_LEASE_SECONDS,
+            max_tasks=TASKQUEUE_LEASE_MAX_TASKS,
+            tag=tag)
+      full_tags = set()
+      for tag, rpc in rpcs.iteritems():
+        tasks = rpc.get_result()
+        tags_to_tasks[tag].extend(tasks)
+        if len(tasks) == TASKQUEUE_LEASE_MAX_TASKS:
+          full_tags.add(tag)
+    if not tags_to_tasks:
+      return []
+
+    # Group the task data by window, since old tags didn't include a shard.
+    windows_to_data = collections.defaultdict(list)
+    all_tasks = []
+    for tasks in tags_to_tasks.itervalues():
+      for task in tasks:
+        counter_data = json.loads(task.payload)
+        windows_to_data[counter_data['window']].append(counter_data)
+      all_tasks.extend(tasks)
+
+    results = []
+    for window in sorted(windows_to_data):
+      aggregate_data = self._AggregateCounterData(
+          window, windows_to_data[window])
+      if aggregate_data:
+        results.append(aggregate_data)
 
     # Save data, then delete tasks whose data we have consumed.
-    self._SaveAggregateData(aggregate_data)
-    queue.delete_tasks(tasks)
+    if results:
+      db.put([self._MakeAggregateWindow(d) for d in results])
+    rpcs = []
+    for i in range(0, len(all_tasks), TASKQUEUE_LEASE_MAX_TASKS):
+      rpcs.append(queue.delete_tasks_async(
+          all_tasks[i:i + TASKQUEUE_LEASE_MAX_TASKS]))
+    for rpc in rpcs:
+      rpc.get_result()
+
+    self._EvaluateAlerts()
+    return results
 
-    return aggregate_data
+  def _EvaluateAlerts(self):
+    """Evaluate alerts on complete windows which haven't been evaluated."""
+    complete_through = _GetWindow(time.time()) - ALERT_DELAY_SECONDS
+    evaluated_through = self._alert_evaluator.ClaimWindows(complete_through)
+    if evaluated_through is None:
+      return
+    window_ents = _AggregateWindow.all()
+    window_ents.filter('window >', evaluated_through)
+    window_ents.filter('window <=', complete_through)
+
+    # Merge the parts of each window.
+    counter_names = self._alert_evaluator.counter_names
+    windows_to_counters = collections.defaultdict(dict)
+    for window_ent in window_ents:
+      counters = json.loads(window_ent.counters)
+      counter_types = window_ent.GetCounterTypes()
+      window_counters = windows_to_counters[window_ent.window]
+      for counter_key in counter_names & set(counters):
+        if counter_key not in window_counters:
+          counter_class = _GetCounterClass(
+              counter_types.get(counter_key)
+              or self._counter_types.get(counter_key))
+          if not counter_class:
+            continue
+          name, dimensions = _ParseCounterKey(counter_key)
+          window_counters[counter_key] = counter_class(
+              name, dimensions=dimensions)
+        window_counters[counter_key].Aggregate(counters[counter_key])
 
-  def ProcessWindowsWithBackoff(self, total_runtime_minutes, development=False):
+    results = []
+    for window in sorted(windows_to_counters):
+      results.append({
+          'window': window,
+          'counters': dict([(k, c.Finalize()) for k, c
+                            in windows_to_counters[window].iteritems()]),
+      })
+    self._alert_evaluator.Evaluate(results)
+
+  def ProcessWindowsWithBackoff(self, total_runtime_minutes, development=False,
+                                max_windows=DEFAULT_PARALLEL_WINDOWS):
     """Long-running function to process multiple windows.
 
     Args:
       total_runtime_minutes: How long to process data for.
+      max_windows: The max number of windows to process concurrently.
     Returns:
       A list of results from ProcessNextWindow().
     """
@@ -327,10 +822,13 @@ class Aggregator(object):
         end_time = time.time() + 5
 
     while True:
-      result = self.ProcessNextWindow()
-      results.append(result)
-      if result:
+      new_results = self.ProcessNextWindows(max_windows=max_windows)
+      results.extend(new_results)
+      if new_results:
         backoff = 1
+        if time.time() > end_time:
+          # Leave any backlog to the next run.
+          break
       else:
         if time.time() + backoff > end_time:
           # If we're about to sleep past the end times, just quit now.
@@ -341,38 +839,287 @@ class Aggregator(object):
           backoff = DEFAULT_WINDOW_SIZE
     return results
 
-  def _SaveAggregateData(self, aggregate_data):
-    """Permanently store aggregate data to Titan Files."""
+  def _AggregateCounterData(self, window, data_to_aggregate):
+    """Aggregate a window's task data into a dictionary of finalized data."""
+    self._ResetCounters()
+
+    # Aggregate the counter data into each counter object.
+    available_counter_names = set()
+    for counter_data in data_to_aggregate:
+      for counter_name, counter_value in counter_data['counters'].iteritems():
+        counter = self._names_to_counters.get(counter_name)
+        if not counter:
+          counter = self._RegisterCounter(counter_name, counter_data)
+          if not counter:
+            continue
+        counter.Aggregate(counter_value)
+        available_counter_names.add(counter_name)
+
+    # Store each counter's finalized data into aggregate_data.
+    aggregate_data = {
+        'counters': {},
+        'window': window,
+    }
+    if not available_counter_names:
+      return {}
+    for counter in self.counters:
+      if counter.key not in available_counter_names:
+        # Don't store anything for counters with no data in this window.
+        continue
+      aggregate_data['counters'][counter.key] = counter.Finalize()
+    return aggregate_data
+
+  def _MakeAggregateWindow(self, aggregate_data):
+    """Make an entity to permanently store aggregate data.
+
+    The entity is later compacted into Titan Files.
+    """
     window = aggregate_data['window']
-    window_datetime = datetime.datetime.utcfromtimestamp(window)
-    for counter_name, counter_value in aggregate_data['counters'].iteritems():
+    # Append-only: each save is a new entity, so there is no read-modify-write
+    # and multiple saves for the same window (such as from different task tag
+    # shards) are all kept, then merged when compacted.
+    counter_types = {}
+    for counter_name in aggregate_data['counters']:
+      counter_types[counter_name] = self._counter_types[counter_name]
+    return _AggregateWindow(
+        window=window,
+        date=_GetDate(window),
+        counters=json.dumps(aggregate_data['counters']),
+        counter_types=json.dumps(counter_types))
+
+def StartAggregatorWorkers(counters, num_workers=TASKQUEUE_TAG_SHARDS,
+                           total_runtime_minutes=1):
+  """Fan out aggregation to several concurrent task queue workers.
+
+  Since tasks of each window are tagged across TASKQUEUE_TAG_SHARDS shards,
+  concurrent workers lease disjoint sets of tasks, even for the same window.
+
+  Args:
+    counters: An iterable of counters to aggregate.
+    num_workers: The number of workers to start.
+    total_runtime_minutes: How long each worker processes data for.
+  """
+  for _ in range(num_workers):
+    deferred.defer(_RunAggregator, counters, total_runtime_minutes)
+
+def _RunAggregator(counters, total_runtime_minutes):
+  aggregator = Aggregator(counters)
+  aggregator.ProcessWindowsWithBackoff(
+      total_runtime_minutes=total_runtime_minutes)
+
+class _AggregateWindow(db.Model):
+  """Aggregate counter data of a window which has not yet been compacted.
+
+  Attributes:
+    window: The aggregation window, a unix timestamp.
+    date: The UTC day of the window, as a datetime.
+    counters: JSON of a dictionary mapping counter keys to finalized data.
+    counter_types: JSON of a dictionary mapping counter keys to the class
+        names of the counters, used to merge data into rollups.
+  """
+  window = db.IntegerProperty()
+  date = db.DateTimeProperty()
+  counters = db.TextProperty()
+  counter_types = db.TextProperty()
+
+  def GetCounterTypes(self):
+    """Get the counter class names, inferring them for older windows.
+
+    Windows stored before counter types were recorded have no types, so their
+    types are inferred from the shape of the data, which is enough to merge it.
+    """
+    counter_types = json.loads(self.counter_types) if self.counter_types else {}
+    if len(counter_types) < len(self.counters):
+      for counter_key, counter_value in json.loads(self.counters).iteritems():
+        if counter_key not in counter_types:
+          class_name = _InferCounterClassName(counter_value)
+          if class_name:
+            counter_types[counter_key] = class_name
+    return counter_types
+
+def CompactAggregateData(min_age_seconds=COMPACTION_MIN_AGE_SECONDS,
+                         batch_size=COMPACTION_BATCH_SIZE):
+  """Compact stored windows into per-day, per-counter Titan data files.
+
+  Each data file is rewritten at most once per call, no matter how many
+  windows are compacted into it.
+
+  Args:
+    min_age_seconds: Only compact windows at least this old.
+    batch_size: The max number of stored window entities to compact. Only
+        whole windows are compacted, so fewer may be compacted.
+  Returns:
+    The number of window entities compacted.
+  """
+  max_window = _GetWindow(time.time()) - min_age_seconds
+  window_ents = _AggregateWindow.all()
+  window_ents.filter('window <', max_window)
+  window_ents.order('window')
+  window_ents = window_ents.fetch(batch_size)
+  if not window_ents:
+    _UpdateCompactedThrough(max_window - DEFAULT_WINDOW_SIZE)
+    return 0
+  # If the batch isn't full, every window before max_window is compacted.
+  compacted_through = max_window - DEFAULT_WINDOW_SIZE
+  if len(window_ents) == batch_size:
+    # A window can be stored in several parts, and the batch may end partway
+    # through the last one. Its remaining parts would then be skipped as
+    # already compacted, so only compact whole windows.
+    last_window = window_ents[-1].window
+    whole_window_ents = [w for w in window_ents if w.window != last_window]
+    if whole_window_ents:
+      window_ents = whole_window_ents
+    else:
+      # The whole batch is one window; compact all of its parts.
+      window_ents = list(
+          _AggregateWindow.all().filter('window =', last_window))
+    compacted_through = window_ents[-1].window
+
+  # Group the new data by data file. For counters with dimensions, counter
+  # names below are counter keys.
+  new_data = collections.defaultdict(list)
+  data_file_meta = {}
+  counter_types = {}
+  for window_ent in window_ents:
+    window_datetime = datetime.datetime.utcfromtimestamp(window_ent.window)
+    counters = json.loads(window_ent.counters)
+    counter_types.update(window_ent.GetCounterTypes())
+    for counter_name, counter_value in counters.iteritems():
       path = _MakeLogPath(window_datetime, counter_name)
-      file_obj = files.Get(path)
-      content = []
-      if file_obj:
-        content = json.loads(file_obj.content)
-      content.append((window, counter_value))
-
-      date = datetime.datetime.utcfromtimestamp(window)
-      # Strip hours/minutes/seconds from date since the datastore can only
-      # store datetime objects, but we only need the date itself.
-      date = datetime.datetime(date.year, date.month, date.day)
-      meta = {
+      new_data[path].append((window_ent.window, counter_value))
+      data_file_meta[path] = {
           'stats_counter_name': counter_name,
-          'stats_date': date,
+          'stats_date': window_ent.date,
       }
-      files.Write(path, content=json.dumps(content), meta=meta)
+
+  # Maps (counter name, date) to dictionaries of counter keys to day values.
+  new_dimension_data = collections.defaultdict(dict)
+  for path, counter_data in new_data.iteritems():
+    file_obj = files.Get(path)
+    content = []
+    file_compacted_through = None
+    if file_obj:
+      content = _LoadCounterData(file_obj.content)
+      file_compacted_through = getattr(
+          file_obj, 'stats_compacted_through', None)
+    for window, counter_value in counter_data:
+      # Skip data which was already compacted by a previous call which failed
+      # before its windows were deleted.
+      if (file_compacted_through is None
+          or window > file_compacted_through):
+        content.append((window, counter_value))
+    content.sort(key=lambda d: d[0])
+    meta = data_file_meta[path].copy()
+    meta['stats_compacted_through'] = max(
+        [d[0] for d in counter_data] + [file_compacted_through])
+    counter_name = meta['stats_counter_name']
+    counter_class = _GetCounterClass(counter_types.get(counter_name))
+    if counter_class:
+      # Merge data of the same window, which was aggregated in parts.
+      content = _RollUp(counter_class, counter_name, content,
+                        DEFAULT_WINDOW_SIZE)
+    files.Write(path, content=_DumpCounterData(content), meta=meta)
+
+    # Rebuild the day's rollups from the full day of raw windows.
+    if not counter_class:
+      logging.warning('Unknown counter type for "%s", not storing rollups.',
+                      counter_name)
+      continue
+    for resolution in RESOLUTIONS[1:]:
+      rollup_data = _RollUp(counter_class, counter_name, content, resolution)
+      rollup_path = _MakeLogPath(meta['stats_date'], counter_name, resolution)
+      files.Write(rollup_path, content=_DumpCounterData(rollup_data),
+                  meta=meta)
+
+    name, dimensions = _ParseCounterKey(counter_name)
+    if dimensions:
+      # The last rollup has a single point: the value for the whole day.
+      new_dimension_data[(name, meta['stats_date'])][counter_name] = (
+          counter_types[counter_name], rollup_data[0][1],
+          meta['stats_compacted_through'])
+
+  for (name, date), counter_data in new_dimension_data.iteritems():
+    _UpdateDimensionsFile(name, date, counter_data)
+
+  db.delete(window_ents)
+  _UpdateCompactedThrough(compacted_through)
+  logging.info('Compacted %d stats windows into %d data files.',
+               len(window_ents), len(new_data))
+  return len(window_ents)
+
+def GetCompactedThrough():
+  """Get the window through which all stored windows have been compacted.
+
+  Returns:
+    A window, or None if windows have never been compacted.
+  """
+  file_obj = files.Get(COMPACTION_STATE_PATH)
+  if not file_obj:
+    return None
+  return getattr(file_obj, 'stats_compacted_through', None)
+
+def _UpdateCompactedThrough(compacted_through):
+  if compacted_through <= GetCompactedThrough():
+    return
+  files.Write(COMPACTION_STATE_PATH, content='',
+              meta={'stats_compacted_through': compacted_through})
+
+def _UpdateDimensionsFile(counter_name, date, counter_data):
+  """Update the day values of a counter's dimensional counters.
+
+  Args:
+    counter_name: The counter name, without dimensions.
+    date: The day, as a datetime.
+    counter_data: A dictionary mapping counter keys to three-tuples of
+        (counter class name, day value, last compacted window).
+  """
+  path = _MakeDimensionsPath(date, counter_name)
+  file_obj = files.Get(path)
+  content = {'counter_types': {}, 'counters': {}}
+  compacted_through = None
+  if file_obj:
+    content = json.loads(file_obj.content)
+    compacted_through = getattr(file_obj, 'stats_compacted_through', None)
+  for counter_key, (class_name, value, last_window) in (
+      counter_data.iteritems()):
+    content['counter_types'][counter_key] = class_name
+    content['counters'][counter_key] = value
+    compacted_through = max(compacted_through, last_window)
+  meta = {
+      'stats_counter_name': counter_name,
+      'stats_date': date,
+      'stats_compacted_through': compacted_through,
+  }
+  files.Write(path, content=json.dumps(content), meta=meta)
 
 class CountersService(object):
   """A service class to retrieve permanently stored counter stats."""
 
-  def GetCounterData(self, counter_names, start_date=None, end_date=None):
+  def GetCounterData(self, counter_names, start_date=None, end_date=None,
+                     resolution=None, max_points=None,
+                     since=None):
     """Get a date range of stored counter data.
 
+    The assembled results are cached per date range. Each counter's series is
+    also cached per day: the compacted data of a day is cached until the next
+    compaction, or for long once every window of the day has been compacted.
+    Windows which have not been compacted are read each time the range isn't
+    cached, since parts of them can still be added.
+
     Args:
-      counter_names: An iterable of counter names.
+      counter_names: An iterable of counter names, or keys of counters with
+          dimensions.
       start_date: A datetime.date object. Defaults to the current day.
       end_date: A datetime.date object. Defaults to current day.
+      resolution: The number of seconds per data point, one of RESOLUTIONS.
+          Defaults to the finest resolution which fits within max_points, or
+          to raw windows if max_points isn't given either.
+      max_points: The max number of data points per counter, used to pick a
+          resolution if one isn't given. For example, DEFAULT_MAX_POINTS.
+      since: If given, only return data points which include windows after
+          this window, so a point which is still filling up is returned again.
+    Raises:
+      ValueError: If the date range or resolution is invalid.
     Returns:
       A dictionary mapping counter_names to a list of counter data. For example:
       {
@@ -394,41 +1141,452 @@ class CountersService(object):
     end_date = datetime.datetime(
         end_date.year, end_date.month, end_date.day)
 
-    # Get all files within the range.
-    file_objs = []
-    for counter_name in counter_names:
-      filters = [
-          ('stats_counter_name =', counter_name),
-          ('stats_date >=', start_date),
-          ('stats_date <=', end_date),
-      ]
-      new_file_objs = files.ListFiles(BASE_DIR, recursive=True, filters=filters)
-      file_objs.extend(new_file_objs)
+    num_days = (end_date - start_date).days + 1
+    if resolution is None:
+      if max_points is None:
+        resolution = DEFAULT_WINDOW_SIZE
+      else:
+        resolution = _PickResolution(num_days * 24 * 60 * 60, max_points)
+    if resolution not in RESOLUTIONS:
+      raise ValueError('Resolution must be one of %r. Got: %r'
+                       % (RESOLUTIONS, resolution))
+
+    dates = [start_date + datetime.timedelta(days=i) for i in range(num_days)]
+    if since is not None:
+      # Skip days which ended before the since window.
+      dates = [d for d in dates if _GetDate(since) <= d]
+    day_keys = [(n, d) for n in counter_names for d in dates]
+    if not day_keys:
+      return {}
+
+    # The assembled range is cached, keyed by the compaction state.
+    compacted_through = GetCompactedThrough()
+    range_cache_key = _MakeRangeCacheKey(
+        counter_names, dates, resolution, since, compacted_through)
+    final_counter_data = sharded_cache.Get(range_cache_key)
+    if final_counter_data is not None:
+      return final_counter_data
+
+    # Get the cached series of each counter for each day within the range.
+    # Series of days which are not final only hold compacted data, so they
+    # are valid until the next compaction.
+    cache_keys = {}
+    for day_key in day_keys:
+      cache_keys[day_key] = _MakeSeriesCacheKey(
+          day_key[0], day_key[1], resolution)
+    cached_series = memcache.get_multi(cache_keys.values())
+    series = {}
+    uncached_day_keys = []
+    for day_key in day_keys:
+      day_series = cached_series.get(cache_keys[day_key])
+      if day_series and (
+          day_series['is_final']
+          or day_series['compacted_through'] == compacted_through):
+        series[day_key] = day_series
+      else:
+        uncached_day_keys.append(day_key)
+
+    # Start the query for windows which have not yet been compacted, so that
+    # it runs in parallel with the batch get of data files.
+    recent_dates = [d for d in dates if not _IsDayFinal(d, compacted_through)]
+    if recent_dates:
+      window_ents = _AggregateWindow.all()
+      window_ents.filter('date >=', min(recent_dates))
+      window_ents.filter('date <=', max(recent_dates))
+      window_ents = window_ents.run(batch_size=1000)
+
+    if uncached_day_keys:
+      loaded_series = self._LoadSeries(
+          uncached_day_keys, resolution, compacted_through)
+      series.update(loaded_series)
+      _CacheSeries(loaded_series, cache_keys)
+
+    if recent_dates:
+      # Merge the windows which have not yet been compacted into copies of
+      # the series, which are not cached.
+      recent_series = {}
+      for day_key, day_series in series.iteritems():
+        if not day_series['is_final']:
+          recent_series[day_key] = day_series.copy()
+      new_data = _GetNewSeriesData(recent_series, window_ents)
+      for day_key, counter_data in new_data.iteritems():
+        _MergeSeries(recent_series[day_key], day_key[0], counter_data,
+                     resolution)
+      series.update(recent_series)
 
     final_counter_data = {}
-    for file_obj in files.SmartFileList(file_objs):
-      # Since JSON only represents lists, convert each inner-list back
-      # to a two-tuple.
-      counter_data = json.loads(file_obj.content)
-      counter_data = [tuple(d) for d in counter_data]
-
-      _, counter_name = _ParseLogPath(file_obj.path)
-      if not counter_name in final_counter_data:
-        final_counter_data[counter_name] = []
-      final_counter_data[counter_name].extend(counter_data)
+    # The last raw window of each point must be after the since window.
+    since_offset = resolution - DEFAULT_WINDOW_SIZE
+    for day_key in day_keys:
+      counter_data = series[day_key]['data']
+      if since is not None:
+        counter_data = [d for d in counter_data if d[0] + since_offset > since]
+      if counter_data:
+        final_counter_data.setdefault(day_key[0], []).extend(counter_data)
+
+    sharded_cache.Set(range_cache_key, final_counter_data,
+                      time=(RANGE_CACHE_RECENT_SECONDS if recent_dates
+                            else RANGE_CACHE_SECONDS))
     return final_counter_data
 
+  @staticmethod
+  def _LoadSeries(day_keys, resolution, compacted_through):
+    """Load the compacted series of counters for days from data files.
+
+    Args:
+      day_keys: A list of (counter name, date) two-tuples.
+      resolution: The number of seconds per data point.
+      compacted_through: The window through which all windows are compacted.
+    Returns:
+      A dictionary mapping day keys to series dictionaries.
+    """
+    paths = {}
+    for counter_name, date in day_keys:
+      paths[(counter_name, date)] = _MakeLogPath(date, counter_name, resolution)
+    file_objs = files.Get(paths.values())
+
+    series = {}
+    for day_key in day_keys:
+      day_series = _MakeSeries(
+          is_final=_IsDayFinal(day_key[1], compacted_through),
+          compacted_through=compacted_through)
+      file_obj = file_objs.get(paths[day_key])
+      if file_obj:
+        day_series['data'] = _LoadCounterData(file_obj.content)
+        day_series['through'] = getattr(
+            file_obj, 'stats_compacted_through', None)
+      series[day_key] = day_series
+    return series
+
+  def GetTopDimensionValues(self, counter_name, dimension, date=None,
+                            limit=10):
+    """Get the top values of a dimension for a day, by the counters' values.
+
+    Data of counters with other dimensions is merged; for example, the top
+    projects of a counter with both "project" and "user" dimensions include
+    the data of all users in each project.
+
+    Args:
+      counter_name: A counter name, without dimensions.
+      dimension: The dimension name.
+      date: A datetime.date object. Defaults to the current day.
+      limit: The max number of dimension values to return.
+    Returns:
+      A list of (dimension value, counter data) two-tuples, highest first.
+      Counter data is compared by its first element if it is a sequence, such
+      as the average of an AverageCounter.
+    """
+    date = date or datetime.datetime.now()
+    date = datetime.datetime(date.year, date.month, date.day)
+    file_obj = files.Get(_MakeDimensionsPath(date, counter_name))
+    content = {'counter_types': {}, 'counters': {}}
+    compacted_through = None
+    if file_obj:
+      content = json.loads(file_obj.content)
+      compacted_through = getattr(file_obj, 'stats_compacted_through', None)
+    counter_types = content['counter_types']
+    counter_data = [(k, v) for k, v in content['counters'].iteritems()]
+
+    # Include the windows which have not yet been compacted.
+    window_ents = _AggregateWindow.all().filter('date =', date)
+    for window_ent in window_ents:
+      if (compacted_through is not None
+          and window_ent.window <= compacted_through):
+        continue
+      counters = json.loads(window_ent.counters)
+      for counter_key, counter_value in counters.iteritems():
+        if _ParseCounterKey(counter_key)[0] == counter_name:
+          counter_data.append((counter_key, counter_value))
+      counter_types.update(window_ent.GetCounterTypes())
+
+    # Merge counter data by the value of the dimension.
+    dimension_counters = {}
+    for counter_key, counter_value in counter_data:
+      dimensions = _ParseCounterKey(counter_key)[1]
+      if dimension not in dimensions:
+        continue
+      counter_class = _GetCounterClass(counter_types.get(counter_key))
+      if not counter_class:
+        continue
+      dimension_value = dimensions[dimension]
+      if dimension_value not in dimension_counters:
+        dimension_counters[dimension_value] = counter_class(counter_name)
+      dimension_counters[dimension_value].Aggregate(counter_value)
+
+    results = [(value, counter.Finalize())
+               for value, counter in dimension_counters.iteritems()]
+    results.sort(key=lambda r: _GetSortValue(r[1]), reverse=True)
+    return results[:limit]
+
+  def GetPercentiles(self, counter_names, percentiles=DEFAULT_PERCENTILES,
+                     **kwargs):
+    """Get percentiles of stored histogram counter data.
+
+    Args:
+      counter_names: An iterable of HistogramCounter names.
+      percentiles: An iterable of numbers between 0 and 100.
+      **kwargs: Keyword arguments for GetCounterData.
+    Returns:
+      A dictionary mapping counter_names to a list of percentile data. For
+      example:
+      {
+          'files/Get/latency/histogram': [
+              (<window>, {50: <value>, 95: <value>, 99: <value>}),
+              ...
+          ],
+      }
+    """
+    counter_data = self.GetCounterData(counter_names, **kwargs)
+    percentile_data = {}
+    for counter_name, data in counter_data.iteritems():
+      percentile_data[counter_name] = []
+      for window, counter_value in data:
+        counter = HistogramCounter(_ParseCounterKey(counter_name)[0])
+        counter.Aggregate(counter_value)
+        values = dict([(p, counter.Percentile(p)) for p in percentiles])
+        percentile_data[counter_name].append((window, values))
+    return percentile_data
+
+def _MakeSeries(is_final, compacted_through):
+  """Make a cacheable series of a counter for a day.
+
+  Args:
+    is_final: Whether the day's data can no longer change.
+    compacted_through: The window through which all windows were compacted
+        when the series was loaded.
+  Returns:
+    A dictionary containing "data", a list of (window, value) two-tuples;
+    "through", the last raw window included in the data; "counter_type", the
+    counter's class name; "is_final"; and "compacted_through".
+  """
+  return {
+      'data': [],
+      'through': None,
+      'counter_type': None,
+      'is_final': is_final,
+      'compacted_through': compacted_through,
+  }
+
+def _IsDayFinal(date, compacted_through):
+  """Whether every window of a day has been compacted."""
+  if compacted_through is None:
+    return False
+  last_window = (calendar.timegm(date.timetuple()) + 24 * 60 * 60
+                 - DEFAULT_WINDOW_SIZE)
+  return last_window <= compacted_through
+
+def _GetNewSeriesData(series, window_ents):
+  """Get data from windows after the "through" window of each series.
+
+  Args:
+    series: A dictionary mapping (counter name, date) to series dictionaries.
+    window_ents: An iterable of _AggregateWindow entities.
+  Returns:
+    A dictionary mapping (counter name, date) to lists of counter data.
+  """
+  new_data = collections.defaultdict(list)
+  for window_ent in window_ents:
+    counters = json.loads(window_ent.counters)
+    counter_types = window_ent.GetCounterTypes()
+    for counter_name, counter_value in counters.iteritems():
+      day_key = (counter_name, window_ent.date)
+      day_series = series.get(day_key)
+      if day_series is None:
+        continue
+      # Skip windows which were compacted after the series was loaded.
+      through = day_series['through']
+      if through is not None and window_ent.window <= through:
+        continue
+      new_data[day_key].append((window_ent.window, counter_value))
+      if counter_name in counter_types:
+        day_series['counter_type'] = counter_types[counter_name]
+  return new_data
+
+def _MergeSeries(series, counter_name, counter_data, resolution):
+  """Merge raw windows of counter data into a series."""
+  series['through'] = max([d[0] for d in counter_data] + [series['through']])
+  data = series['data'] + counter_data
+  counter_class = _GetCounterClass(series['counter_type'])
+  if counter_class:
+    # Merge the raw windows into the points which contain them.
+    data = _RollUp(counter_class, counter_name, data, resolution)
+  elif resolution == DEFAULT_WINDOW_SIZE:
+    data.sort(key=lambda d: d[0])
+  else:
+    # Raw windows can't be merged into the points of a coarser resolution.
+    logging.warning('Unknown counter type for "%s", skipping %d windows.',
+                    counter_name, len(counter_data))
+    return
+  series['data'] = data
+
+def _CacheSeries(series, cache_keys):
+  """Cache finalized series for long, and other series until compacted.
+
+  Series of days which are not final are also replaced once the compaction
+  state changes, so they only need to expire in case it is never read.
+  """
+  final_series = {}
+  recent_series = {}
+  for day_key, day_series in series.iteritems():
+    if day_series['is_final']:
+      final_series[cache_keys[day_key]] = day_series
+    else:
+      recent_series[cache_keys[day_key]] = day_series
+  if final_series:
+    memcache.set_multi(final_series, time=FINAL_SERIES_CACHE_SECONDS)
+  if recent_series:
+    memcache.set_multi(recent_series, time=COMPACTION_MIN_AGE_SECONDS)
+
+def _MakeSeriesCacheKey(counter_name, date, resolution):
+  key = json.dumps([counter_name, date.isoformat(), resolution])
+  return SERIES_CACHE_PREFIX + hashlib.sha1(key).hexdigest()
+
+def _MakeRangeCacheKey(counter_names, dates, resolution, since,
+                       compacted_through):
+  key = json.dumps([sorted(set(counter_names)), dates[0].isoformat(),
+                    dates[-1].isoformat(), resolution, since,
+                    compacted_through])
+  return RANGE_CACHE_PREFIX + hashlib.sha1(key).hexdigest()
+
+def _InferCounterClassName(counter_value):
+  """Get the name of a counter class which can merge the given data."""
+  if isinstance(counter_value, (int, long, float)):
+    return Counter.__name__
+  if isinstance(counter_value, (list, tuple)):
+    if len(counter_value) == 2:
+      return AverageCounter.__name__
+    if len(counter_value) == 3:
+      return HistogramCounter.__name__
+  return None
+
+def _GetCounterClass(class_name):
+  """Get a counter class from its name, or None if it isn't known."""
+  if not class_name:
+    return None
+  counter_classes = [AbstractBaseCounter]
+  while counter_classes:
+    counter_class = counter_classes.pop()
+    if counter_class.__name__ == class_name:
+      return counter_class
+    counter_classes.extend(counter_class.__subclasses__())
+  return None
+
+def _RollUp(counter_class, counter_name, counter_data, resolution):
+  """Merge counter data into points of a coarser resolution.
+
+  Args:
+    counter_class: The counter class whose Aggregate method merges data.
+    counter_name: The name or key of the counter.
+    counter_data: A list of (window, value) two-tuples.
+    resolution: The number of seconds per rolled-up point.
+  Returns:
+    A sorted list of (window, value) two-tuples, where each window is the
+    start of a rolled-up point.
+  """
+  name = _ParseCounterKey(counter_name)[0]
+  counters = {}
+  for window, counter_value in counter_data:
+    window -= window % resolution
+    if window not in counters:
+      counters[window] = counter_class(name)
+    counters[window].Aggregate(counter_value)
+  return [(window, counters[window].Finalize())
+          for window in sorted(counters)]
+
+def _GetHistogramBucket(value):
+  """Get the index of the histogram bucket containing the given value."""
+  if value < 1:
+    # Zero, and any fraction of a unit, share the first bucket.
+    return 0
+  return 1 + int(math.log(value, HISTOGRAM_BUCKET_GROWTH))
+
+def _GetHistogramBucketValue(index):
+  """Get the value which represents a histogram bucket."""
+  if not index:
+    return 0
+  # The geometric midpoint of the bucket's lower and upper bounds.
+  return HISTOGRAM_BUCKET_GROWTH ** (index - 0.5)
+
+def _GetSortValue(counter_value):
+  """Get a comparable value from counter data, for sorting."""
+  if isinstance(counter_value, (list, tuple)):
+    return counter_value[0]
+  return counter_value
+
+def _MakeCounterKey(counter_name, dimensions):
+  """Make a key like "project/write|project=foo,user=bar"."""
+  if not dimensions:
+    return counter_name
+  dimensions = DIMENSIONS_DELIMITER.join(
+      ['%s%s%s' % (k, DIMENSION_VALUE_DELIMITER, dimensions[k])
+       for k in sorted(dimensions)])
+  return '%s%s%s' % (counter_name, COUNTER_KEY_DELIMITER, dimensions)
+
+def _ParseCounterKey(counter_key):
+  """Get a two-tuple of the counter name and dimensions from a counter key."""
+  if COUNTER_KEY_DELIMITER not in counter_key:
+    return counter_key, {}
+  counter_name, dimensions = counter_key.split(COUNTER_KEY_DELIMITER, 1)
+  dimensions = dict([d.split(DIMENSION_VALUE_DELIMITER, 1)
+                     for d in dimensions.split(DIMENSIONS_DELIMITER)])
+  return counter_name, dimensions
+
+def _PickResolution(num_seconds, max_points):
+  """Get the finest resolution that fits num_seconds within max_points."""
+  for resolution in RESOLUTIONS:
+    if num_seconds / resolution <= max_points:
+      return resolution
+  return RESOLUTIONS[-1]
+
 def _GetWindow(timestamp=None, window_size=DEFAULT_WINDOW_SIZE):
   """Get the aggregation window for the given unix time and window size."""
   return int(window_size * round(float(timestamp) / window_size))
 
-def _MakeLogPath(date, counter_name):
+def _GetDate(window):
+  """Get the UTC day of a window."""
+  date = datetime.datetime.utcfromtimestamp(window)
+  # Strip hours/minutes/seconds from date since the datastore can only
+  # store datetime objects, but we only need the date itself.
+  return datetime.datetime(date.year, date.month, date.day)
+
+def _MakeLogPath(date, counter_name, resolution=DEFAULT_WINDOW_SIZE):
   # Make a path like: /_titan/stats/counters/2015/05/15/page/view/data-10s.json
   path = os.path.join(
       BASE_DIR, str(date.year), str(date.month), str(date.day),
-      counter_name, DATA_FILENAME)
+      counter_name, DATA_FILENAME_FORMAT % resolution)
   return path
 
+def _DumpCounterData(counter_data):
+  """Serialize counter data, in the columnar format if it can be encoded."""
+  content = columnar.Encode(counter_data, compress=COMPRESS_DATA_FILES)
+  if content is None:
+    content = json.dumps(counter_data)
+  return content
+
+def _LoadCounterData(content):
+  """Deserialize counter data from columnar or JSON data file content.
+
+  Returns:
+    A list of (window, value) two-tuples.
+  """
+  if columnar.IsEncoded(content):
+    return columnar.Decode(content)
+  # Since JSON only represents lists, convert each inner-list back
+  # to a two-tuple, and sequence values back to tuples.
+  counter_data = []
+  for window, counter_value in json.loads(content):
+    if isinstance(counter_value, list):
+      counter_value = tuple(counter_value)
+    counter_data.append((window, counter_value))
+  return counter_data
+
+def _MakeDimensionsPath(date, counter_name):
+  # Make a path like:
+  # /_titan/stats/counters/2015/05/15/project/write/dimensions.json
+  return os.path.join(
+      BASE_DIR, str(date.year), str(date.month), str(date.day),
+      counter_name, DIMENSIONS_FILENAME)
+
 def _ParseLogPath(path):
   parts = path.split('/')
   date = datetime.date(int(parts[4]), int(parts[5]), int(parts[6]))